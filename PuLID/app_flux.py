@@ -4,7 +4,7 @@ from einops import rearrange
 from PIL import Image
 
 from .flux.sampling import denoise, get_noise, get_schedule, prepare, unpack
-from .flux.util import load_ae, load_clip, load_flow_model, load_t5, load_flow_model_quintized,SamplingOptions
+from .flux.util import load_ae, load_clip, load_flow_model, load_t5, load_flow_model_quintized
 from .pulid.pipeline_flux import PuLIDPipeline
 
 
@@ -75,56 +75,134 @@ class FluxGenerator:
             true_cfg=1.0,
             timestep_to_start_cfg=1,
             max_sequence_length=128,
+            cfg_interval=1,
     ):
-        if self.if_repo:
-            self.t5.max_length = max_sequence_length
-
-        seed = int(seed)
-        if seed == -1:
-            seed = None
-        
         if isinstance(prompt,str):
             text=prompt
         elif isinstance(prompt,list):
             text=prompt[0]
         else:
             raise "prompt must be list or str"
+        return self.generate_images(
+            width, height, num_steps, start_step, guidance, seed, [text],
+            id_embeddings=[id_embeddings], uncond_id_embeddings=[uncond_id_embeddings], id_weight=id_weight,
+            neg_prompt=neg_prompt, true_cfg=true_cfg, timestep_to_start_cfg=timestep_to_start_cfg,
+            max_sequence_length=max_sequence_length, cfg_interval=cfg_interval,
+        )[0]
 
-        opts = SamplingOptions(
-            text=text,
-            width=width,
-            height=height,
-            num_steps=num_steps,
-            guidance=guidance,
-            seed=seed,
-        )
-        
-        if opts.seed is None:
-            opts.seed = torch.Generator(device="cpu").seed()
-        opts.text = opts.text if isinstance(opts.text,str) else str(opts.text)
-        print(f"Generating '{opts.text}' with seed {opts.seed}")
+    @torch.inference_mode()
+    def generate_images(
+            self,
+            width,
+            height,
+            num_steps,
+            start_step,
+            guidance,
+            seed,
+            prompts,
+            id_embeddings=None,
+            uncond_id_embeddings=None,
+            id_weight=1.0,
+            neg_prompt="",
+            true_cfg=1.0,
+            timestep_to_start_cfg=1,
+            max_sequence_length=128,
+            cfg_interval=1,
+            batch_size=1,
+    ):
+        """
+        one image per prompt,see iter_generate_images.
+        """
+        images = [None] * len(prompts)
+        for inds, batch_images in self.iter_generate_images(
+                width, height, num_steps, start_step, guidance, seed, prompts, id_embeddings=id_embeddings,
+                uncond_id_embeddings=uncond_id_embeddings, id_weight=id_weight, neg_prompt=neg_prompt,
+                true_cfg=true_cfg, timestep_to_start_cfg=timestep_to_start_cfg,
+                max_sequence_length=max_sequence_length, cfg_interval=cfg_interval, batch_size=batch_size):
+            for j, img in zip(inds, batch_images):
+                images[j] = img
+        return images
+
+    def decode_latents(self, x, height, width):
+        # packed latents of a mini batch to PIL images
+        x = unpack(x.float(), height, width)
+        with torch.autocast(device_type=self.device.type, dtype=torch.bfloat16):
+            x = self.ae.decode(x)
+
+        # bring into PIL format
+        x = x.clamp(-1, 1)
+        # x = embed_watermark(x.float())
+        x = rearrange(x, "b c h w -> b h w c")
+        x = (127.5 * (x + 1.0)).cpu().byte().numpy()
+        return [Image.fromarray(img) for img in x]
+
+    @torch.inference_mode()
+    def iter_generate_images(
+            self,
+            width,
+            height,
+            num_steps,
+            start_step,
+            guidance,
+            seed,
+            prompts,
+            id_embeddings=None,
+            uncond_id_embeddings=None,
+            id_weight=1.0,
+            neg_prompt="",
+            true_cfg=1.0,
+            timestep_to_start_cfg=1,
+            max_sequence_length=128,
+            cfg_interval=1,
+            batch_size=1,
+    ):
+        """
+        one image per prompt,id_embeddings/uncond_id_embeddings are a list with one tensor (or None) per prompt.
+        every prompt is encoded first,then the images are denoised batch_size at a time and (prompt indices,images)
+        of every mini batch are yielded as soon as it is decoded. without offload the ae decodes a mini batch right
+        after it is denoised,with offload the flow model stays on the gpu for every mini batch and the ae decodes
+        them at the end,so the offload moves happen once per call.
+        """
+        if self.if_repo:
+            self.t5.max_length = max_sequence_length
+
+        seed = int(seed)
+        if seed == -1:
+            seed = torch.Generator(device="cpu").seed()
+        prompts = [text if isinstance(text, str) else str(text) for text in prompts]
+        if not isinstance(id_embeddings, (list, tuple)):
+            id_embeddings = [id_embeddings] * len(prompts)
+        if not isinstance(uncond_id_embeddings, (list, tuple)):
+            uncond_id_embeddings = [uncond_id_embeddings] * len(prompts)
+        for text in prompts:
+            print(f"Generating '{text}' with seed {seed}")
         t0 = time.perf_counter()
         
         use_true_cfg = abs(true_cfg - 1.0) > 1e-2
 
-        # prepare input
+        # prepare input,every image starts from the same noise as a single generate_image call
         x = get_noise(
             1,
-            opts.height,
-            opts.width,
+            height,
+            width,
             device=self.device,
             dtype=torch.bfloat16,
-            seed=opts.seed,
+            seed=seed,
         )
         timesteps = get_schedule(
-            opts.num_steps,
+            num_steps,
             x.shape[-1] * x.shape[-2] // 4,
             shift=True,
         )
         
         if self.offload and  self.if_repo:
             self.t5, self.clip = self.t5.to(self.device), self.clip.to(self.device)
-        inp = prepare(t5=self.t5, clip=self.clip, img=x, prompt=opts.text,if_repo=self.if_repo)
+        if self.if_repo:
+            # one t5/clip call for every prompt
+            inp = prepare(t5=self.t5, clip=self.clip, img=x, prompt=prompts, if_repo=self.if_repo)
+            inps = [{k: v[j:j + 1] for k, v in inp.items()} for j in range(len(prompts))]
+        else:
+            inps = [prepare(t5=self.t5, clip=self.clip, img=x, prompt=text, if_repo=self.if_repo) for text in prompts]
         inp_neg = prepare(t5=self.t5, clip=self.clip, img=x, prompt=neg_prompt,if_repo=self.if_repo) if use_true_cfg else None
         
         
@@ -142,44 +220,52 @@ class FluxGenerator:
             self.model = self.model.to(self.device)
         torch.cuda.empty_cache()
         
+        # mini batches of consecutive images whose txt length and id usage match
+        batches = []
+        for j, cur_inp in enumerate(inps):
+            key = (cur_inp["txt"].shape, id_embeddings[j] is None, uncond_id_embeddings[j] is None)
+            if batches and batches[-1][0] == key and len(batches[-1][1]) < max(batch_size, 1):
+                batches[-1][1].append(j)
+            else:
+                batches.append((key, [j]))
+        
         # denoise initial noise
         print("start denoise...")
-        x = denoise(
-            self.model, **inp, timesteps=timesteps, guidance=opts.guidance, id=id_embeddings, id_weight=id_weight,
-            start_step=start_step, uncond_id=uncond_id_embeddings, true_cfg=true_cfg,
-            timestep_to_start_cfg=timestep_to_start_cfg,
-            neg_txt=inp_neg["txt"] if use_true_cfg else None,
-            neg_txt_ids=inp_neg["txt_ids"] if use_true_cfg else None,
-            neg_vec=inp_neg["vec"] if use_true_cfg else None,
-            aggressive_offload=self.aggressive_offload,
-        )
+        pending = []  # mini batches waiting for the ae while the flow model holds the gpu
+        for _, inds in batches:
+            batch_inp = {k: torch.cat([inps[j][k] for j in inds]) for k in inps[inds[0]]}
+            cur_id = torch.cat([id_embeddings[j] for j in inds]) if id_embeddings[inds[0]] is not None else None
+            cur_uncond_id = torch.cat([uncond_id_embeddings[j] for j in inds]) \
+                if uncond_id_embeddings[inds[0]] is not None else None
+            neg = {k: torch.cat([v] * len(inds)) for k, v in inp_neg.items()} if use_true_cfg else None
+            x = denoise(
+                self.model, **batch_inp, timesteps=timesteps, guidance=guidance, id=cur_id, id_weight=id_weight,
+                start_step=start_step, uncond_id=cur_uncond_id, true_cfg=true_cfg,
+                timestep_to_start_cfg=timestep_to_start_cfg,
+                neg_txt=neg["txt"] if use_true_cfg else None,
+                neg_txt_ids=neg["txt_ids"] if use_true_cfg else None,
+                neg_vec=neg["vec"] if use_true_cfg else None,
+                aggressive_offload=self.aggressive_offload,
+                cfg_interval=cfg_interval,
+            )
+            if self.offload:
+                pending.append((inds, x))
+            else:
+                yield inds, self.decode_latents(x, height, width)
         
-        # offload model, load autoencoder to gpu
-        print("start decoder...")
-        if self.offload :
+        if pending:
+            # offload model, load autoencoder to gpu
+            print("start decoder...")
             if self.aggressive_offload:
                 self.model.cpu()
                 torch.cuda.empty_cache()
-            self.ae.decoder.to(x.device)
-        
-        # decode latents to pixel space
-        x = unpack(x.float(), opts.height, opts.width)
-        with torch.autocast(device_type=self.device.type, dtype=torch.bfloat16):
-            x = self.ae.decode(x)
-        
-        if self.offload:
+            self.ae.decoder.to(self.device)
+            # decode latents to pixel space,one mini batch at a time to bound the decoder activations
+            for inds, x in pending:
+                yield inds, self.decode_latents(x, height, width)
             self.ae.decoder.cpu()
             torch.cuda.empty_cache()
         
         t1 = time.perf_counter()
         
         print(f"Done in {t1 - t0:.1f}s.")
-        
-        # bring into PIL format
-        x = x.clamp(-1, 1)
-        # x = embed_watermark(x.float())
-        x = rearrange(x[0], "c h w -> h w c")
-        
-        img = Image.fromarray((127.5 * (x + 1.0)).cpu().byte().numpy())
-        # return img, str(opts.seed), self.pulid_model.debug_img_list
-        return img
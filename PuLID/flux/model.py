@@ -11,6 +11,7 @@ from .modules.layers import (
     SingleStreamBlock,
     timestep_embedding,
 )
+from .offload import BlockStreamer
 
 DEVICE = torch.device("cuda")
 
@@ -83,6 +84,7 @@ class Flux(nn.Module):
         self.pulid_ca = None
         self.pulid_double_interval = 2
         self.pulid_single_interval = 4
+        self.block_streamer = None
 
     def forward(
         self,
@@ -114,29 +116,22 @@ class Flux(nn.Module):
         pe = self.pe_embedder(ids)
 
         ca_idx = 0
+        double_blocks, single_blocks = self.double_blocks, self.single_blocks
         if aggressive_offload:
-            self.double_blocks = self.double_blocks.to(DEVICE)
-        for i, block in enumerate(self.double_blocks):
+            # stream the blocks that do not fit in vram,uploading the next ones while the current computes
+            streamer = self.get_block_streamer()
+            streamer.begin()
+            double_blocks = streamer.run(self.double_blocks)
+            single_blocks = streamer.run(self.single_blocks, len(self.double_blocks))
+        for i, block in enumerate(double_blocks):
             img, txt = block(img=img, txt=txt, vec=vec, pe=pe)
 
             if i % self.pulid_double_interval == 0 and id is not None:
                 img = img + id_weight * self.pulid_ca[ca_idx](id, img)
                 ca_idx += 1
-        if aggressive_offload:
-            self.double_blocks.cpu()
 
         img = torch.cat((txt, img), 1)
-        if aggressive_offload:
-            # put half of the single blcoks to gpu
-            for i in range(len(self.single_blocks) // 2):
-                self.single_blocks[i] = self.single_blocks[i].to(DEVICE)
-        for i, block in enumerate(self.single_blocks):
-            if aggressive_offload and i == len(self.single_blocks)//2:
-                # put first half of the single blcoks to cpu and last half to gpu
-                for j in range(len(self.single_blocks) // 2):
-                    self.single_blocks[j].cpu()
-                for j in range(len(self.single_blocks) // 2, len(self.single_blocks)):
-                    self.single_blocks[j] = self.single_blocks[j].to(DEVICE)
+        for i, block in enumerate(single_blocks):
             x = block(img, vec=vec, pe=pe)
             real_img, txt = x[:, txt.shape[1]:, ...], x[:, :txt.shape[1], ...]
 
@@ -145,13 +140,17 @@ class Flux(nn.Module):
                 ca_idx += 1
 
             img = torch.cat((txt, real_img), 1)
-        if aggressive_offload:
-            self.single_blocks.cpu()
         img = img[:, txt.shape[1] :, ...]
 
         img = self.final_layer(img, vec)  # (N, T, patch_size ** 2 * out_channels)
         return img
 
+    def get_block_streamer(self) -> BlockStreamer:
+        # built on first use,the pinned copies and the resident blocks are kept for later steps and runs
+        if self.block_streamer is None:
+            self.block_streamer = BlockStreamer([*self.double_blocks, *self.single_blocks], DEVICE)
+        return self.block_streamer
+
     def components_to_gpu(self):
         # everything but double_blocks, single_blocks
         self.img_in.to(DEVICE)
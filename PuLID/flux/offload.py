@@ -0,0 +1,101 @@
+import os
+
+import torch
+from torch import nn
+
+# aggressive_offload: GB of vram the double/single blocks may keep resident,"auto" uses the free vram
+# minus OFFLOAD_RESERVE_GB for activations,the blocks that do not fit are streamed from pinned memory
+OFFLOAD_BUDGET_GB = os.getenv("STORY_OFFLOAD_BUDGET_GB", "auto")
+OFFLOAD_RESERVE_GB = float(os.getenv("STORY_OFFLOAD_RESERVE_GB", "4"))
+# how many streamed blocks are uploaded ahead of the one computing
+OFFLOAD_WINDOW = int(os.getenv("STORY_OFFLOAD_WINDOW", "2"))
+
+
+def get_block_bytes(block: nn.Module) -> int:
+    return sum(t.numel() * t.element_size() for t in list(block.parameters()) + list(block.buffers()))
+
+
+class BlockStreamer:
+    """
+    Streams transformer blocks through the gpu: the leading blocks that fit in the vram budget stay resident,
+    every other block keeps a pinned cpu copy of its weights and is uploaded on a side cuda stream `window`
+    blocks ahead of the block computing,then dropped again once its kernels are queued.
+    """
+
+    def __init__(self, blocks, device, budget_gb=OFFLOAD_BUDGET_GB, window=OFFLOAD_WINDOW):
+        self.blocks = list(blocks)
+        self.device = device
+        self.window = max(window, 1)
+        self.stream = torch.cuda.Stream(device=device)
+        self.events = {}
+        self.host = {}  # block index:[(module,kind,name,pinned cpu tensor)]
+
+        sizes = [get_block_bytes(block) for block in self.blocks]
+        if str(budget_gb).lower() == "auto":
+            budget = torch.cuda.mem_get_info(device)[0] - OFFLOAD_RESERVE_GB * 1024 ** 3
+        else:
+            budget = float(budget_gb) * 1024 ** 3
+        budget -= self.window * max(sizes, default=0)  # room for the blocks in flight
+        self.resident = 0
+        while self.resident < len(self.blocks) and sizes[self.resident] <= budget:
+            budget -= sizes[self.resident]
+            self.resident += 1
+        for i in range(self.resident, len(self.blocks)):
+            self.host[i] = self.pin_block(self.blocks[i])
+        print(f"block streaming: {self.resident} blocks resident,{len(self.host)} streamed,window {self.window}")
+
+    @staticmethod
+    def pin_block(block):
+        host = []
+        for module in block.modules():
+            for kind in ("_parameters", "_buffers"):
+                for name, tensor in getattr(module, kind).items():
+                    if tensor is None:
+                        continue
+                    tensor = tensor.detach().cpu()
+                    try:
+                        tensor = tensor.pin_memory()
+                    except (RuntimeError, NotImplementedError):
+                        pass  # some quantized tensor types can not be pinned,they are copied synchronously
+                    if kind == "_parameters":
+                        tensor = nn.Parameter(tensor, requires_grad=False)
+                    getattr(module, kind)[name] = tensor
+                    host.append((module, kind, name, tensor))
+        return host
+
+    def upload(self, i):
+        if i not in self.host or i in self.events:
+            return
+        # the side stream waits for the queued compute,so the vram freed by dropped blocks is not reused too early
+        self.stream.wait_stream(torch.cuda.current_stream(self.device))
+        with torch.cuda.stream(self.stream):
+            for module, kind, name, tensor in self.host[i]:
+                on_device = tensor.detach().to(self.device, non_blocking=True)
+                if kind == "_parameters":
+                    on_device = nn.Parameter(on_device, requires_grad=False)
+                getattr(module, kind)[name] = on_device
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        self.events[i] = event
+
+    def offload(self, i):
+        for module, kind, name, tensor in self.host[i]:
+            getattr(module, kind)[name] = tensor
+        self.events.pop(i, None)
+
+    def begin(self):
+        for block in self.blocks[:self.resident]:
+            block.to(self.device)  # no-op unless the model was moved to cpu after the last run
+        for i in range(self.resident, min(self.resident + self.window, len(self.blocks))):
+            self.upload(i)
+
+    def run(self, blocks, offset=0):
+        # yields the blocks of one module list,offset is its first index in the streamed block list
+        for i, block in enumerate(blocks, offset):
+            event = self.events.get(i)
+            if event is not None:
+                torch.cuda.current_stream(self.device).wait_event(event)
+            yield block
+            if i in self.host:
+                self.offload(i)
+                self.upload(i + self.window)
@@ -126,39 +126,69 @@ def denoise(
     neg_txt_ids=None,
     neg_vec=None,
     aggressive_offload=False,
+    cfg_interval=1,
 ):
+    """
+    true cfg runs the cond and uncond pass as one batch when their txt shapes match and both (or neither)
+    use an id embedding. with cfg_interval=n the uncond pass only runs every n-th cfg step,the steps
+    between reuse the last (cond - uncond) difference.
+    """
     # this is ignored for schnell
     guidance_vec = torch.full((img.shape[0],), guidance, device=img.device, dtype=img.dtype)
     use_true_cfg = abs(true_cfg - 1.0) > 1e-2
+    can_batch = use_true_cfg and neg_txt is not None and txt.shape == neg_txt.shape and vec.shape == neg_vec.shape
+    cfg_delta = None
     for i, (t_curr, t_prev) in enumerate(zip(timesteps[:-1], timesteps[1:])):
         t_vec = torch.full((img.shape[0],), t_curr, dtype=img.dtype, device=img.device)
-        pred = model(
-            img=img,
-            img_ids=img_ids,
-            txt=txt,
-            txt_ids=txt_ids,
-            y=vec,
-            timesteps=t_vec,
-            guidance=guidance_vec,
-            id=id if i >= start_step else None,
-            id_weight=id_weight,
-            aggressive_offload=aggressive_offload,
-        )
-
-        if use_true_cfg and i >= timestep_to_start_cfg:
-            neg_pred = model(
+        cur_id = id if i >= start_step else None
+        cur_uncond_id = uncond_id if i >= start_step else None
+        run_cfg = use_true_cfg and i >= timestep_to_start_cfg
+        run_uncond = run_cfg and (cfg_delta is None or (i - timestep_to_start_cfg) % max(cfg_interval, 1) == 0)
+        if run_uncond and can_batch and (cur_id is None) == (cur_uncond_id is None):
+            pred, neg_pred = model(
+                img=torch.cat([img, img]),
+                img_ids=torch.cat([img_ids, img_ids]),
+                txt=torch.cat([txt, neg_txt]),
+                txt_ids=torch.cat([txt_ids, neg_txt_ids]),
+                y=torch.cat([vec, neg_vec]),
+                timesteps=torch.cat([t_vec, t_vec]),
+                guidance=torch.cat([guidance_vec, guidance_vec]),
+                id=torch.cat([cur_id, cur_uncond_id]) if cur_id is not None else None,
+                id_weight=id_weight,
+                aggressive_offload=aggressive_offload,
+            ).chunk(2)
+        else:
+            pred = model(
                 img=img,
                 img_ids=img_ids,
-                txt=neg_txt,
-                txt_ids=neg_txt_ids,
-                y=neg_vec,
+                txt=txt,
+                txt_ids=txt_ids,
+                y=vec,
                 timesteps=t_vec,
                 guidance=guidance_vec,
-                id=uncond_id if i >= start_step else None,
+                id=cur_id,
                 id_weight=id_weight,
                 aggressive_offload=aggressive_offload,
             )
-            pred = neg_pred + true_cfg * (pred - neg_pred)
+            if run_uncond:
+                neg_pred = model(
+                    img=img,
+                    img_ids=img_ids,
+                    txt=neg_txt,
+                    txt_ids=neg_txt_ids,
+                    y=neg_vec,
+                    timesteps=t_vec,
+                    guidance=guidance_vec,
+                    id=cur_uncond_id,
+                    id_weight=id_weight,
+                    aggressive_offload=aggressive_offload,
+                )
+
+        if run_uncond:
+            cfg_delta = pred - neg_pred
+        if run_cfg:
+            # same as neg_pred + true_cfg * (pred - neg_pred)
+            pred = pred + (true_cfg - 1.0) * cfg_delta
 
         img = img + (t_prev - t_curr) * pred
 
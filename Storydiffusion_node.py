@@ -8,16 +8,19 @@ import torch
 import os
 from PIL import ImageFont,Image
 import datetime
+import hashlib
+import threading
+import contextlib
 import folder_paths
 from comfy.clip_vision import load as clip_load
 from comfy.model_management import total_vram
 
 import torch.nn.functional as F
 import copy
-global total_count, attn_count, cur_step, mask1024, mask4096, attn_procs, unet
-global sa32, sa64
-global write
-global height_s, width_s
+from safetensors import safe_open
+from safetensors.torch import save_file
+from .utils.gradio_utils import get_attn_indice_plan, character_to_dict, process_original_prompt, get_ref_character
+from .utils.cache_utils import ANCHOR_CACHE, CharacterLibrary, get_hash_key, pipe_cache, prompt_cache
 
 photomaker_dir=os.path.join(folder_paths.models_dir, "photomaker")
 device = "cuda" if torch.cuda.is_available() else "mps" if torch.backends.mps.is_available() else "cpu"
@@ -31,6 +34,7 @@ fonts_lists = os.listdir(fonts_path)
 base_pt = os.path.join(photomaker_dir,"pt")
 if not os.path.exists(base_pt):
     os.makedirs(base_pt)
+character_library = CharacterLibrary(base_pt)
 
 def find_directories(base_path):
     directories = []
@@ -50,7 +54,6 @@ SCHEDULER_NAMES = ["normal", "karras", "exponential", "sgm_uniform", "simple", "
 def set_attention_processor(unet, id_length, is_ipadapter=False):
     from .ip_adapter.attention_processor import IPAttnProcessor2_0
     from .utils.gradio_utils import AttnProcessor2_0 as AttnProcessor
-    global attn_procs
     attn_procs = {}
     for name in unet.attn_processors.keys():
         cross_attention_dim = (
@@ -83,30 +86,80 @@ def set_attention_processor(unet, id_length, is_ipadapter=False):
                 attn_procs[name] = AttnProcessor()
 
     unet.set_attn_processor(copy.deepcopy(attn_procs))
+    # every unet owns its run state,so two loaders or two prompts never share counters and id banks
+    bind_story_ctx(unet, StoryAttnContext(id_length))
+    # the id banks live on the processors,so samplers sharing this unet run one after another
+    unet.story_lock = getattr(unet, "story_lock", None) or threading.Lock()
+
+
+def bind_story_ctx(unet, ctx):
+    for attn_processor in unet.attn_processors.values():
+        if isinstance(attn_processor, SpatialAttnProcessor2_0):
+            attn_processor.ctx = ctx
+            ctx.total_count += 1
+    unet.story_ctx = ctx
+
+
+def get_story_ctx(pipe):
+    # pipes without story-diffusion processors get a detached context,so callers can set it freely
+    ctx = getattr(getattr(pipe, "unet", None), "story_ctx", None)
+    return ctx if ctx is not None else StoryAttnContext()
+
+
+def new_story_ctx(pipe):
+    # a fresh context for every run,only the loader settings are carried over
+    unet = getattr(pipe, "unet", None)
+    old = getattr(unet, "story_ctx", None)
+    if old is None:
+        return StoryAttnContext()
+    ctx = StoryAttnContext(old.id_length, old.device, old.dtype)
+    ctx.bank_dtype = old.bank_dtype
+    bind_story_ctx(unet, ctx)
+    return ctx
+
+
+def story_run_lock(pipe):
+    return getattr(getattr(pipe, "unet", None), "story_lock", None) or contextlib.nullcontext()
 
 def load_single_character_weights(unet, filepath):
     """
     从指定文件中加载权重到 attention_processor 类的 id_bank 中。
+    .safetensors 文件通过 mmap 按需读取,只有正在去噪的 step 会被读入并移到设备上。
     参数:
     - model: 包含 attention_processor 类实例的模型。
     - filepath: 权重文件的路径。
     """
-    # 使用torch.load来读取权重
+    if filepath.endswith(".safetensors"):
+        handle = safe_open(filepath, framework="pt", device="cpu")  # mmap,nothing is read yet
+        metadata = handle.metadata() or {}
+        character = metadata["character"]
+        layer_keys = {}  # layer:{step:[keys of every img]}
+        for key in handle.keys():
+            attn_name, step_key, _ = key.rsplit("/", 2)
+            layer_keys.setdefault(attn_name, {}).setdefault(int(step_key), []).append(key)
+        for attn_name, attn_processor in unet.attn_processors.items():
+            if isinstance(attn_processor, SpatialAttnProcessor2_0):
+                step_keys = {step_key: sorted(keys, key=lambda k: int(k.rsplit("/", 1)[1]))
+                             for step_key, keys in layer_keys[attn_name].items()}
+                attn_processor.id_bank[character] = LazyIdBank(handle, step_keys, unet.device, unet.dtype)
+        if "steps" in metadata:
+            logging.debug(f"{character} was saved with {metadata['steps']} steps,longer runs reuse its last step")
+        logging.info(f"successsfully,load_single_character_weights {character}")
+        return
+    # 旧的 .pt 格式,使用torch.load来读取权重
     weights_to_load = torch.load(filepath, map_location=torch.device("cpu"))
-    weights_to_load.eval()
     character = weights_to_load["character"]
-    description = weights_to_load["description"]
     #print(character)
     for attn_name, attn_processor in unet.attn_processors.items():
         if isinstance(attn_processor, SpatialAttnProcessor2_0):
             # 转移权重到GPU（如果GPU可用的话）并赋值给id_bank
-            attn_processor.id_bank[character] = {}
-            for step_key in weights_to_load[attn_name].keys():
-
-                attn_processor.id_bank[character][step_key] = [
-                    tensor.to(unet.device)
-                    for tensor in weights_to_load[attn_name][step_key]
-                ]
+            steps = {step_key: torch.cat(tensors, dim=1) for step_key, tensors in weights_to_load[attn_name].items()}
+            sample = next(iter(steps.values()))
+            bank = IdBank(max(steps) + 1, max(t.shape[1] for t in steps.values()), sample.shape[-1],
+                          unet.device, sample.dtype, attn_processor.ctx.bank_dtype)
+            for step_key, tensor in steps.items():
+                bank.set(step_key, tensor.to(unet.device))
+            attn_processor.id_bank[character] = bank
     print("successsfully,load_single_character_weights")
 
 def load_character_files_on_running(unet, character_files: str):
@@ -115,43 +168,238 @@ def load_character_files_on_running(unet, character_files: str):
     weights_list = os.listdir(character_files)#获取路径下的权重列表
     #character_files_arr = character_files.splitlines()
     for character_file in weights_list:
+        if not character_file.endswith((".safetensors", ".pt")):
+            continue
         path_cur=os.path.join(character_files,character_file)
         load_single_character_weights(unet, path_cur)
     return True
 def save_single_character_weights(unet, character, description, filepath):
     """
-    保存 attention_processor 类中的 id_bank GPU Tensor 列表到指定文件中。
+    保存 attention_processor 类中的 id_bank 到 safetensors 文件中,键为 `layer/step/img`。
     参数:
     - model: 包含 attention_processor 类实例的模型。
     - filepath: 权重要保存到的文件路径。
     """
     weights_to_save = {}
-    weights_to_save["description"] = description
-    weights_to_save["character"] = character
+    steps = 0
     for attn_name, attn_processor in unet.attn_processors.items():
         if isinstance(attn_processor, SpatialAttnProcessor2_0):
-            # 将每个 Tensor 转到 CPU 并转为列表，以确保它可以被序列化
-            #print(attn_name, attn_processor)
-            weights_to_save[attn_name] = {}
-            for step_key in attn_processor.id_bank[character].keys():
-                weights_to_save[attn_name][step_key] = [
-                    tensor.cpu()
-                    for tensor in attn_processor.id_bank[character][step_key]
-                ]
-    # 使用torch.save保存权重
-    torch.save(weights_to_save, filepath)
+            bank = attn_processor.id_bank[character]
+            for step_key in bank.keys():
+                # the bank keeps the images of one step concatenated,so img is always 0
+                weights_to_save[f"{attn_name}/{step_key}/0"] = bank.get(step_key).contiguous().cpu()
+                steps = max(steps, step_key + 1)
+    save_file(weights_to_save, filepath,
+              metadata={"character": character, "description": description, "steps": str(steps)})
     
 def save_results(unet):
+    from .model_loader_utils import to_pil
     timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
     weight_folder_name =os.path.join(base_pt,f"{timestamp}")
     #创建文件夹
     if not os.path.exists(weight_folder_name):
         os.makedirs(weight_folder_name)
-    global character_dict
+    ctx = unet.story_ctx
+    character_dict = ctx.character_dict
     for char in character_dict:
+        if char in ctx.library_keys and character_library.get(ctx.library_keys[char]):
+            continue  # reused from the library,already on disk
         description = character_dict[char]
-        save_single_character_weights(unet,char,description,os.path.join(weight_folder_name, f'{char}.pt'))
+        filepath = os.path.join(weight_folder_name, f'{char}.safetensors')
+        save_single_character_weights(unet,char,description,filepath)
+        if char in ctx.library_keys:
+            # the id panels are kept with the bank,a later run returns them instead of sampling them again
+            image_paths = []
+            for ind, img in enumerate(ctx.id_images.get(char, [])):
+                image_path = os.path.join(weight_folder_name, f'{char}_id{ind}.png')
+                to_pil(img).save(image_path)
+                image_paths.append(image_path)
+            character_library.add(ctx.library_keys[char], char, filepath, images=image_paths, description=description,
+                                  height=ctx.height, width=ctx.width, sa32=ctx.sa32, sa64=ctx.sa64, steps=ctx.steps,
+                                  seed=ctx.seed)
         
+class StoryAttnContext:
+    """
+    Run state of consistent self-attention for one unet.
+    Args:
+        id_length (`int`):
+            The number of id images of each character.
+    """
+
+    def __init__(self, id_length=1, device=device, dtype=torch.float16):
+        self.id_length = id_length
+        self.total_length = id_length + 1
+        self.device = device
+        self.dtype = dtype
+        self.total_count = 0  # SpatialAttnProcessor2_0 calls in one denoising step
+        self.attn_count = 0
+        self.cur_step = 0
+        self.write = False
+        self.cur_character = []
+        self.character_dict = {}
+        self.sa32 = 0.5
+        self.sa64 = 0.5
+        self.height = 768
+        self.width = 768
+        self.steps = 50
+        self.seed = 0
+        self.plan = None
+        self.indices1024 = None
+        self.indices4096 = None
+        self.bank_dtype = "fp16"  # id bank storage,"fp16","fp8" or "int8"
+        self.library_keys = {}  # character:key in the character library
+        self.id_images = {}  # character:id panels of this run,in the order of its id prompts
+
+    def setup(self, sa32, sa64, height, width, steps=50, seed=0):
+        self.sa32 = sa32
+        self.sa64 = sa64
+        self.height = height
+        self.width = width
+        self.steps = steps
+        self.seed = seed
+        self.plan = None
+        self.library_keys = {}
+        self.id_images = {}
+
+    def start(self, write, cur_character):
+        # call before every pipe call
+        self.write = write
+        self.cur_character = cur_character
+        self.cur_step = 0
+        self.attn_count = 0
+
+    def sample_indices(self):
+        # indices of all steps are sampled once per (size,sa,steps,seed) and shared by later prompts and runs
+        if self.plan is None:
+            self.plan = get_attn_indice_plan(
+                self.total_length,
+                self.id_length,
+                self.sa32,
+                self.sa64,
+                self.height,
+                self.width,
+                self.steps,
+                self.seed,
+                device=self.device,
+            )
+        self.indices1024, self.indices4096 = self.plan.get(self.cur_step)
+
+    def step(self):
+        self.attn_count += 1
+        if self.attn_count == self.total_count:
+            self.attn_count = 0
+            self.cur_step += 1
+            self.sample_indices()
+
+
+def get_bank_step(steps, step):
+    # samplers running more steps than were written reuse the last written step before it
+    written = [key for key in steps if key <= step]
+    if not written:
+        raise KeyError(f"id bank has no step written at or before step {step},written steps:{sorted(steps)}")
+    return max(written)
+
+
+class IdBank:
+    """
+    Id features of one character in one attention layer.
+    All steps live in one preallocated (steps, 2, length, channel) buffer on the unet device,
+    stored as fp16 or as fp8/int8 with a per-step scale and dequantized when read.
+    """
+
+    def __init__(self, steps, length, channel, device=device, dtype=torch.float16, store_dtype="fp16"):
+        self.dtype = dtype
+        if store_dtype == "fp8" and hasattr(torch, "float8_e4m3fn"):
+            self.store_dtype, self.qmax = torch.float8_e4m3fn, 448.0
+        elif store_dtype in ("fp8", "int8"):
+            self.store_dtype, self.qmax = torch.int8, 127.0
+        else:
+            self.store_dtype, self.qmax = dtype, None
+        self.buffer = torch.zeros((max(steps, 1), 2, length, channel), device=device, dtype=self.store_dtype)
+        self.scales = torch.ones(max(steps, 1), device=device, dtype=torch.float32) if self.qmax else None
+        self.lengths = {}  # step:valid tokens
+
+    def grow(self, steps, length):
+        # only hit by schedulers calling the unet more than once per step or larger sa settings
+        buffer = self.buffer.new_zeros((steps, 2, length, self.buffer.shape[-1]))
+        buffer[:self.buffer.shape[0], :, :self.buffer.shape[2]] = self.buffer
+        self.buffer = buffer
+        if self.qmax:
+            scales = self.scales.new_ones(steps)
+            scales[:self.scales.shape[0]] = self.scales
+            self.scales = scales
+
+    def set(self, step, tensor):
+        length = tensor.shape[1]
+        if step >= self.buffer.shape[0] or length > self.buffer.shape[2]:
+            self.grow(max(step + 1, self.buffer.shape[0]), max(length, self.buffer.shape[2]))
+        if self.qmax:
+            scale = tensor.abs().amax().float().clamp(min=1e-8) / self.qmax
+            self.scales[step] = scale  # stays on device,no host sync
+            tensor = tensor.float() / scale
+            if self.store_dtype == torch.int8:
+                tensor = tensor.round().clamp(-127, 127)
+        self.buffer[step, :, :length] = tensor.to(self.store_dtype)
+        self.lengths[step] = length
+
+    def get(self, step):
+        if step not in self.lengths:
+            step = get_bank_step(self.lengths, step)
+        tensor = self.buffer[step, :, :self.lengths[step]]
+        if self.qmax:
+            return tensor.to(self.dtype) * self.scales[step].to(self.dtype)
+        return tensor
+
+    def keys(self):
+        return self.lengths.keys()
+
+    def nbytes(self):
+        total = self.buffer.numel() * self.buffer.element_size()
+        return total + (self.scales.numel() * 4 if self.qmax else 0)
+
+
+class LazyIdBank:
+    """
+    Id bank of one character in one attention layer read from a mmapped safetensors file,
+    a step is paged in and moved to device only when it is denoised,only the last step stays on device.
+    """
+
+    def __init__(self, handle, step_keys, device=device, dtype=torch.float16):
+        self.handle = handle  # shared by all layers of the file
+        self.step_keys = step_keys  # step:[keys of every img]
+        self.device = device
+        self.dtype = dtype
+        self.cur_step = None
+        self.cur_tensor = None
+
+    def get(self, step):
+        if step not in self.step_keys:
+            step = get_bank_step(self.step_keys, step)
+        if step != self.cur_step:
+            tensors = [self.handle.get_tensor(key) for key in self.step_keys[step]]
+            tensor = tensors[0] if len(tensors) == 1 else torch.cat(tensors, dim=1)
+            # the mmapped source is pageable,a blocking copy is as fast here
+            self.cur_tensor = tensor.to(self.device, dtype=self.dtype)
+            self.cur_step = step
+        return self.cur_tensor
+
+    def keys(self):
+        return self.step_keys.keys()
+
+    def nbytes(self):
+        return self.cur_tensor.numel() * self.cur_tensor.element_size() if self.cur_tensor is not None else 0
+
+
+def get_id_bank_report(unet):
+    # bytes of the id bank of every character,summed over all consistent attention layers
+    report = {}
+    for attn_processor in unet.attn_processors.values():
+        if isinstance(attn_processor, SpatialAttnProcessor2_0):
+            for character, bank in attn_processor.id_bank.items():
+                report[character] = report.get(character, 0) + bank.nbytes()
+    return report
+
+
 class SpatialAttnProcessor2_0(torch.nn.Module):
     r"""
     Attention processor for IP-Adapater for PyTorch 2.0.
@@ -186,6 +434,7 @@ class SpatialAttnProcessor2_0(torch.nn.Module):
         self.total_length = id_length + 1
         self.id_length = id_length
         self.id_bank = {}
+        self.ctx = StoryAttnContext(id_length, device, dtype)
 
     def __call__(
             self,
@@ -198,53 +447,32 @@ class SpatialAttnProcessor2_0(torch.nn.Module):
         # un_cond_hidden_states, cond_hidden_states = hidden_states.chunk(2)
         # un_cond_hidden_states = self.__call2__(attn, un_cond_hidden_states,encoder_hidden_states,attention_mask,temb)
         # 生成一个0到1之间的随机数
-        global total_count, attn_count, cur_step, indices1024, indices4096
-        global sa32, sa64
-        global write
-        global height_s, width_s
-        global character_dict
-        global  character_index_dict, invert_character_index_dict, cur_character, ref_indexs_dict, ref_totals, cur_character
-        if attn_count == 0 and cur_step == 0:
-            indices1024, indices4096 = cal_attn_indice_xl_effcient_memory(
-                self.total_length,
-                self.id_length,
-                sa32,
-                sa64,
-                height_s,
-                width_s,
-                device=self.device,
-                dtype=self.dtype,
-            )
-        if write:
+        ctx = self.ctx
+        cur_step = ctx.cur_step
+        cur_character = ctx.cur_character
+        if ctx.attn_count == 0 and cur_step == 0:
+            ctx.sample_indices()
+        if ctx.write:
             assert len(cur_character) == 1
-            if hidden_states.shape[1] == (height_s // 32) * (width_s // 32):
-                indices = indices1024
+            if hidden_states.shape[1] == (ctx.height // 32) * (ctx.width // 32):
+                indices = ctx.indices1024
             else:
-                indices = indices4096
+                indices = ctx.indices4096
             # print(f"white:{cur_step}")
             total_batch_size, nums_token, channel = hidden_states.shape
             img_nums = total_batch_size // 2
             hidden_states = hidden_states.reshape(-1, img_nums, nums_token, channel)
             # print(img_nums,len(indices),hidden_states.shape,self.total_length)
-            if cur_character[0] not in self.id_bank:
-                self.id_bank[cur_character[0]] = {}
-            self.id_bank[cur_character[0]][cur_step] = [
-                hidden_states[:, img_ind, indices[img_ind], :]
-                .reshape(2, -1, channel)
-                .clone()
-                for img_ind in range(img_nums)
-            ]
+            bank = self.get_write_bank(cur_character[0], ctx.steps, ctx.plan.max_length(nums_token, img_nums), channel,
+                                       hidden_states.device, hidden_states.dtype, ctx.bank_dtype)
+            bank.set(cur_step, torch.cat(
+                [hidden_states[:, img_ind, indices[img_ind], :] for img_ind in range(img_nums)], dim=1))
             hidden_states = hidden_states.reshape(-1, nums_token, channel)
             # self.id_bank[cur_step] = [hidden_states[:self.id_length].clone(), hidden_states[self.id_length:].clone()]
         else:
             # encoder_hidden_states = torch.cat((self.id_bank[cur_step][0].to(self.device),self.id_bank[cur_step][1].to(self.device)))
             # TODO: ADD Multipersion Control
-            encoder_arr = []
-            for character in cur_character:
-                encoder_arr = encoder_arr + [
-                    tensor.to(self.device)
-                    for tensor in self.id_bank[character][cur_step]
-                ]
+            encoder_arr = [self.id_bank[character].get(cur_step) for character in cur_character]
         # 判断随机数是否大于0.5
         if cur_step < 1:
             hidden_states = self.__call2__(
@@ -258,12 +486,12 @@ class SpatialAttnProcessor2_0(torch.nn.Module):
                 rand_num = 0.1
             # print(f"hidden state shape {hidden_states.shape[1]}")
             if random_number > rand_num:
-                if hidden_states.shape[1] == (height_s // 32) * (width_s // 32):
-                    indices = indices1024
+                if hidden_states.shape[1] == (ctx.height // 32) * (ctx.width // 32):
+                    indices = ctx.indices1024
                 else:
-                    indices = indices4096
+                    indices = ctx.indices4096
                 # print("before attention",hidden_states.shape,attention_mask.shape,encoder_hidden_states.shape if encoder_hidden_states is not None else "None")
-                if write:
+                if ctx.write:
                     total_batch_size, nums_token, channel = hidden_states.shape
                     img_nums = total_batch_size // 2
                     hidden_states = hidden_states.reshape(
@@ -300,18 +528,17 @@ class SpatialAttnProcessor2_0(torch.nn.Module):
                         )
                 else:
                     _, nums_token, channel = hidden_states.shape
-                    # img_nums = total_batch_size // 2
-                    # encoder_hidden_states = encoder_hidden_states.reshape(-1,img_nums,nums_token,channel)
+                    # scene prompts may come as a batch,every item reads the same id_bank
                     hidden_states = hidden_states.reshape(2, -1, nums_token, channel)
-
-                    # encoder_arr = [encoder_hidden_states[:,img_ind,indices[img_ind],:].reshape(2,-1,channel) for img_ind in range(img_nums)]
+                    img_nums = hidden_states.shape[1]
                     encoder_hidden_states_tmp = torch.cat(
-                        encoder_arr + [hidden_states[:, 0, :, :]], dim=1
-                    )
+                        [tensor.unsqueeze(1).expand(-1, img_nums, -1, -1) for tensor in encoder_arr]
+                        + [hidden_states], dim=2
+                    ).reshape(2 * img_nums, -1, channel)
 
-                    hidden_states[:, 0, :, :] = self.__call2__(
+                    hidden_states = self.__call2__(
                         attn,
-                        hidden_states[:, 0, :, :],
+                        hidden_states.reshape(-1, nums_token, channel),
                         encoder_hidden_states_tmp,
                         None,
                         temb,
@@ -321,23 +548,18 @@ class SpatialAttnProcessor2_0(torch.nn.Module):
                 hidden_states = self.__call2__(
                     attn, hidden_states, None, attention_mask, temb
                 )
-        attn_count += 1
-        if attn_count == total_count:
-            attn_count = 0
-            cur_step += 1
-            indices1024, indices4096 = cal_attn_indice_xl_effcient_memory(
-                self.total_length,
-                self.id_length,
-                sa32,
-                sa64,
-                height_s,
-                width_s,
-                device=self.device,
-                dtype=self.dtype,
-            )
+        ctx.step()
 
         return hidden_states
 
+    def get_write_bank(self, character, steps, length, channel, device, dtype, bank_dtype="fp16"):
+        # banks read from the library or a character file (LazyIdBank) are read only,a write pass replaces them
+        bank = self.id_bank.get(character)
+        if not isinstance(bank, IdBank):
+            bank = IdBank(steps, length, channel, device, dtype, bank_dtype)
+            self.id_bank[character] = bank
+        return bank
+
     def __call2__(
             self,
             attn,
@@ -443,7 +665,8 @@ def process_generation(
         lora,
         trigger_words, photomake_mode, use_kolor, use_flux, make_dual_only, kolor_face, pulid, story_maker,
         input_id_emb_s_dict, input_id_img_s_dict, input_id_emb_un_dict, input_id_cloth_dict, guidance, condition_image,
-        empty_emb_zero, use_cf, cf_scheduler, controlnet_path, controlnet_scale, cn_dict,input_tag_dict,SD35_mode,use_wrapper,use_inf=None
+        empty_emb_zero, use_cf, cf_scheduler, controlnet_path, controlnet_scale, cn_dict,input_tag_dict,SD35_mode,use_wrapper,use_inf=None,
+        scene_batch_size=1,sa32_degree=0.5,sa64_degree=0.5,model_key=None
 ):  # Corrected font_choice usage
     
     from .model_loader_utils import extract_content_from_brackets,remove_punctuation_from_strings, setup_seed, apply_style,apply_style_positive,lora_lightning_list
@@ -456,9 +679,8 @@ def process_generation(
         if model_type == "img2img" and "img" not in general_prompt:
             raise 'if using normal SDXL img2img ,need add the triger word " img "  behind the class word you want to customize, such as: man img or woman img'
     
-    global total_length, attn_procs, cur_model_type
-    global write
-    global cur_step, attn_count
+    ctx = new_story_ctx(pipe)
+    ctx.setup(sa32_degree, sa64_degree, height, width, _num_steps, seed_)
     
     # load_chars = load_character_files_on_running(unet, character_files=char_files)
     
@@ -476,10 +698,8 @@ def process_generation(
             prompts = remove_punctuation_from_strings(prompts)
             prompts = [item + add_trigger_words for item in prompts]
     
-    global character_index_dict, invert_character_index_dict, ref_indexs_dict, ref_totals
-    global character_dict
-    
     character_dict, character_list = character_to_dict(general_prompt, lora, add_trigger_words)
+    ctx.character_dict = character_dict
     # print(character_dict)
     start_merge_step = int(float(_style_strength_ratio) / 100 * _num_steps)
     if start_merge_step > 30:
@@ -547,17 +767,54 @@ def process_generation(
     # real_prompts = prompts[id_length:]
     # if device == "cuda":
     #     torch.cuda.empty_cache()
-    write = True
-    cur_step = 0
-    attn_count = 0
     total_results = []
     id_images = []
     results_dict = {}
     p_num = 0
     
-    global cur_character
+    # characters with a matching bank in the library skip the write pass,their id panels come from the library,
+    # banks saved without id images get their id prompts sampled like scene prompts
+    reused_characters = []
+    reused_id_panels = []
+    if model_key and not load_chars and ctx.total_count > 0:
+        images_key = [hashlib.sha1(img.tobytes()).hexdigest() for img in upload_images] if model_type == "img2img" else None
+        for character_key in character_dict.keys():
+            id_prompts = [replace_prompts[ref_ind] for ref_ind in ref_indexs_dict.get(character_key, [])]
+            library_key = get_hash_key(model_key, character_key, character_dict[character_key], id_prompts, style_name,
+                                       negative_prompt, cfg, denoise_or_ip_sacle, _style_strength_ratio, height, width,
+                                       sa32_degree, sa64_degree, _num_steps, seed_, images_key)
+            ctx.library_keys[character_key] = library_key
+            library_path = character_library.get(library_key)
+            if library_path:
+                load_single_character_weights(pipe.unet, library_path)
+                reused_characters.append(character_key)
+                image_paths = character_library.get_images(library_key)
+                ref_indexs = ref_indexs_dict.get(character_key, [])
+                if image_paths and len(image_paths) == len(ref_indexs):
+                    for ind, image_path in zip(ref_indexs, image_paths):
+                        with Image.open(image_path) as img:
+                            results_dict[ind] = img.convert("RGB")
+                    reused_id_panels.append(character_key)
+                else:
+                    logging.info(f"{character_key} was saved without id images,its id prompts are sampled again")
+            elif character_library.find(character_key):
+                logging.info(f"{character_key} is in the character library with other prompts or settings,generate it again")
+    
+    # the exact negative strings the id and scene panels pass,the session encodes them and nothing else
+    _, scene_negative_style = apply_style_positive(style_name, "real_prompt")
+    scene_negative_prompt = str(negative_prompt) + str(scene_negative_style)
+    if use_cf or use_wrapper:
+        # story session: every styled panel prompt is encoded now and the model stays loaded until the sampler ends it,
+        # replace_prompts holds the single character panels only,dual panels are sampled later by another pipe
+        session_prompts, id_negative_prompt = apply_style(style_name, replace_prompts, negative_prompt)
+        writes_ids = not load_chars and len(reused_characters) < len(character_dict)
+        pipe.begin_session(session_prompts,
+                           [id_negative_prompt, scene_negative_prompt] if writes_ids else [scene_negative_prompt])
+    
     if not load_chars:
         for character_key in character_dict.keys():  # 先生成角色对应第一句场景提示词的图片,图生图是批次生成
+            if character_key in reused_characters:
+                continue
             character_key_str = character_key
             cur_character = [character_key]
             ref_indexs = ref_indexs_dict[character_key]
@@ -565,7 +822,7 @@ def process_generation(
             if model_type == "txt2img":
                 setup_seed(seed_)
             generator = torch.Generator(device=device).manual_seed(seed_)
-            cur_step = 0
+            ctx.start(True, cur_character)
             cur_positive_prompts, cur_negative_prompt = apply_style(
                 style_name, current_prompts, negative_prompt
             )
@@ -686,7 +943,7 @@ def process_generation(
                                     generator=generator,
                                     face_crop_image=crop_image,
                                     face_insightface_embeds=face_embeds,
-                                ).images
+                                ).images[0]
                                 id_images.append(id_image)
                         else:
                             id_images = pipe(
@@ -718,41 +975,21 @@ def process_generation(
                     if pulid:
                         id_embeddings = input_id_emb_s_dict[character_key_str][0]
                         uncond_id_embeddings = input_id_emb_un_dict[character_key_str][0]
-                        if id_length > 1:
-                            id_images = []
-                            for index, i in enumerate(cur_positive_prompts):
-                                id_image = pipe.generate_image(
-                                    prompt=i,
-                                    seed=seed_,
-                                    start_step=2,
-                                    num_steps=_num_steps,
-                                    height=height,
-                                    width=width,
-                                    id_embeddings=id_embeddings,
-                                    uncond_id_embeddings=uncond_id_embeddings,
-                                    id_weight=1,
-                                    guidance=guidance,
-                                    true_cfg=1.0,
-                                    max_sequence_length=128,
-                                )
-                                id_images.append(id_image)
-                        
-                        else:
-                            id_images = pipe.generate_image(
-                                prompt=cur_positive_prompts,
-                                seed=seed_,
-                                start_step=2,
-                                num_steps=_num_steps,
-                                height=height,
-                                width=width,
-                                id_embeddings=id_embeddings,
-                                uncond_id_embeddings=uncond_id_embeddings,
-                                id_weight=1,
-                                guidance=guidance,
-                                true_cfg=1.0,
-                                max_sequence_length=128,
-                            )
-                            id_images = [id_images]
+                        id_images = pipe.generate_images(
+                            prompts=cur_positive_prompts if id_length > 1 else cur_positive_prompts[:1],
+                            seed=seed_,
+                            start_step=2,
+                            num_steps=_num_steps,
+                            height=height,
+                            width=width,
+                            id_embeddings=id_embeddings,
+                            uncond_id_embeddings=uncond_id_embeddings,
+                            id_weight=1,
+                            guidance=guidance,
+                            true_cfg=1.0,
+                            max_sequence_length=128,
+                            batch_size=scene_batch_size,
+                        )
                     elif use_cf:
                         cfg = 1.0
                         cur_negative_prompt = [cur_negative_prompt]
@@ -818,7 +1055,7 @@ def process_generation(
                                 height=height, width=width,
                                 generator=generator,
                                 cloth=cloth_info,
-                            ).images
+                            ).images[0]
                             id_images.append(id_image)
                     else:
                         id_images = pipe(
@@ -969,21 +1206,123 @@ def process_generation(
             else:
                 for ind, img in enumerate(id_images):
                     results_dict[ref_indexs[ind]] = img
+            if all(ind in results_dict for ind in ref_indexs):
+                ctx.id_images[character_key] = [results_dict[ind] for ind in ref_indexs]
             # real_images = []
             # print(results_dict)
-            yield [results_dict[ind] for ind in results_dict.keys()]
+            yield results_dict  # finished panels so far,streamed by the sampler
+        if hasattr(pipe, "unet"):
+            for character, nbytes in get_id_bank_report(pipe.unet).items():
+                logging.info(f"id bank of {character}: {nbytes / 1024 ** 2:.1f} MB ({ctx.bank_dtype})")
     
-    write = False
     if not load_chars:
+        resampled = [key for key in reused_characters if key not in reused_id_panels]
+        written_totals = [ind for ind in ref_totals if not any(ind in ref_indexs_dict[key] for key in resampled)]
         real_prompts_inds = [
-            ind for ind in range(len(prompts)) if ind not in ref_totals
+            ind for ind in range(len(prompts)) if ind not in written_totals
         ]
     else:
         real_prompts_inds = [ind for ind in range(len(prompts))]
     print(real_prompts_inds)
-    real_prompt_no, negative_prompt_style = apply_style_positive(style_name, "real_prompt")
-    negative_prompt = str(negative_prompt) + str(negative_prompt_style)
+    negative_prompt = scene_negative_prompt
     # print(f"real_prompts_inds is {real_prompts_inds}")
+    # story-diffusion pipes (sdxl,kolor txt2img,photomaker) can sample scene prompts of the same role in one batch
+    if model_type == "txt2img":
+        batch_able = not (use_flux or use_cf or SD35_mode)
+    else:
+        batch_able = not (use_kolor or use_flux or (story_maker and not make_dual_only) or use_inf or use_cf or SD35_mode)
+    if scene_batch_size > 1 and batch_able:
+        for cur_character, is_nc, batch_inds in group_scene_prompts(real_prompts_inds, prompts, character_dict, nc_indexs,
+                                                                     scene_batch_size):
+            if len(cur_character) > 1 and model_type == "img2img":
+                raise "Temporarily Not Support Multiple character in Ref Image Mode!"
+            if model_type == "txt2img":
+                setup_seed(seed_)
+            # one generator per item,so every panel starts from the same noise as the unbatched loop
+            generator = [torch.Generator(device=device).manual_seed(seed_) for _ in batch_inds]
+            ctx.start(False, cur_character)
+            batch_prompts = [apply_style_positive(style_name, replace_prompts[ind])[0] for ind in batch_inds]
+            print(f"Sample real_prompt batch : {batch_prompts}")
+            if model_type == "txt2img":
+                batch_images = pipe(
+                    batch_prompts,
+                    num_inference_steps=_num_steps,
+                    guidance_scale=cfg,
+                    height=height,
+                    width=width,
+                    negative_prompt=[negative_prompt] * len(batch_prompts),
+                    generator=generator,
+                    output_type="pt",
+                ).images
+            else:
+                input_id_images = input_id_images_dict[cur_character[0]] if not is_nc else input_id_images_dict[character_list[0]]
+                if photomake_mode == "v2":
+                    id_embeds = input_id_emb_s_dict[cur_character[0]][0] if not is_nc else empty_emb_zero
+                    batch_images = pipe(
+                        batch_prompts,
+                        input_id_images=input_id_images,
+                        num_inference_steps=_num_steps,
+                        guidance_scale=cfg,
+                        start_merge_step=start_merge_step,
+                        height=height,
+                        width=width,
+                        negative_prompt=negative_prompt,
+                        generator=generator,
+                        id_embeds=id_embeds,
+                        nc_flag=is_nc,
+                        output_type="pt",
+                    ).images
+                else:
+                    batch_images = pipe(
+                        batch_prompts,
+                        input_id_images=input_id_images,
+                        num_inference_steps=_num_steps,
+                        guidance_scale=cfg,
+                        start_merge_step=start_merge_step,
+                        height=height,
+                        width=width,
+                        negative_prompt=negative_prompt,
+                        generator=generator,
+                        nc_flag=is_nc,
+                        output_type="pt",
+                    ).images
+            for ind, img in zip(batch_inds, batch_images):
+                results_dict[ind] = img
+            yield results_dict  # finished panels so far,streamed by the sampler
+        real_prompts_inds = []
+    if model_type == "img2img" and use_flux and pulid and not use_inf and real_prompts_inds:
+        # every pulid panel in one iter_generate_images call,so the flow model stays on the gpu for the whole story,
+        # the panels of a mini batch are streamed as soon as it is decoded
+        panel_prompts, panel_ids, panel_uncond_ids = [], [], []
+        for real_prompts_ind in real_prompts_inds:
+            cur_character = get_ref_character(prompts[real_prompts_ind], character_dict)
+            if len(cur_character) > 1:
+                raise "Temporarily Not Support Multiple character in Ref Image Mode!"
+            is_nc = real_prompts_ind in nc_indexs
+            panel_prompts.append(apply_style_positive(style_name, replace_prompts[real_prompts_ind])[0])
+            panel_ids.append(input_id_emb_s_dict[cur_character[0]][0] if not is_nc else empty_emb_zero)
+            panel_uncond_ids.append(input_id_emb_un_dict[cur_character[0]][0] if not is_nc else empty_emb_zero)
+        print(f"Sample real_prompt batch : {panel_prompts}")
+        panel_batches = pipe.iter_generate_images(
+            prompts=panel_prompts,
+            seed=seed_,
+            start_step=2,
+            num_steps=_num_steps,
+            height=height,
+            width=width,
+            id_embeddings=panel_ids,
+            uncond_id_embeddings=panel_uncond_ids,
+            id_weight=1,
+            guidance=guidance,
+            true_cfg=1.0,
+            max_sequence_length=128,
+            batch_size=scene_batch_size,
+        )
+        for inds, panel_images in panel_batches:
+            for j, img in zip(inds, panel_images):
+                results_dict[real_prompts_inds[j]] = img
+            yield results_dict  # finished panels so far,streamed by the sampler
+        real_prompts_inds = []
     for real_prompts_ind in real_prompts_inds:  #
         real_prompt = replace_prompts[real_prompts_ind]
         cur_character = get_ref_character(prompts[real_prompts_ind], character_dict)
@@ -994,7 +1333,7 @@ def process_generation(
         
         if len(cur_character) > 1 and model_type == "img2img":
             raise "Temporarily Not Support Multiple character in Ref Image Mode!"
-        cur_step = 0
+        ctx.start(False, cur_character)
         real_prompt, negative_prompt_style_no = apply_style_positive(style_name, real_prompt)
         print(f"Sample real_prompt : {real_prompt}")
         if model_type == "txt2img":
@@ -1074,6 +1413,7 @@ def process_generation(
                         width=width,
                         negative_prompt=negative_prompt,
                         generator=generator,
+                        output_type="pt",
                     ).images[0]
         
         elif model_type == "img2img":
@@ -1116,26 +1456,8 @@ def process_generation(
                         nc_flag=True if real_prompts_ind in nc_indexs else False,  # nc_flag，用索引标记，主要控制非角色人物的生成，默认false
                     ).images[0]
             elif use_flux and not use_inf:
-                if pulid:
-                    id_embeddings = input_id_emb_s_dict[cur_character[0]][
-                        0] if real_prompts_ind not in nc_indexs else empty_emb_zero
-                    uncond_id_embeddings = input_id_emb_un_dict[cur_character[0]][
-                        0] if real_prompts_ind not in nc_indexs else empty_emb_zero
-                    results_dict[real_prompts_ind] = pipe.generate_image(
-                        prompt=real_prompt,
-                        seed=seed_,
-                        start_step=2,
-                        num_steps=_num_steps,
-                        height=height,
-                        width=width,
-                        id_embeddings=id_embeddings,
-                        uncond_id_embeddings=uncond_id_embeddings,
-                        id_weight=1,
-                        guidance=guidance,
-                        true_cfg=1.0,
-                        max_sequence_length=128,
-                    )
-                elif use_cf:
+                # pulid panels were all sampled in one generate_images call above
+                if use_cf:
                     cfg = 1.0
                     results_dict[real_prompts_ind] = pipe.generate_image(
                         width=width,
@@ -1289,6 +1611,7 @@ def process_generation(
                             generator=generator,
                             id_embeds=id_embeds,
                             nc_flag=True if real_prompts_ind in nc_indexs else False,
+                            output_type="pt",
                         ).images[0]
                     else:
                         # print(real_prompts_ind, real_prompt, "v1 mode", )
@@ -1308,6 +1631,7 @@ def process_generation(
                             generator=generator,
                             nc_flag=True if real_prompts_ind in nc_indexs else False,
                             # nc_flag，用索引标记，主要控制非角色人物的生成，默认false
+                            output_type="pt",
                         ).images[0]
         
         else:
@@ -1315,12 +1639,25 @@ def process_generation(
                 "You should choice between original and Photomaker!",
                 f"But you choice {model_type}",
             )
-        yield [results_dict[ind] for ind in results_dict.keys()]
+        yield results_dict  # finished panels so far,streamed by the sampler
     total_results = [results_dict[ind] for ind in range(len(prompts))]
     torch.cuda.empty_cache()
     yield total_results
 
 
+def group_scene_prompts(real_prompts_inds, prompts, character_dict, nc_indexs, batch_size):
+    # [(role list, is NC, [prompt index...]),...],prompts in a group share the id_bank read and input images
+    groups = {}
+    for ind in real_prompts_inds:
+        key = (tuple(get_ref_character(prompts[ind], character_dict)), ind in nc_indexs)
+        groups.setdefault(key, []).append(ind)
+    batches = []
+    for (characters, is_nc), inds in groups.items():
+        for i in range(0, len(inds), batch_size):
+            batches.append((list(characters), is_nc, inds[i:i + batch_size]))
+    return batches
+
+
 class Storydiffusion_Model_Loader:
     def __init__(self):
         pass
@@ -1358,6 +1695,7 @@ class Storydiffusion_Model_Loader:
                          "clip":("CLIP",),
                          "vae":("VAE",),
         },
+            "hidden": {"unique_id": "UNIQUE_ID"},
         }
 
     RETURN_TYPES = ("STORY_DICT", )
@@ -1371,6 +1709,7 @@ class Storydiffusion_Model_Loader:
         from transformers import CLIPVisionModelWithProjection
         from transformers import CLIPImageProcessor
         from .utils.load_models_utils import load_models
+        from .utils.cache_utils import pipe_cache, ms_cache, get_file_stamp, get_obj_key, enable_prompt_cache, prefetch_files
         from .model_loader_utils import story_maker_loader,kolor_loader,get_scheduler,SD35Wrapper, nomarl_upscale,lora_lightning_list,pre_checkpoint,get_easy_function,sd35_loader
         import transformers
         try:
@@ -1413,7 +1752,7 @@ class Storydiffusion_Model_Loader:
         # load model
         (auraface, NF4, save_model, kolor_face,flux_pulid_name,pulid,quantized_mode,story_maker,make_dual_only,
          clip_vision_path,char_files,ckpt_path,lora,lora_path,use_kolor,photomake_mode,use_flux,onnx_provider,
-         low_vram,TAG_mode,SD35_mode,consistory,cached,inject,use_quantize,use_inf)=get_easy_function(
+         low_vram,TAG_mode,SD35_mode,consistory,cached,inject,use_quantize,use_inf,reload_pipe,bank_dtype)=get_easy_function(
             easy_function,clip_vision,character_weights,ckpt_name,lora,repo_id,photomake_mode)
         
         if use_inf and not isinstance(cf_model,dict):
@@ -1434,27 +1773,39 @@ class Storydiffusion_Model_Loader:
             aggressive_offload = True
             offload = True
         logging.info(f"total_vram is {total_vram},aggressive_offload is {aggressive_offload},offload is {offload}")
-        # global
-        global  attn_procs
-        global sa32, sa64, write, height_s, width_s
-        global attn_count, total_count, id_length, total_length, cur_step
-
-        sa32 = sa32_degree
-        sa64 = sa64_degree
-        attn_count = 0
-        total_count = 0
-        cur_step = 0
         id_length = id_number
-        total_length = 5
-        attn_procs = {}
-        write = False
-        height_s = height
-        width_s = width
         use_cf=False
         use_storydif=False
         use_wrapper = False
         image_proj_model=None
-        if not repo_id and not ckpt_path and not cf_model:
+        # same loader node and ckpt/lora/vae/mode as a previous run,reuse the loaded pipe instead of rebuilding it,
+        # two loader nodes never share a pipe,so one can not reset the id banks of the other
+        pipe_key = (kwargs.get("unique_id"), model_type, repo_id, get_file_stamp(ckpt_path), get_file_stamp(lora_path), lora_scale, trigger_words,
+                    photomake_mode, vae_id, controlnet_path, clip_vision_path, get_obj_key(cf_model), get_obj_key(clip),
+                    get_obj_key(front_vae), auraface, NF4, save_model, kolor_face, flux_pulid_name, pulid, quantized_mode,
+                    story_maker, make_dual_only, use_kolor, use_flux, onnx_provider, low_vram, SD35_mode, consistory,
+                    use_quantize, use_inf, cached, inject)  # the consistory sampler offloads or casts the pipe by cached/inject
+        # stable identity of the weights for the character library,unlike pipe_key it never holds id() of live objects
+        model_key = get_hash_key(model_type, repo_id, get_file_stamp(ckpt_path), get_file_stamp(lora_path), lora_scale,
+                                 trigger_words, photomake_mode, vae_id, sampeler_name, scheduler, use_kolor, story_maker,
+                                 kolor_face, use_inf)
+        if reload_pipe:
+            pipe_cache.clear()
+            ms_cache.clear()
+        cached_pipe = pipe_cache.get(pipe_key)
+        if cached_pipe is None:
+            pipe_cache.reserve()  # release the old pipe before the new one is built
+            # warm the page cache of every weight file while the base pipeline is being built
+            prefetch_files([ckpt_path, lora_path, photomaker_path, face_ckpt, pulid_ckpt, face_adapter, kolor_ip_path,
+                            controlnet_path, clip_vision_path,
+                            folder_paths.get_full_path("vae", vae_id) if vae_id != "none" else None])
+        if cached_pipe is not None:
+            logging.info("reuse cached pipeline,skip loading models...")
+            pipe = cached_pipe["pipe"]
+            use_cf, use_flux, pulid = cached_pipe["use_cf"], cached_pipe["use_flux"], cached_pipe["pulid"]
+            use_storydif, use_wrapper = cached_pipe["use_storydif"], cached_pipe["use_wrapper"]
+            image_proj_model = cached_pipe["image_proj_model"]
+        elif not repo_id and not ckpt_path and not cf_model:
             raise "you need choice a model or repo_id or link a comfyUI model..."
         elif not repo_id and not ckpt_path and cf_model:
             from comfy.utils import load_torch_file as load_torch_file_
@@ -1776,22 +2127,33 @@ class Storydiffusion_Model_Loader:
                                        trigger_words=trigger_words, lora_scale=lora_scale)
                     set_attention_processor(pipe.unet, id_length, is_ipadapter=False)
                     
-        if vae_id != "none":
+        if vae_id != "none" and cached_pipe is None:
             vae_id = folder_paths.get_full_path("vae", vae_id)
             vae_config = os.path.join(dir_path, "local_repo", "vae")
             if use_storydif:
                 pipe.vae=AutoencoderKL.from_single_file(vae_id, config=vae_config,torch_dtype=torch.float16)
             elif consistory:
                 pipe.vae = AutoencoderKL.from_single_file(vae_id, config=vae_config,torch_dtype=torch.float16)
+        enable_prompt_cache(pipe)
+        if cached_pipe is None:
+            pipe_cache.put(pipe_key, {"pipe": pipe, "use_cf": use_cf, "use_flux": use_flux, "pulid": pulid,
+                                      "use_storydif": use_storydif, "use_wrapper": use_wrapper,
+                                      "image_proj_model": image_proj_model})
         load_chars = False
         if use_storydif:
-            pipe.scheduler = scheduler_choice.from_config(pipe.scheduler.config)
-            load_chars = load_character_files_on_running(pipe.unet, character_files=char_files)
-            pipe.enable_freeu(s1=0.6, s2=0.4, b1=1.1, b2=1.2)
-            pipe.enable_vae_slicing()
-            if device != "mps":
-                if low_vram:
-                    pipe.enable_model_cpu_offload()
+            # a sampler may still be running on the cached unet,the story state is only swapped between runs
+            with story_run_lock(pipe):
+                if cached_pipe is not None:
+                    # fresh story processors (empty id_bank) like a newly built pipe,whatever the last run installed
+                    set_attention_processor(pipe.unet, id_length, is_ipadapter=False)
+                pipe.scheduler = scheduler_choice.from_config(pipe.scheduler.config)
+                get_story_ctx(pipe).bank_dtype = bank_dtype
+                load_chars = load_character_files_on_running(pipe.unet, character_files=char_files)
+                pipe.enable_freeu(s1=0.6, s2=0.4, b1=1.1, b2=1.2)
+                pipe.enable_vae_slicing()
+                if device != "mps":
+                    if low_vram:
+                        pipe.enable_model_cpu_offload()
         
         torch.cuda.empty_cache()
         # need get emb
@@ -1808,10 +2170,11 @@ class Storydiffusion_Model_Loader:
                 image_load = [nomarl_upscale(img, width, height) for img in img_list]
                 
             from .model_loader_utils import insight_face_loader,get_insight_dict
-            app_face,pipeline_mask,app_face_=insight_face_loader(photomake_mode, auraface, kolor_face, story_maker, make_dual_only,use_storydif,use_inf)
-            input_id_emb_s_dict, input_id_img_s_dict, input_id_emb_un_dict, input_id_cloth_dict=get_insight_dict(app_face,pipeline_mask,app_face_,image_load,photomake_mode,
+            # face models are only loaded if a reference image is not in the face cache
+            face_loader = lambda: insight_face_loader(photomake_mode, auraface, kolor_face, story_maker, make_dual_only,use_storydif,use_inf)
+            input_id_emb_s_dict, input_id_img_s_dict, input_id_emb_un_dict, input_id_cloth_dict=get_insight_dict(face_loader,image_load,photomake_mode,
                                                                                                                  kolor_face,story_maker,make_dual_only,
-                     pulid,pipe,character_list_,condition_image,width, height,use_storydif,use_inf,image_proj_model)
+                     pulid,pipe,character_list_,condition_image,width, height,use_storydif,use_inf,image_proj_model,auraface)
         else:
             input_id_emb_s_dict = {}
             input_id_img_s_dict = {}
@@ -1843,7 +2206,8 @@ class Storydiffusion_Model_Loader:
                "make_dual_only":make_dual_only,"face_adapter":face_adapter,"clip_vision_path":clip_vision_path,"consistory":consistory,"cached":cached,"inject":inject,
                "controlnet_path":controlnet_path,"character_prompt":character_prompt,"image":image,"condition_image":condition_image,"use_inf": use_inf,
                "input_id_emb_s_dict":input_id_emb_s_dict,"input_id_img_s_dict":input_id_img_s_dict,"use_cf":use_cf,"SD35_mode":SD35_mode,"use_wrapper":use_wrapper,
-               "input_id_emb_un_dict":input_id_emb_un_dict,"input_id_cloth_dict":input_id_cloth_dict,"role_name_list":role_name_list,"use_storydif":use_storydif,"low_vram":low_vram,"input_tag_dict":input_tag_dict}
+               "input_id_emb_un_dict":input_id_emb_un_dict,"input_id_cloth_dict":input_id_cloth_dict,"role_name_list":role_name_list,"use_storydif":use_storydif,"low_vram":low_vram,"input_tag_dict":input_tag_dict,
+               "id_length":id_length,"sa32_degree":sa32_degree,"sa64_degree":sa64_degree,"model_key":model_key}
         return (model,)
 
 
@@ -1883,6 +2247,8 @@ class Storydiffusion_Sampler:
                 "controlnet_scale": (
                     "FLOAT", {"default": 0.8, "min": 0.0, "max": 1.0, "step": 0.1, "round": 0.01}),
                 "guidance_list": ("STRING", {"multiline": True, "default": "0., 0.25, 0.4, 0.75;0.6, 0.25, 1., 0.75"}),
+                "scene_batch_size": ("INT", {"default": 1, "min": 1, "max": 16}),
+                "save_panels": ("BOOLEAN", {"default": False},),
             },
             "optional": {"control_image": ("IMAGE",),
                          },
@@ -1896,10 +2262,10 @@ class Storydiffusion_Sampler:
 
     def story_sampler(self, model,scene_prompts, negative_prompt, img_style, seed, steps,
                   cfg, denoise_or_ip_sacle, style_strength_ratio,
-                  guidance, mask_threshold, start_step,save_character,controlnet_scale,guidance_list,**kwargs):
+                  guidance, mask_threshold, start_step,save_character,controlnet_scale,guidance_list,scene_batch_size=1,save_panels=False,**kwargs):
         # get value from dict
         from diffusers import UniPCMultistepScheduler
-        from .model_loader_utils import story_maker_loader, extract_content_from_brackets,narry_list,remove_punctuation_from_strings,phi_list,center_crop_s,center_crop, setup_seed, apply_style,get_scheduler,load_images_list, nomarl_upscale,lora_lightning_list
+        from .model_loader_utils import story_maker_loader, extract_content_from_brackets,narry_list,remove_punctuation_from_strings,center_crop_s,center_crop, setup_seed, apply_style,get_scheduler,load_images_list, nomarl_upscale,lora_lightning_list,PanelStreamer,to_pil
         pipe=model.get("pipe")
         use_flux=model.get("use_flux")
         photomake_mode=model.get("photomake_mode")
@@ -1944,6 +2310,9 @@ class Storydiffusion_Sampler:
         consistory=model.get("consistory")
         cached=model.get("cached")
         inject=model.get("inject")
+        id_length=model.get("id_length")
+        sa32_degree=model.get("sa32_degree")
+        sa64_degree=model.get("sa64_degree")
         if use_storydif:
             pipe.to(device)
 
@@ -2021,7 +2390,8 @@ class Storydiffusion_Sampler:
                                      trigger_words,photomake_mode,use_kolor,use_flux,make_dual_only,
                                      kolor_face,pulid,story_maker,input_id_emb_s_dict, input_id_img_s_dict,input_id_emb_un_dict,
                                      input_id_cloth_dict,guidance,condition_image,empty_emb_zero,use_cf,cf_scheduler,controlnet_path,
-                                     controlnet_scale,cn_dict,input_tag_dict,SD35_mode,use_wrapper,use_inf)
+                                     controlnet_scale,cn_dict,input_tag_dict,SD35_mode,use_wrapper,use_inf,scene_batch_size,
+                                     sa32_degree,sa64_degree,model.get("model_key"))
 
         else:
             if story_maker:
@@ -2033,6 +2403,7 @@ class Storydiffusion_Sampler:
                 if id_length>1:
                     raise "consistory support 1 role now "
                 from .consistory.consistory_run import run_batch_generation,run_anchor_generation, run_extra_generation
+                from .consistory.consistory_utils import save_anchor_caches, load_anchor_caches
                 mask_dropout = 0.5
                 same_latent = False
                 n_achors = 2
@@ -2115,19 +2486,36 @@ class Storydiffusion_Sampler:
                     anchor_out_images = run_batch_generation(pipe, replace_prompts, concept_token,negative_prompt, seed,n_steps=steps,
                                                          mask_dropout=mask_dropout, same_latent=same_latent, perform_injection=inject,n_achors=n_achors)
                 else:
-                    if len(replace_prompts)>2:
-                        spilit_prompt=replace_prompts[:2]
-                    else:
-                        spilit_prompt=replace_prompts
-                        
-                    anchor_out_images, anchor_cache_first_stage, anchor_cache_second_stage = run_anchor_generation(
-                        pipe, spilit_prompt, concept_token,negative_prompt,
-                        seed=seed, n_steps=steps, mask_dropout=mask_dropout, same_latent=same_latent,perform_injection=inject,
-                        cache_cpu_offloading=True)
-                    if len(replace_prompts) > 2:
-                        left_prompt=replace_prompts[2:]
+                    # anchors of this character/seed/model saved by an earlier run,only the extra scenes are generated
+                    anchor_path = None
+                    if ANCHOR_CACHE:
+                        anchor_key = get_hash_key(model.get("model_key"), concept_token, seed, steps, inject, mask_dropout,
+                                                  negative_prompt, same_latent, n_achors)
+                        anchor_path = os.path.join(photomaker_dir, "anchor_cache", f"anchors_{anchor_key}.safetensors")
+                    if anchor_path and os.path.isfile(anchor_path):
+                        logging.info(f"reuse consistory anchors of {concept_token} from {anchor_path}")
+                        anchor_cache_first_stage, anchor_cache_second_stage = load_anchor_caches(anchor_path)
+                        anchor_out_images = []
+                        left_prompt = replace_prompts
                     else:
-                        left_prompt=replace_prompts[:1]  # use default
+                        if len(replace_prompts)>2:
+                            spilit_prompt=replace_prompts[:2]
+                        else:
+                            spilit_prompt=replace_prompts
+                            
+                        anchor_out_images, anchor_cache_first_stage, anchor_cache_second_stage = run_anchor_generation(
+                            pipe, spilit_prompt, concept_token,negative_prompt,
+                            seed=seed, n_steps=steps, mask_dropout=mask_dropout, same_latent=same_latent,perform_injection=inject,
+                            cache_cpu_offloading=True)
+                        if anchor_path:
+                            save_anchor_caches(anchor_path, [anchor_cache_first_stage, anchor_cache_second_stage],
+                                               concept_token=concept_token, seed=seed, steps=steps, inject=inject,
+                                               same_latent=same_latent, n_achors=n_achors)
+                            logging.info(f"saved consistory anchors of {concept_token} to {anchor_path}")
+                        if len(replace_prompts) > 2:
+                            left_prompt=replace_prompts[2:]
+                        else:
+                            left_prompt=replace_prompts[:1]  # use default
                     
                     for extra_prompt in left_prompt:
                         extra_image = run_extra_generation(pipe, [extra_prompt],
@@ -2161,16 +2549,31 @@ class Storydiffusion_Sampler:
                                          pulid, story_maker, input_id_emb_s_dict, input_id_img_s_dict,
                                          input_id_emb_un_dict, input_id_cloth_dict, guidance, condition_image,
                                          empty_emb_zero, use_cf, cf_scheduler, controlnet_path, controlnet_scale,
-                                         cn_dict, input_tag_dict, SD35_mode, use_wrapper)
+                                         cn_dict, input_tag_dict, SD35_mode, use_wrapper, scene_batch_size=scene_batch_size,
+                                         sa32_degree=sa32_degree, sa64_degree=sa64_degree, model_key=model.get("model_key"))
         
-        for value in gen:
-            print(type(value))
-        image_pil_list = phi_list(value)
-
-        image_pil_list_ms = image_pil_list.copy()
-        if save_character:
-            print("saving character...")
-            save_results(pipe.unet)
+        # panels are converted and previewed as soon as they are finished,dual panels fill their positions later
+        positions_single = [index for index in range(len(prompts_origin)) if index not in positions_dual]
+        save_dir = None
+        if save_panels:
+            timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+            save_dir = os.path.join(folder_paths.get_output_directory(), "StoryDiffusion", timestamp)
+        streamer = PanelStreamer(len(prompts_origin), height, width, save_dir)
+        with story_run_lock(pipe):
+            try:
+                for value in gen:
+                    if isinstance(value, dict):
+                        streamer.stream(value, positions_single)
+            finally:
+                if use_cf or use_wrapper:
+                    pipe.end_session()
+            image_pil_list = value
+            streamer.stream(dict(enumerate(image_pil_list)), positions_single)
+
+            image_pil_list_ms = image_pil_list.copy()
+            if save_character:
+                print("saving character...")
+                save_results(pipe.unet)
         if prompts_dual:
             if not clip_vision_path:
                 raise "need a clip_vison weight."
@@ -2180,11 +2583,12 @@ class Storydiffusion_Sampler:
                 image_a = image_load[0]
                 image_b = image_load[1]
             else:
-                image_a = image_pil_list_ms[positions_char_1]
-                image_b = image_pil_list_ms[positions_char_2]
+                image_a = to_pil(image_pil_list_ms[positions_char_1])
+                image_b = to_pil(image_pil_list_ms[positions_char_2])
             if story_maker:
                 print("start sampler dual prompt using story maker")
                 if make_dual_only:
+                    pipe_cache.discard(pipe)  # the cache would keep the story pipe alive next to story maker
                     del pipe
                     gc.collect()
                     torch.cuda.empty_cache()
@@ -2259,25 +2663,24 @@ class Storydiffusion_Sampler:
                 #gc.collect()
                 #torch.cuda.empty_cache()
                 from .model_loader_utils import msdiffusion_main
-                image_dual = msdiffusion_main(image_a, image_b, prompts_dual, new_width, new_height, steps, seed,
-                                              img_style, char_describe, char_origin, negative_prompt, clip_vision_path,
-                                              model_type, lora, lora_path, lora_scale,
-                                              trigger_words, ckpt_path, repo_id, guidance,
-                                              mask_threshold, start_step, controlnet_path, control_image,
-                                              controlnet_scale, cfg, guidance_list, scheduler_choice,pipe)
+                # txt2img swaps the processors of the story unet while sampling
+                with story_run_lock(pipe):
+                    image_dual = msdiffusion_main(image_a, image_b, prompts_dual, new_width, new_height, steps, seed,
+                                                  img_style, char_describe, char_origin, negative_prompt,
+                                                  clip_vision_path, model_type, lora, lora_path, lora_scale,
+                                                  trigger_words, ckpt_path, repo_id, guidance,
+                                                  mask_threshold, start_step, controlnet_path, control_image,
+                                                  controlnet_scale, cfg, guidance_list, scheduler_choice,pipe)
             j = 0
             for i in positions_dual:  # 重新将双人场景插入原序列
                 if width != height:
                     img = center_crop_s(image_dual[j], width, height)
                 else:
                     img = image_dual[j]
-                image_pil_list.insert(int(i), img)
+                streamer.put(int(i), img)
                 j += 1
-            image_list = narry_list(image_pil_list)
             torch.cuda.empty_cache()
-        else:
-            image_list = narry_list(image_pil_list)
-        image = torch.from_numpy(np.fromiter(image_list, np.dtype((np.float32, (height, width, 3)))))
+        image = streamer.images
         if use_storydif and not prompts_dual:
             try:
                pipe.to("cpu")
@@ -2285,6 +2688,7 @@ class Storydiffusion_Sampler:
                 pass
         gc.collect()
         torch.cuda.empty_cache()
+        logging.info(f"prompt embedding cache: {prompt_cache.stats()}")
         return (image, scene_prompts,)
     
 class Comic_Type:
@@ -20,10 +20,28 @@
 from diffusers.utils import USE_PEFT_BACKEND
 from typing import Callable, Optional
 import torch
+import torch.nn.functional as F
 from diffusers.models.attention_processor import Attention
-from xformers.ops import memory_efficient_attention
+from diffusers.utils.import_utils import is_xformers_available
 from .consistory_utils import AnchorCache, FeatureInjector, QueryStore
 
+if is_xformers_available():
+    from xformers.ops import memory_efficient_attention
+    from xformers.ops.fmha.attn_bias import BlockDiagonalMask
+else:
+    memory_efficient_attention = None
+
+
+def use_xformers(query):
+    return memory_efficient_attention is not None and query.is_cuda
+
+
+def attention(query, key, value, scale, op=None):
+    # [batch*heads, tokens, head_dim] inputs,xformers on cuda,torch sdpa on cpu and non-xformers installs
+    if use_xformers(query):
+        return memory_efficient_attention(query, key, value, op=op, scale=scale)
+    return F.scaled_dot_product_attention(query, key, value, scale=scale)
+
 
 class ConsistoryAttnStoreProcessor:
     def __init__(self, attnstore, place_in_unet):
@@ -85,6 +103,40 @@ class ConsistoryExtendedAttnXFormersAttnProcessor:
         self.curr_unet_part = self.place_in_unet.split('_')[0]
         self.attnstore = attnstore
 
+    def extended_attention(self, attn, query, key, value, indices, batch_size):
+        """
+        Extended self attention of the whole batch in one call: every image attends to its own patches and the
+        masked patches of the images it is mapped to, within its own (uncond or cond) half of the batch.
+        query is [batch*heads, patches, head_dim], key and value are [batch, patches, inner_dim].
+        """
+        heads = attn.heads
+        n_patches, head_dim = query.shape[1:]
+
+        # both halves share the indices,their patches are flattened to [2, images*patches, inner_dim]
+        key = key.reshape(2, -1, key.shape[-1])
+        value = value.reshape(2, -1, value.shape[-1])
+
+        if use_xformers(query):
+            # packed keys/values of all images with a block diagonal bias,no padding
+            query = query.view(batch_size, heads, n_patches, head_dim).transpose(1, 2).reshape(1, -1, heads, head_dim)
+            packed_key = key[:, indices['kv_index']].reshape(1, -1, heads, head_dim)
+            packed_value = value[:, indices['kv_index']].reshape(1, -1, heads, head_dim)
+            attn_bias = BlockDiagonalMask.from_seqlens([n_patches] * batch_size, indices['kv_seqlens'] * 2)
+
+            hidden_states = memory_efficient_attention(
+                query, packed_key, packed_value, attn_bias=attn_bias, op=self.attention_op, scale=attn.scale
+            )
+            return hidden_states.view(batch_size, n_patches, heads, head_dim).transpose(1, 2).reshape(-1, n_patches, head_dim)
+
+        # keys/values padded to the longest image,the padding is masked out
+        query = query.view(batch_size, heads, n_patches, head_dim)
+        padded_key = key[:, indices['padded_index']].view(batch_size, -1, heads, head_dim).transpose(1, 2)
+        padded_value = value[:, indices['padded_index']].view(batch_size, -1, heads, head_dim).transpose(1, 2)
+        attn_mask = indices['padded_mask'].repeat(2, 1)[:, None, None]
+
+        hidden_states = F.scaled_dot_product_attention(query, padded_key, padded_value, attn_mask=attn_mask, scale=attn.scale)
+        return hidden_states.reshape(-1, n_patches, head_dim)
+
     def __call__(
         self,
         attn: Attention,
@@ -179,57 +231,15 @@ class ConsistoryExtendedAttnXFormersAttnProcessor:
                 extended_value = attn.head_to_batch_dim(extended_value).contiguous()
 
                 # attn_masks needs to be of shape [batch_size, query_tokens, key_tokens]
-                hidden_states = memory_efficient_attention(
-                    query, extended_key, extended_value,  op=self.attention_op, scale=attn.scale
-                )
+                hidden_states = attention(query, extended_key, extended_value, attn.scale, op=self.attention_op)
             else:
-                # # We make extended key and value by concatenating the original key and value with the query.
-                # attention_mask_bias = self.attnstore.get_attn_mask_bias(tgt_size = width, bsz = batch_size)
-
-                # if attention_mask_bias is not None:
-                #     attention_mask_bias = torch.cat([x.unsqueeze(0).expand(attn.heads, -1, -1) for x in attention_mask_bias])
-
-                # Pre-allocate the output tensor
-                ex_out = torch.empty_like(query)
-
-                for i in range(batch_size):
-                    start_idx = i * attn.heads
-                    end_idx = start_idx + attn.heads
-
-                    attention_mask = self.attnstore.get_extended_attn_mask_instance(width, i%(batch_size//2))
-
-                    curr_q = query[start_idx:end_idx]
-
-                    if i < batch_size//2:
-                        curr_k = key[:batch_size//2]
-                        curr_v = value[:batch_size//2]
-                    else:
-                        curr_k = key[batch_size//2:]
-                        curr_v = value[batch_size//2:]
-
-                    curr_k = curr_k.flatten(0,1)[attention_mask].unsqueeze(0)
-                    curr_v = curr_v.flatten(0,1)[attention_mask].unsqueeze(0)
-
-                    curr_k = attn.head_to_batch_dim(curr_k).contiguous()
-                    curr_v = attn.head_to_batch_dim(curr_v).contiguous()
-
-                    hidden_states = memory_efficient_attention(
-                        curr_q, curr_k, curr_v, 
-                        op=self.attention_op, scale=attn.scale
-                    )
-
-                    ex_out[start_idx:end_idx] = hidden_states
-
-                hidden_states = ex_out
+                indices = self.attnstore.get_extended_attn_indices(width)
+                hidden_states = self.extended_attention(attn, query, key, value, indices, batch_size)
         else:
             key = attn.head_to_batch_dim(key).contiguous()
             value = attn.head_to_batch_dim(value).contiguous()
 
-            # attn_masks needs to be of shape [batch_size, query_tokens, key_tokens]
-            
-            hidden_states = memory_efficient_attention(
-                query, key, value, op=self.attention_op, scale=attn.scale
-            )
+            hidden_states = attention(query, key, value, attn.scale, op=self.attention_op)
  
             
             
@@ -3,9 +3,13 @@
 # This work is licensed under the LICENSE file
 # located at the root directory.
 
+import json
+import os
 import numpy as np
 import torch
 from collections import defaultdict
+from safetensors import safe_open
+from safetensors.torch import save_file
 from diffusers.utils.import_utils import is_xformers_available
 from typing import Optional, List
 
@@ -28,44 +32,63 @@ class FeatureInjector:
         self.dist_thr = dist_thr
         self.inject_unet_parts = inject_unet_parts
         self.inject_res = [64]
+        self.injection_cache = {} # (output_res, from anchors): (extended_mapping, gather indices and blend mask)
 
-    def inject_outputs(self, output, curr_iter, output_res, extended_mapping, place_in_unet, anchors_cache=None):
-        curr_unet_part = place_in_unet.split('_')[0]
+    def get_injection_indices(self, output_res, extended_mapping=None):
+        # nn_map is fixed for a run,so the chosen neighbours and the blend masks are computed once per resolution
+        # and reused by every injected layer and step,extended_mapping is None when injecting from the anchors
+        key = (output_res, extended_mapping is None)
+        cached = self.injection_cache.get(key)
+        if cached is not None and cached[0] is extended_mapping:
+            return cached[1]
 
-        # Inject only in the specified unet parts (up, mid, down)
-        if (curr_unet_part not in self.inject_unet_parts) or output_res not in self.inject_res:
-            return output
-
-        bsz = output.shape[0]
         nn_map = self.nn_map[output_res]
         nn_distances = self.nn_distances[output_res]
         attn_masks = self.attn_masks[output_res]
-        vector_dim = output_res**2
+        bsz = nn_distances.shape[0]
 
-        alpha = next((alpha for min_range, max_range, alpha in self.inject_range_alpha if min_range <= curr_iter <= max_range), None)
-        if alpha:
-            old_output = output#.clone()
-            for i in range(bsz):
-                other_outputs = []
+        if extended_mapping is None:
+            has_other = torch.ones(bsz, dtype=torch.bool, device=nn_distances.device)
+        else:
+            mapping = extended_mapping.to(nn_distances.device).bool()
+            # images not mapped to any other image are skipped
+            has_other = (mapping & ~torch.eye(bsz, dtype=torch.bool, device=mapping.device)).any(dim=1)
+            nn_distances = nn_distances.masked_fill(~mapping.unsqueeze(-1), float('inf'))
+
+        min_dists = nn_distances.argmin(dim=1, keepdim=True)
+        curr_nn_map = nn_map.gather(1, min_dists).squeeze(1)
+        curr_nn_distances = nn_distances.gather(1, min_dists).squeeze(1)
+
+        if self.dist_thr == 'dynamic':
+            # keep the distances of skipped images finite for their (unused) histogram
+            dist_thr = get_dynamic_threshold(torch.where(has_other.unsqueeze(1), curr_nn_distances, 0.)).unsqueeze(1)
+        else:
+            dist_thr = self.dist_thr
+        final_mask_tgt = attn_masks & (curr_nn_distances < dist_thr) & has_other.unsqueeze(1)
 
-                if self.swap_strategy == 'min':
-                    curr_mapping = extended_mapping[i]
+        indices = (min_dists.squeeze(1), curr_nn_map, final_mask_tgt.unsqueeze(-1))
+        self.injection_cache[key] = (extended_mapping, indices)
+        return indices
 
-                    # If the current image is not mapped to any other image, skip
-                    if not torch.any(torch.cat([curr_mapping[:i], curr_mapping[i+1:]])):
-                        continue
+    def blend(self, output, source_outputs, alpha, indices):
+        # all batch items at once: blend each masked pixel with its nearest neighbour in the source outputs
+        min_dists, curr_nn_map, final_mask_tgt = indices
+        other_outputs = source_outputs[min_dists, curr_nn_map]
 
-                    min_dists = nn_distances[i][curr_mapping].argmin(dim=0)
-                    curr_nn_map = nn_map[i][curr_mapping][min_dists, torch.arange(vector_dim)]
+        return torch.where(final_mask_tgt, output.lerp(other_outputs.to(output.dtype), alpha), output)
 
-                    curr_nn_distances = nn_distances[i][curr_mapping][min_dists, torch.arange(vector_dim)]
-                    dist_thr = get_dynamic_threshold(curr_nn_distances) if self.dist_thr == 'dynamic' else self.dist_thr
-                    dist_mask = curr_nn_distances < dist_thr
-                    final_mask_tgt = attn_masks[i] & dist_mask
+    def inject_outputs(self, output, curr_iter, output_res, extended_mapping, place_in_unet, anchors_cache=None):
+        curr_unet_part = place_in_unet.split('_')[0]
 
-                    other_outputs = old_output[curr_mapping][min_dists, curr_nn_map][final_mask_tgt]
+        # Inject only in the specified unet parts (up, mid, down)
+        if (curr_unet_part not in self.inject_unet_parts) or output_res not in self.inject_res:
+            return output
 
-                    output[i][final_mask_tgt] = alpha * other_outputs + (1 - alpha)*old_output[i][final_mask_tgt]
+        alpha = next((alpha for min_range, max_range, alpha in self.inject_range_alpha if min_range <= curr_iter <= max_range), None)
+        if alpha:
+            if self.swap_strategy == 'min':
+                indices = self.get_injection_indices(output_res, extended_mapping)
+                output = self.blend(output, output, alpha, indices)
 
             if anchors_cache and anchors_cache.is_cache_mode():
                 if place_in_unet not in anchors_cache.h_out_cache:
@@ -82,33 +105,13 @@ class FeatureInjector:
         if (curr_unet_part not in self.inject_unet_parts) or output_res not in self.inject_res:
             return output
 
-        bsz = output.shape[0]
-        nn_map = self.nn_map[output_res]
-        nn_distances = self.nn_distances[output_res]
-        attn_masks = self.attn_masks[output_res]
-        vector_dim = output_res**2
-
         alpha = next((alpha for min_range, max_range, alpha in self.inject_range_alpha if min_range <= curr_iter <= max_range), None)
         if alpha:
-
             anchor_outputs = anchors_cache.h_out_cache[place_in_unet][curr_iter]
 
-            old_output = output#.clone()
-            for i in range(bsz):
-                other_outputs = []
-
-                if self.swap_strategy == 'min':
-                    min_dists = nn_distances[i].argmin(dim=0)
-                    curr_nn_map = nn_map[i][min_dists, torch.arange(vector_dim)]
-
-                    curr_nn_distances = nn_distances[i][min_dists, torch.arange(vector_dim)]
-                    dist_thr = get_dynamic_threshold(curr_nn_distances) if self.dist_thr == 'dynamic' else self.dist_thr
-                    dist_mask = curr_nn_distances < dist_thr
-                    final_mask_tgt = attn_masks[i] & dist_mask
-
-                    other_outputs = anchor_outputs[min_dists, curr_nn_map][final_mask_tgt]
-
-                    output[i][final_mask_tgt] = alpha * other_outputs + (1 - alpha)*old_output[i][final_mask_tgt]
+            if self.swap_strategy == 'min':
+                indices = self.get_injection_indices(output_res)
+                output = self.blend(output, anchor_outputs, alpha, indices)
 
         return output
 
@@ -151,6 +154,70 @@ class AnchorCache:
         if self.dift_cache is not None:
             self.dift_cache = self.dift_cache.to(device)
 
+    def state_dict(self, prefix=''):
+        # flat fp16 tensors keyed by place_in_unet/step,masks stay bool
+        def pack(tensor):
+            tensor = tensor.detach().to('cpu')
+            return (tensor.half() if tensor.is_floating_point() else tensor).contiguous()
+
+        state_dict = {}
+        for name, cache in (('input_h', self.input_h_cache), ('h_out', self.h_out_cache)):
+            for place_in_unet, steps in cache.items():
+                for step, value in steps.items():
+                    state_dict[f'{prefix}{name}/{place_in_unet}/{step}'] = pack(value)
+        for res, mask in (self.anchors_last_mask or {}).items():
+            if mask is not None:
+                state_dict[f'{prefix}last_mask/{res}'] = pack(mask)
+        if self.dift_cache is not None:
+            state_dict[f'{prefix}dift'] = pack(self.dift_cache)
+
+        return state_dict
+
+    def load_state_dict(self, state_dict, prefix=''):
+        for key, value in state_dict.items():
+            if not key.startswith(prefix):
+                continue
+            name, *rest = key[len(prefix):].split('/')
+            if name == 'dift':
+                self.dift_cache = value
+            elif name == 'last_mask':
+                if self.anchors_last_mask is None:
+                    self.anchors_last_mask = {}
+                self.anchors_last_mask[int(rest[0])] = value
+            else:
+                cache = self.input_h_cache if name == 'input_h' else self.h_out_cache
+                cache.setdefault(rest[0], {})[int(rest[1])] = value
+
+
+def save_anchor_caches(path, anchor_caches, **metadata):
+    # the anchor caches of one run (first and second stage) in one safetensors file
+    state_dict = {}
+    for i, anchor_cache in enumerate(anchor_caches):
+        state_dict.update(anchor_cache.state_dict(prefix=f'{i}/'))
+    metadata = {k: v if isinstance(v, str) else json.dumps(v) for k, v in metadata.items()}
+    metadata['n_caches'] = str(len(anchor_caches))
+
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    tmp_path = path + '.tmp'
+    save_file(state_dict, tmp_path, metadata=metadata)
+    os.replace(tmp_path, path)
+
+def load_anchor_caches(path, device='cpu'):
+    # the caches come back on cpu (like cache_cpu_offloading) and in inject mode
+    with safe_open(path, framework='pt', device=str(device)) as f:
+        metadata = f.metadata() or {}
+        state_dict = {k: f.get_tensor(k) for k in f.keys()}
+
+    anchor_caches = []
+    for i in range(int(metadata.get('n_caches', 1))):
+        anchor_cache = AnchorCache()
+        anchor_cache.load_state_dict(state_dict, prefix=f'{i}/')
+        anchor_cache.set_mode_inject()
+        anchor_caches.append(anchor_cache)
+
+    return anchor_caches
+
 
 class QueryStore:
     def __init__(self, mode='store', t_range=[0, 1000], strength_start=1, strength_end=1):
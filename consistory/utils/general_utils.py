@@ -14,20 +14,48 @@ import numpy as np
 from typing import List
 from diffusers.utils.torch_utils import randn_tensor
 import torch.nn.functional as F
-from skimage import filters
 
 from tqdm import tqdm
 
 ## Attention Utils
+def batched_otsu_threshold(values, nbins=256):
+    """
+    Otsu threshold of every row of a [B, N] tensor, computed on its device without host syncs.
+    Uses the same histogram and bin centres as skimage.filters.threshold_otsu.
+    """
+    values = values.float()
+    low = values.min(dim=1, keepdim=True).values
+    high = values.max(dim=1, keepdim=True).values
+    scale = (high - low).clamp_min(torch.finfo(values.dtype).tiny)
+
+    bins = ((values - low) / scale * nbins).long().clamp_(0, nbins - 1)
+    counts = torch.zeros(values.shape[0], nbins, device=values.device).scatter_add_(1, bins, torch.ones_like(values))
+    bin_centers = low + (torch.arange(nbins, device=values.device) + 0.5) / nbins * scale
+
+    # class weights and means for every split,the first and last bins are never empty
+    weight1 = counts.cumsum(dim=1)
+    weight2 = counts.flip(1).cumsum(dim=1).flip(1)
+    mean1 = (counts * bin_centers).cumsum(dim=1) / weight1.clamp_min(1)
+    mean2 = (counts * bin_centers).flip(1).cumsum(dim=1).flip(1) / weight2.clamp_min(1)
+
+    variance12 = weight1[:, :-1] * weight2[:, 1:] * (mean1[:, :-1] - mean2[:, 1:]) ** 2
+    thresholds = bin_centers.gather(1, variance12.argmax(dim=1, keepdim=True))
+
+    # a constant row has no split,its value is the threshold
+    return torch.where(high > low, thresholds, low).squeeze(1)
+
 def get_dynamic_threshold(tensor):
-    return filters.threshold_otsu(tensor.cpu().numpy())
+    # one threshold per row of the last dim,a 0-d tensor for a single vector
+    thresholds = batched_otsu_threshold(tensor.reshape(-1, tensor.shape[-1]))
+    return thresholds.view(tensor.shape[:-1])
 
 def attn_map_to_binary(attention_map, scaler=1.):
-    attention_map_np = attention_map.cpu().numpy()
-    threshold_value = filters.threshold_otsu(attention_map_np) * scaler
-    binary_mask = (attention_map_np > threshold_value).astype(np.uint8)
+    # a [h, w] map or a [B, h, w] batch of maps,each thresholded with its own otsu value
+    attention_maps = attention_map.reshape(-1, attention_map.shape[-2] * attention_map.shape[-1]).float()
+    threshold_value = batched_otsu_threshold(attention_maps) * scaler
+    binary_mask = attention_maps > threshold_value.unsqueeze(1)
 
-    return binary_mask
+    return binary_mask.view(attention_map.shape)
 
 
 ## Features
@@ -89,21 +117,52 @@ def gen_nn_map(src_features, src_mask,  tgt_features, tgt_mask, device, batch_si
 
     return nearest_neighbor_indices, nearest_neighbor_distances
 
+def resize_features(features, tgt_size):
+    # [B, C, h, w] -> l2 normalised [B, tgt_size**2, C], done once per resolution instead of once per pair
+    resized_features = F.interpolate(features, size=tgt_size, mode='bilinear', align_corners=False)
+    resized_features = resized_features.flatten(2).transpose(1, 2)
+
+    return F.normalize(resized_features, dim=-1)
+
+def batched_nn_map(src_features, src_masks, tgt_features, max_elements=2**26):
+    """
+    Nearest source pixel of every target pixel for all (target, source) pairs at once.
+    src_features [S, N, C] and tgt_features [T, M, C] are normalised, src_masks [S, N] are the valid source pixels.
+    The target pixels of all images are flattened and processed in chunks, so a distance block never holds
+    more than max_elements values. Returns nn_map [T, S, M] and nn_distances [T, S, M].
+    """
+    n_src, n_src_pixels, _ = src_features.shape
+    n_tgt, n_tgt_pixels, _ = tgt_features.shape
+    flat_tgt_features = tgt_features.reshape(n_tgt * n_tgt_pixels, -1)
+    invalid = ~src_masks.reshape(n_src, n_src_pixels, 1).bool()
+
+    nn_map = torch.empty(n_src, n_tgt * n_tgt_pixels, dtype=torch.long, device=src_features.device)
+    nn_distances = torch.empty(n_src, n_tgt * n_tgt_pixels, dtype=src_features.dtype, device=src_features.device)
+
+    chunk_size = max(1, max_elements // (n_src * n_src_pixels))
+    for i in range(0, n_tgt * n_tgt_pixels, chunk_size):
+        # [S, N, chunk] cosine distances of the chunk to every source pixel of every source image
+        distances = 1 - src_features @ flat_tgt_features[i:i+chunk_size].T
+        distances.masked_fill_(invalid, 2.)
+        min_distances, min_indices = torch.min(distances, dim=1)
+        nn_map[:, i:i+chunk_size] = min_indices
+        nn_distances[:, i:i+chunk_size] = min_distances
+
+    nn_map = nn_map.view(n_src, n_tgt, n_tgt_pixels).transpose(0, 1).contiguous()
+    nn_distances = nn_distances.view(n_src, n_tgt, n_tgt_pixels).transpose(0, 1).contiguous()
+
+    return nn_map, nn_distances
+
 def cyclic_nn_map(features, masks, latent_resolutions, device):
     bsz = features.shape[0]
     nn_map_dict = {}
     nn_distances_dict = {}
 
     for tgt_size in latent_resolutions:
-        nn_map = torch.empty(bsz, bsz, tgt_size**2, dtype=torch.long, device=device)
-        nn_distances = torch.full((bsz, bsz, tgt_size**2), float('inf'), dtype=features.dtype, device=device)
-
-        for i in range(bsz):
-            for j in range(bsz):
-                if i != j:
-                    nearest_neighbor_indices, nearest_neighbor_distances = gen_nn_map(features[j], masks[tgt_size][j], features[i], masks[tgt_size][i], device, batch_size=None, tgt_size=tgt_size)
-                    nn_map[i,j] = nearest_neighbor_indices
-                    nn_distances[i,j] = nearest_neighbor_distances
+        resized_features = resize_features(features.to(device), tgt_size)
+        nn_map, nn_distances = batched_nn_map(resized_features, masks[tgt_size].to(device), resized_features)
+        # an image is never its own neighbour
+        nn_distances[torch.arange(bsz), torch.arange(bsz)] = float('inf')
 
         nn_map_dict[tgt_size] = nn_map
         nn_distances_dict[tgt_size] = nn_distances
@@ -111,23 +170,15 @@ def cyclic_nn_map(features, masks, latent_resolutions, device):
     return nn_map_dict, nn_distances_dict
 
 def anchor_nn_map(features, anchor_features, masks, anchor_masks, latent_resolutions, device):
-    bsz = features.shape[0]
-    anchor_bsz = anchor_features.shape[0]
     nn_map_dict = {}
     nn_distances_dict = {}
 
     for tgt_size in latent_resolutions:
-        nn_map = torch.empty(bsz, anchor_bsz, tgt_size**2, dtype=torch.long, device=device)
-        nn_distances = torch.full((bsz, anchor_bsz, tgt_size**2), float('inf'), dtype=features.dtype, device=device)
-
-        for i in range(bsz):
-            for j in range(anchor_bsz):
-                nearest_neighbor_indices, nearest_neighbor_distances = gen_nn_map(anchor_features[j], anchor_masks[tgt_size][j], features[i], masks[tgt_size][i], device, batch_size=None, tgt_size=tgt_size)
-                nn_map[i,j] = nearest_neighbor_indices
-                nn_distances[i,j] = nearest_neighbor_distances
-        
+        resized_features = resize_features(features.to(device), tgt_size)
+        resized_anchor_features = resize_features(anchor_features.to(device), tgt_size)
+        nn_map, nn_distances = batched_nn_map(resized_anchor_features, anchor_masks[tgt_size].to(device), resized_features)
+
         nn_map_dict[tgt_size] = nn_map
         nn_distances_dict[tgt_size] = nn_distances
     
     return nn_map_dict, nn_distances_dict
-
@@ -121,6 +121,7 @@ class AttentionStore:
         self.attn_masks = {res: None for res in self.ALL_RES}
         self.last_mask = {res: None for res in self.ALL_RES}
         self.last_mask_dropout = {res: None for res in self.ALL_RES}
+        self.extended_attn_indices = {} # width: (last_mask_dropout it was built from, indices)
 
     def __call__(self, attn, is_cross: bool, place_in_unet: str, attn_heads: int):
         if is_cross and attn.shape[1] == np.prod(self.attn_res):
@@ -134,6 +135,7 @@ class AttentionStore:
         self.attn_masks = {res: None for res in self.ALL_RES}
         self.last_mask = {res: None for res in self.ALL_RES}
         self.last_mask_dropout = {res: None for res in self.ALL_RES}
+        self.extended_attn_indices = {}
 
         torch.cuda.empty_cache()
 
@@ -153,23 +155,18 @@ class AttentionStore:
 
             agg_attn_maps.append(torch.stack(curr_prompt_indices))
 
+        concept_counts = [len(x) for x in agg_attn_maps]
+        all_agg_attn_maps = torch.cat(agg_attn_maps)
+
         # Upsample the attention maps to the target resolution
         # and create the attention masks, unifying masks across the different concepts
         for tgt_size in self.ALL_RES:
             pixels = tgt_size ** 2
-            tgt_agg_attn_maps = [F.interpolate(x.unsqueeze(1), size=tgt_size, mode='bilinear').squeeze(1) for x in agg_attn_maps]
-
-            attn_masks = []
-            for batch_item_map in tgt_agg_attn_maps:
-                concept_attn_masks = []
-
-                for concept_maps in batch_item_map:
-                    concept_attn_masks.append(torch.from_numpy(attn_map_to_binary(concept_maps, 1.)).to(attention_maps.device).bool().view(-1))
+            tgt_agg_attn_maps = F.interpolate(all_agg_attn_maps.unsqueeze(1), size=tgt_size, mode='bilinear').squeeze(1)
 
-                concept_attn_masks = torch.stack(concept_attn_masks, dim=0).max(dim=0).values
-                attn_masks.append(concept_attn_masks)
-
-            attn_masks = torch.stack(attn_masks)
+            # threshold all concept maps of all batch items at once
+            concept_attn_masks = attn_map_to_binary(tgt_agg_attn_maps, 1.).view(-1, pixels)
+            attn_masks = torch.stack([x.any(dim=0) for x in concept_attn_masks.split(concept_counts)])
             self.last_mask[tgt_size] = attn_masks.clone()
 
             # Add mask dropout
@@ -229,4 +226,41 @@ class AttentionStore:
                         raise NotImplementedError('mask_background_query is not supported anymore')
                         output_attn_mask[0, attn_mask[i], k*n_patches:(k+1)*n_patches] = attn_mask[j].unsqueeze(0).expand(attn_mask[i].sum(), -1)
 
-        return output_attn_mask
\ No newline at end of file
+        return output_attn_mask
+
+    def get_extended_attn_indices(self, width):
+        """
+        Packed key/value indices of the extended attention of every image: its own patches followed by the masked
+        patches of the images it is mapped to, in the order get_extended_attn_mask_instance selects them.
+        The masks change once per step, so every layer of a resolution shares the indices.
+        """
+        attn_mask = self.last_mask_dropout[width]
+        if attn_mask is None:
+            return None
+
+        cached = self.extended_attn_indices.get(width)
+        if cached is not None and cached[0] is attn_mask:
+            return cached[1]
+
+        n_images = attn_mask.shape[0]
+        eye = torch.eye(n_images, dtype=torch.bool, device=attn_mask.device)
+        mapping = self.extended_mapping.to(attn_mask.device).bool() & ~eye
+        extended_mask = (eye.unsqueeze(-1) | (mapping.unsqueeze(-1) & attn_mask.unsqueeze(0))).view(n_images, -1)
+
+        kv_seqlens = extended_mask.sum(dim=1)
+        kv_index = extended_mask.nonzero()[:, 1]
+
+        # the same indices padded to the longest image, for backends without variable length attention
+        positions = torch.arange(int(kv_seqlens.max()), device=attn_mask.device)
+        offsets = kv_seqlens.cumsum(dim=0) - kv_seqlens
+        padded_index = kv_index[(offsets.unsqueeze(1) + positions).clamp(max=kv_index.numel() - 1)]
+        padded_mask = positions < kv_seqlens.unsqueeze(1)
+
+        indices = {
+            'kv_index': kv_index,
+            'kv_seqlens': kv_seqlens.tolist(),
+            'padded_index': padded_index,
+            'padded_mask': padded_mask,
+        }
+        self.extended_attn_indices[width] = (attn_mask, indices)
+        return indices
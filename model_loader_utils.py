@@ -2,11 +2,15 @@
 # -*- coding: UTF-8 -*-
 import datetime
 import gc
+import hashlib
+import json
 import logging
 import os
 import sys
 import re
 import random
+from collections import OrderedDict
+from concurrent.futures import Future
 import torch
 from diffusers.image_processor import VaeImageProcessor
 from omegaconf import OmegaConf
@@ -29,9 +33,12 @@ from .msdiffusion.models.model import MSAdapter
 from .msdiffusion.utils import get_phrase_idx, get_eot_idx
 from .utils.style_template import styles
 from .utils.load_models_utils import  get_lora_dict,get_instance_path
+from .utils.cache_utils import prompt_cache, FaceAnalysisCache, face_pool, prefetch_pool, QuantizedWeightCache, \
+    MS_CACHE, ms_cache, get_file_stamp, get_obj_key
 from .PuLID.pulid.utils import resize_numpy_image_long
 from transformers import AutoModel, AutoTokenizer
 from comfy.utils import common_upscale,ProgressBar
+import comfy.model_management
 import folder_paths
 
 from comfy.clip_vision import load as clip_load
@@ -40,16 +47,13 @@ cur_path = os.path.dirname(os.path.abspath(__file__))
 photomaker_dir=os.path.join(folder_paths.models_dir, "photomaker")
 cache_photomaker_dir="/stable-diffusion-cache/models/photomaker"
 base_pt = os.path.join(photomaker_dir,"pt")
+face_cache = FaceAnalysisCache(os.path.join(photomaker_dir, "face_cache"))
+quant_cache = QuantizedWeightCache(os.path.join(photomaker_dir, "quant_cache"))
 device = "cuda" if torch.cuda.is_available() else "mps" if torch.backends.mps.is_available() else "cpu"
 
 lora_get = get_lora_dict()
 lora_lightning_list = lora_get["lightning_xl_lora"]
 
-global total_count, attn_count, cur_step, mask1024, mask4096, attn_procs, unet
-global sa32, sa64
-global write
-global height_s, width_s
-
 SAMPLER_NAMES = ["euler", "euler_cfg_pp", "euler_ancestral", "euler_ancestral_cfg_pp", "heun", "heunpp2","dpm_2", "dpm_2_ancestral",
                   "lms", "dpm_fast", "dpm_adaptive", "dpmpp_2s_ancestral", "dpmpp_2s_ancestral_cfg_pp", "dpmpp_sde", "dpmpp_sde_gpu",
                   "dpmpp_2m", "dpmpp_2m_sde", "dpmpp_2m_sde_gpu", "dpmpp_3m_sde", "dpmpp_3m_sde_gpu", "ddpm", "lcm",
@@ -128,6 +132,8 @@ def get_easy_function(easy_function, clip_vision, character_weights, ckpt_name,
     inject=False
     use_quantize=True
     use_inf=False
+    reload_pipe=False
+    bank_dtype="fp16"
     if easy_function:
         easy_function = easy_function.strip().lower()
         if "auraface" in easy_function:
@@ -164,6 +170,12 @@ def get_easy_function(easy_function, clip_vision, character_weights, ckpt_name,
             use_quantize=False
         if "infinite" in easy_function:
             use_inf=True
+        if "fresh" in easy_function:
+            reload_pipe=True
+        if "f8bank" in easy_function:
+            bank_dtype="fp8"
+        if "i8bank" in easy_function:
+            bank_dtype="int8"
 
     
     if clip_vision != "none":
@@ -200,16 +212,19 @@ def get_easy_function(easy_function, clip_vision, character_weights, ckpt_name,
         photomake_mode = ""
     
     return (auraface, NF4, save_model, kolor_face, flux_pulid_name, pulid, quantized_mode, story_maker, make_dual_only,
-            clip_vision_path, char_files, ckpt_path, lora, lora_path, use_kolor, photomake_mode, use_flux,onnx_provider,low_vram,TAG_mode,SD35_mode,consistory,cached,inject,use_quantize,use_inf)
+            clip_vision_path, char_files, ckpt_path, lora, lora_path, use_kolor, photomake_mode, use_flux,onnx_provider,low_vram,TAG_mode,SD35_mode,consistory,cached,inject,use_quantize,use_inf,reload_pipe,bank_dtype)
 def pre_checkpoint(photomaker_path, photomake_mode, kolor_face, pulid, story_maker, clip_vision_path, use_kolor,
                    model_type,use_flux,SD35_mode,use_inf=False):
+    # missing adapters are downloaded concurrently in prefetch_pool,the loader prefetches the resolved files
+    downloads = []
     if not (use_inf or pulid or kolor_face or use_kolor or use_flux or SD35_mode):
         if photomake_mode == "v1":
             if not os.path.exists(photomaker_path):
                 if os.path.exists(cache_photomaker_dir):
                     photomaker_path = os.path.join(cache_photomaker_dir, "photomaker-v1.bin")
                 else:
-                    photomaker_path = hf_hub_download(
+                    photomaker_path = prefetch_pool.submit(
+                        hf_hub_download,
                         repo_id="TencentARC/PhotoMaker",
                         filename="photomaker-v1.bin",
                         local_dir=photomaker_dir,
@@ -219,7 +234,8 @@ def pre_checkpoint(photomaker_path, photomake_mode, kolor_face, pulid, story_mak
                 if os.path.exists(cache_photomaker_dir):
                     photomaker_path = os.path.join(cache_photomaker_dir, "photomaker-v2.bin")
                 else:
-                    photomaker_path = hf_hub_download(
+                    photomaker_path = prefetch_pool.submit(
+                        hf_hub_download,
                         repo_id="TencentARC/PhotoMaker-V2",
                         filename="photomaker-v2.bin",
                         local_dir=photomaker_dir,
@@ -230,11 +246,12 @@ def pre_checkpoint(photomaker_path, photomake_mode, kolor_face, pulid, story_mak
             if os.path.exists("/stable-diffusion-cache/models/ControlNet/Kolors_ip_adapter_plus_general.bin"):
                 face_ckpt = "/stable-diffusion-cache/models/ControlNet/kolors_cn/kolors_ipa_faceid_plus.bin"
             else:
-                hf_hub_download(
+                downloads.append(prefetch_pool.submit(
+                    hf_hub_download,
                     repo_id="Kwai-Kolors/Kolors-IP-Adapter-FaceID-Plus",
                     filename="ipa-faceid-plus.bin",
                     local_dir=photomaker_dir,
-                )
+                ))
         photomake_mode = ""
     else:
         face_ckpt = ""
@@ -244,11 +261,12 @@ def pre_checkpoint(photomaker_path, photomake_mode, kolor_face, pulid, story_mak
             if os.path.exists("/stable-diffusion-cache/models/pulid/pulid_flux_v0.9.0.safetensors"):
                 pulid_ckpt = "/stable-diffusion-cache/models/pulid/pulid_flux_v0.9.0.safetensors"
             else:
-                hf_hub_download(
+                downloads.append(prefetch_pool.submit(
+                    hf_hub_download,
                     repo_id="guozinan/PuLID",
                     filename="pulid_flux_v0.9.0.safetensors",
                     local_dir=photomaker_dir,
-                )
+                ))
         photomake_mode = ""
     else:
         pulid_ckpt = ""
@@ -262,11 +280,12 @@ def pre_checkpoint(photomaker_path, photomake_mode, kolor_face, pulid, story_mak
             if os.path.exists("/stable-diffusion-cache/models/RED-AIGC/StoryMaker/mask.bin"):
                 face_adapter = "/stable-diffusion-cache/models/RED-AIGC/StoryMaker/mask.bin"
             else:
-                hf_hub_download(
+                downloads.append(prefetch_pool.submit(
+                    hf_hub_download,
                     repo_id="RED-AIGC/StoryMaker",
                     filename="mask.bin",
                     local_dir=photomaker_dir,
-                )
+                ))
     else:
         face_adapter = ""
     
@@ -278,12 +297,17 @@ def pre_checkpoint(photomaker_path, photomake_mode, kolor_face, pulid, story_mak
                 if os.path.exists("/stable-diffusion-cache/models/ControlNet/Kolors_ip_adapter_plus_general.bin"):
                     kolor_ip_path = "/stable-diffusion-cache/models/ControlNet/Kolors_ip_adapter_plus_general.bin"
                 else:
-                    hf_hub_download(
+                    downloads.append(prefetch_pool.submit(
+                        hf_hub_download,
                         repo_id="Kwai-Kolors/Kolors-IP-Adapter-Plus",
                         filename="ip_adapter_plus_general.bin",
                         local_dir=photomaker_dir,
-                    )
+                    ))
             photomake_mode = ""
+    if isinstance(photomaker_path, Future):
+        photomaker_path = photomaker_path.result()
+    for download in downloads:
+        download.result()
     return photomaker_path, face_ckpt, photomake_mode, pulid_ckpt, face_adapter, kolor_ip_path
 
 
@@ -296,6 +320,12 @@ def tensor_to_image(tensor):
     image = Image.fromarray(image_np, mode='RGB')
     return image
 
+def to_pil(img):
+    # pipeline "pt" outputs ([3,H,W]) to PIL,PIL passes through
+    if isinstance(img, torch.Tensor):
+        return tensor_to_image(img.squeeze(0).permute(1, 2, 0).float().cpu())
+    return img
+
 def tensortopil_list(tensor_in):
     d1, _, _, _ = tensor_in.size()
     if d1 == 1:
@@ -311,6 +341,8 @@ def nomarl_tensor_upscale(tensor, width, height):
     samples = samples.movedim(1, -1)
     return samples
 def nomarl_upscale(img, width, height):
+    if img.shape[1] == height and img.shape[2] == width:
+        return tensor_to_image(img)  # already the target size,skip the resample copy
     samples = img.movedim(-1, 1)
     img = common_upscale(samples, width, height, "nearest-exact", "center")
     samples = img.movedim(1, -1)
@@ -359,11 +391,44 @@ def remove_punctuation_from_strings(lst):
     pattern = r"[\W]+$"  # 匹配字符串末尾的所有非单词字符
     return [re.sub(pattern, '', s) for s in lst]
 
-def phi_list(list_in):
-    for i in range(len(list_in)):
-        value = list_in[i]
-        list_in[i] = value
-    return list_in
+class PanelStreamer:
+    """
+    write every finished panel into one preallocated [N,H,W,3] float32 tensor as soon as the sampler gets it,
+    push it to the comfyUI progress bar as a preview and optionally save it to save_dir.
+    """
+    def __init__(self, total, height, width, save_dir=None):
+        self.images = torch.zeros((total, height, width, 3), dtype=torch.float32)
+        self.done = set()
+        self.pbar = ProgressBar(total)
+        self.save_dir = save_dir
+        if save_dir and not os.path.exists(save_dir):
+            os.makedirs(save_dir)
+
+    def put(self, position, img):
+        # img is a PIL image or a pipeline "pt" output ([3,H,W] float in 0~1,on any device)
+        if position in self.done:
+            return
+        if isinstance(img, (list, tuple)):  # a pipeline .images list of one panel
+            img = img[0]
+        if isinstance(img, torch.Tensor):
+            self.images[position].copy_(img.squeeze(0).permute(1, 2, 0))
+            # the preview only needs a strided view,a full size PIL is made only when saving
+            stride = max(1, max(self.images.shape[1:3]) // 512)
+            preview = tensor_to_image(self.images[position][::stride, ::stride])
+        else:
+            array = np.array(img if img.mode == "RGB" else img.convert("RGB"))
+            self.images[position].copy_(torch.from_numpy(array)).div_(255.0)
+            preview = img
+        self.done.add(position)
+        self.pbar.update_absolute(len(self.done), preview=("JPEG", preview, 512))
+        if self.save_dir:
+            to_pil(img).save(os.path.join(self.save_dir, f"{position:03d}.png"))
+
+    def stream(self, results, positions):
+        # results:{prompt index:image},positions maps a prompt index to its panel
+        for ind in list(results.keys()):
+            self.put(positions[ind], results[ind])
+
 
 def narry_list_pil(list_in):
     for i in range(len(list_in)):
@@ -571,6 +636,7 @@ def kolor_loader(repo_id,model_type,set_attention_processor,id_length,kolor_face
     
     
 def quantized_nf4_extra(ckpt_path,dir_path,mode):
+    # a nf4 ckpt is loaded as is,a full precision one is quantized once and the nf4 weights are saved in quant_cache
     if mode=="flux":
         from diffusers.models.transformers.transformer_flux import FluxTransformer2DModel
         config_file = os.path.join(dir_path, "config.json")
@@ -579,43 +645,93 @@ def quantized_nf4_extra(ckpt_path,dir_path,mode):
         config_file = os.path.join(dir_path, "config/sd35/config.json")
     from accelerate.utils import set_module_tensor_to_device
     from accelerate import init_empty_weights
+    from safetensors import safe_open
     from .utils.convert_nf4_flux import _replace_with_bnb_linear, create_quantized_param, \
         check_quantized_param
-    import gc
     dtype = torch.bfloat16
     is_torch_e4m3fn_available = hasattr(torch, "float8_e4m3fn")
-    original_state_dict = load_file(ckpt_path)
+    with safe_open(ckpt_path, framework="pt", device="cpu") as f:
+        pre_quantized = any(".quant_state.bitsandbytes__" in k for k in f.keys())
+    load_path = ckpt_path
+    if not pre_quantized:
+        cached_path = quant_cache.get(ckpt_path, "nf4")
+        if cached_path is not None:
+            logging.info(f"loading nf4 weights from cache {cached_path}")
+            load_path, pre_quantized = cached_path, True
     with init_empty_weights():
         if mode == "flux":
             config = FluxTransformer2DModel.load_config(config_file)
             model = FluxTransformer2DModel.from_config(config).to(dtype)
-            expected_state_dict_keys = list(model.state_dict().keys())
+            expected_state_dict_keys = set(model.state_dict().keys())
         else:
             config = SD3Transformer2DModel.load_config(config_file)
             model = SD3Transformer2DModel.from_config(config).to(dtype)
-            expected_state_dict_keys = list(model.state_dict().keys())
+            expected_state_dict_keys = set(model.state_dict().keys())
     _replace_with_bnb_linear(model, "nf4")
     
-    for param_name, param in original_state_dict.items():
-        if param_name not in expected_state_dict_keys:
-            continue
-        
-        is_param_float8_e4m3fn = is_torch_e4m3fn_available and param.dtype == torch.float8_e4m3fn
-        if torch.is_floating_point(param) and not is_param_float8_e4m3fn:
-            param = param.to(dtype)
-        
-        if not check_quantized_param(model, param_name):
-            set_module_tensor_to_device(model, param_name, device=0, value=param)
-        else:
-            create_quantized_param(
-                model, param, param_name, target_device=0, state_dict=original_state_dict,
-                pre_quantized=True
-            )
+    with safe_open(load_path, framework="pt", device="cpu") as f:
+        keys = list(f.keys())
+        # param name:{quant state key:tensor},grouped once instead of scanning the whole state dict per param
+        quantized_stats = {}
+        if pre_quantized:
+            for k in keys:
+                if k in expected_state_dict_keys:
+                    continue
+                param_name = k
+                while "." in param_name and param_name not in expected_state_dict_keys:
+                    param_name = param_name.rsplit(".", 1)[0]
+                if param_name in expected_state_dict_keys:
+                    quantized_stats.setdefault(param_name, {})[k] = f.get_tensor(k)
+        for param_name in keys:
+            if param_name not in expected_state_dict_keys:
+                continue
+            param = f.get_tensor(param_name)  # one tensor at a time from the mmap'd file
+            
+            is_param_float8_e4m3fn = is_torch_e4m3fn_available and param.dtype == torch.float8_e4m3fn
+            if torch.is_floating_point(param) and not is_param_float8_e4m3fn:
+                param = param.to(dtype)
+            
+            if not check_quantized_param(model, param_name):
+                set_module_tensor_to_device(model, param_name, device=0, value=param)
+            else:
+                create_quantized_param(
+                    model, param, param_name, target_device=0, state_dict=quantized_stats.get(param_name, {}),
+                    pre_quantized=pre_quantized
+                )
     
-    del original_state_dict
+    if not pre_quantized:
+        quant_cache.put(ckpt_path, "nf4", model.state_dict())
+    del quantized_stats
     gc.collect()
     
     return model
+
+
+def quanto_fp8_loader(repo_id, subfolder, build_empty, build_full, revision=None, dtype=torch.bfloat16):
+    """
+    qfloat8 model of repo_id/subfolder (a local dir or a hub repo at revision),the quantized weights are saved in
+    quant_cache on the first load,later loads build the model on meta and requantize() it from the cached file
+    instead of loading the full precision weights and running quantize()/freeze() again.
+    """
+    from optimum.quanto import freeze, qfloat8, quantize, quantization_map, requantize
+    from accelerate import init_empty_weights
+    cached_path = quant_cache.get(repo_id, "qfloat8", subfolder, revision)
+    if cached_path is not None:
+        logging.info(f"loading qfloat8 weights from cache {cached_path}")
+        state_dict, metadata = quant_cache.load(cached_path)
+        with init_empty_weights():
+            model = build_empty().to(dtype)
+        requantize(model, state_dict, json.loads(metadata["quantization_map"]), device=torch.device("cpu"))
+        if hasattr(model, "tie_weights"):
+            model.tie_weights()
+        del state_dict
+        return model.eval()
+    model = build_full()
+    quantize(model, weights=qfloat8)
+    freeze(model)
+    quant_cache.put(repo_id, "qfloat8", model.state_dict(), subfolder, revision,
+                    quantization_map=quantization_map(model))
+    return model
     
 
 def flux_loader(folder_paths,ckpt_path,repo_id,AutoencoderKL,save_model,model_type,pulid,clip_vision_path,NF4,vae_id,offload,aggressive_offload,pulid_ckpt,quantized_mode,
@@ -627,7 +743,6 @@ def flux_loader(folder_paths,ckpt_path,repo_id,AutoencoderKL,save_model,model_ty
     dtype = torch.bfloat16
     if not ckpt_path:
         logging.info("using repo_id ,start flux fp8 quantize processing...")
-        from optimum.quanto import freeze, qfloat8, quantize
         from diffusers.pipelines.flux.pipeline_flux import FluxPipeline
         from diffusers import FlowMatchEulerDiscreteScheduler
         from diffusers.models.transformers.transformer_flux import FluxTransformer2DModel
@@ -642,24 +757,29 @@ def flux_loader(folder_paths,ckpt_path,repo_id,AutoencoderKL,save_model,model_ty
         else:
             text_encoder = CLIPTextModel.from_pretrained("openai/clip-vit-large-patch14", torch_dtype=dtype)
             tokenizer = CLIPTokenizer.from_pretrained("openai/clip-vit-large-patch14", torch_dtype=dtype)
-        text_encoder_2 = T5EncoderModel.from_pretrained(repo_id, subfolder="text_encoder_2",
-                                                        torch_dtype=dtype,
-                                                        revision=revision)
+        text_encoder_2 = quanto_fp8_loader(
+            repo_id, "text_encoder_2",
+            lambda: T5EncoderModel(T5EncoderModel.config_class.from_pretrained(repo_id, subfolder="text_encoder_2",
+                                                                               revision=revision)),
+            lambda: T5EncoderModel.from_pretrained(repo_id, subfolder="text_encoder_2", torch_dtype=dtype,
+                                                   revision=revision),
+            revision=revision)
         tokenizer_2 = T5TokenizerFast.from_pretrained(repo_id, subfolder="tokenizer_2",
                                                       torch_dtype=dtype,
                                                       revision=revision)
         vae = AutoencoderKL.from_pretrained(repo_id, subfolder="vae", torch_dtype=dtype,
                                             revision=revision)
-        transformer = FluxTransformer2DModel.from_pretrained(repo_id, subfolder="transformer",
-                                                             torch_dtype=dtype, revision=revision)
-        quantize(transformer, weights=qfloat8)
-        freeze(transformer)
+        transformer = quanto_fp8_loader(
+            repo_id, "transformer",
+            lambda: FluxTransformer2DModel.from_config(
+                FluxTransformer2DModel.load_config(repo_id, subfolder="transformer", revision=revision)),
+            lambda: FluxTransformer2DModel.from_pretrained(repo_id, subfolder="transformer", torch_dtype=dtype,
+                                                           revision=revision),
+            revision=revision)
         if save_model:
             print(f"saving fp8 pt on '{weight_transformer}'")
             torch.save(transformer,
                        weight_transformer)  # https://pytorch.org/tutorials/beginner/saving_loading_models.html.
-        quantize(text_encoder_2, weights=qfloat8)
-        freeze(text_encoder_2)
         if model_type == "img2img":
             # https://github.com/deforum-studio/flux/blob/main/flux_pipeline.py#L536
             from .utils.flux_pipeline import FluxImg2ImgPipeline
@@ -688,7 +808,6 @@ def flux_loader(folder_paths,ckpt_path,repo_id,AutoencoderKL,save_model,model_ty
     else:  # flux diff unet ,diff 0.30 ckpt or repo
         from diffusers import FluxTransformer2DModel, FluxPipeline
         from transformers import T5EncoderModel, CLIPTextModel
-        from optimum.quanto import freeze, qfloat8, quantize
         if pulid:
             logging.info("using repo_id and ckpt ,start flux-pulid processing...")
             from .PuLID.app_flux import FluxGenerator
@@ -725,10 +844,11 @@ def flux_loader(folder_paths,ckpt_path,repo_id,AutoencoderKL,save_model,model_ty
                     config_file = os.path.join(dir_path, "utils", "config.json")
                     transformer = FluxTransformer2DModel.from_single_file(ckpt_path, config=config_file,
                                                                           torch_dtype=dtype)
-                text_encoder_2 = T5EncoderModel.from_pretrained(repo_id, subfolder="text_encoder_2",
-                                                                torch_dtype=dtype)
-                quantize(text_encoder_2, weights=qfloat8)
-                freeze(text_encoder_2)
+                text_encoder_2 = quanto_fp8_loader(
+                    repo_id, "text_encoder_2",
+                    lambda: T5EncoderModel(T5EncoderModel.config_class.from_pretrained(repo_id,
+                                                                                       subfolder="text_encoder_2")),
+                    lambda: T5EncoderModel.from_pretrained(repo_id, subfolder="text_encoder_2", torch_dtype=dtype))
                 
                 if model_type == "img2img":
                     from .utils.flux_pipeline import FluxImg2ImgPipeline
@@ -743,82 +863,88 @@ def flux_loader(folder_paths,ckpt_path,repo_id,AutoencoderKL,save_model,model_ty
             pipe.enable_model_cpu_offload()
     return pipe
 
+def prepare_face_app(app_face, det_size=(640, 640)):
+    app_face.prepare(ctx_id=0, det_size=det_size)
+    return app_face
+
+
 def insight_face_loader(photomake_mode,auraface,kolor_face,story_maker,make_dual_only,use_storydif,use_inf=None):
+    # every model comes from face_pool,so a later run reuses the loaded onnx sessions/torch modules
     insight_root = "./"
     if os.path.exists("/stable-diffusion-cache/models/annotator/insightface/models/AuraFace-v1"):
         insight_root = "/stable-diffusion-cache/models/annotator/insightface"
     if use_storydif and photomake_mode == "v2" and not story_maker:
         from .utils.insightface_package import FaceAnalysis2, analyze_faces
         if auraface:
-            from huggingface_hub import snapshot_download
-            snapshot_download(
-                "fal/AuraFace-v1",
-                local_dir="models/AuraFace-v1",
-            )
-            app_face = FaceAnalysis2(name="AuraFace-v1",
-                                     providers=["CUDAExecutionProvider", "CPUExecutionProvider"], root=insight_root,
-                                     allowed_modules=['detection', 'recognition'])
+            def build_app_face():
+                from huggingface_hub import snapshot_download
+                snapshot_download(
+                    "fal/AuraFace-v1",
+                    local_dir="models/AuraFace-v1",
+                )
+                return prepare_face_app(FaceAnalysis2(name="AuraFace-v1",
+                                                      providers=["CUDAExecutionProvider", "CPUExecutionProvider"], root=insight_root,
+                                                      allowed_modules=['detection', 'recognition']))
+            app_face = face_pool.get(("FaceAnalysis2", "AuraFace-v1", insight_root), build_app_face)
         else:
-            app_face = FaceAnalysis2(providers=['CUDAExecutionProvider'], root=insight_root ,
-                                     allowed_modules=['detection', 'recognition'])
-        app_face.prepare(ctx_id=0, det_size=(640, 640))
+            app_face = face_pool.get(("FaceAnalysis2", "antelopev2", insight_root), lambda: prepare_face_app(
+                FaceAnalysis2(providers=['CUDAExecutionProvider'], root=insight_root, allowed_modules=['detection', 'recognition'])))
         pipeline_mask = None
         app_face_ = None
     elif kolor_face:
-        from .kolors.models.sample_ipadapter_faceid_plus import FaceInfoGenerator
-        from huggingface_hub import snapshot_download
-        if not os.path.exists("/stable-diffusion-cache/models/annotator/insightface/models/AuraFace-v1"):
-            snapshot_download(
-                'DIAMONIK7777/antelopev2',
-                local_dir='models/antelopev2',
-            )
-        app_face = FaceInfoGenerator(root_dir=insight_root)
+        def build_app_face():
+            from .kolors.models.sample_ipadapter_faceid_plus import FaceInfoGenerator
+            from huggingface_hub import snapshot_download
+            if not os.path.exists("/stable-diffusion-cache/models/annotator/insightface/models/AuraFace-v1"):
+                snapshot_download(
+                    'DIAMONIK7777/antelopev2',
+                    local_dir='models/antelopev2',
+                )
+            return FaceInfoGenerator(root_dir=insight_root)
+        app_face = face_pool.get(("FaceInfoGenerator", insight_root), build_app_face)
         pipeline_mask = None
         app_face_ = None
     elif story_maker:
         from insightface.app import FaceAnalysis
         from transformers import pipeline
-        pipeline_mask = pipeline("image-segmentation", model="briaai/RMBG-1.4",
-                                 trust_remote_code=True)
+        pipeline_mask = face_pool.get(("RMBG-1.4",), lambda: pipeline("image-segmentation", model="briaai/RMBG-1.4",
+                                                                         trust_remote_code=True))
+        buffalo_l = ("FaceAnalysis", "buffalo_l", insight_root)
+        build_buffalo_l = lambda: prepare_face_app(FaceAnalysis(name='buffalo_l', root=insight_root,
+                                                                providers=['CUDAExecutionProvider', 'CPUExecutionProvider']))
         if make_dual_only:  # 前段用story 双人用maker
             if photomake_mode == "v2" and use_storydif:
                 from .utils.insightface_package import FaceAnalysis2
                 if auraface:
-                    from huggingface_hub import snapshot_download
-                    if not os.path.exists("/stable-diffusion-cache/models/annotator/insightface/models/AuraFace-v1"):
-                        snapshot_download(
-                            "fal/AuraFace-v1",
-                            local_dir="models/auraface",
-                        )
-                    app_face = FaceAnalysis2(name="auraface",
-                                             providers=["CUDAExecutionProvider", "CPUExecutionProvider"],
-                                             root=insight_root,
-                                             allowed_modules=['detection', 'recognition'])
+                    def build_app_face():
+                        from huggingface_hub import snapshot_download
+                        if not os.path.exists("/stable-diffusion-cache/models/annotator/insightface/models/AuraFace-v1"):
+                            snapshot_download(
+                                "fal/AuraFace-v1",
+                                local_dir="models/auraface",
+                            )
+                        return prepare_face_app(FaceAnalysis2(name="auraface",
+                                                              providers=["CUDAExecutionProvider", "CPUExecutionProvider"],
+                                                              root=insight_root,
+                                                              allowed_modules=['detection', 'recognition']))
+                    app_face = face_pool.get(("FaceAnalysis2", "auraface", insight_root), build_app_face)
                 else:
-                    app_face = FaceAnalysis2(providers=['CUDAExecutionProvider'], root=insight_root,
-                                             allowed_modules=['detection', 'recognition'])
-                app_face.prepare(ctx_id=0, det_size=(640, 640))
-                app_face_ = FaceAnalysis(name='buffalo_l', root=insight_root,
-                                         providers=['CUDAExecutionProvider', 'CPUExecutionProvider'])
-                app_face_.prepare(ctx_id=0, det_size=(640, 640))
+                    app_face = face_pool.get(("FaceAnalysis2", "antelopev2", insight_root), lambda: prepare_face_app(
+                        FaceAnalysis2(providers=['CUDAExecutionProvider'], root=insight_root, allowed_modules=['detection', 'recognition'])))
+                app_face_ = face_pool.get(buffalo_l, build_buffalo_l)
             else:
-                app_face = FaceAnalysis(name='buffalo_l', root=insight_root,
-                                        providers=['CUDAExecutionProvider', 'CPUExecutionProvider'])
-                app_face.prepare(ctx_id=0, det_size=(640, 640))
+                app_face = face_pool.get(buffalo_l, build_buffalo_l)
                 app_face_ = None
         else:
-            app_face = FaceAnalysis(name='buffalo_l', root=insight_root,
-                                    providers=['CUDAExecutionProvider', 'CPUExecutionProvider'])
-            app_face.prepare(ctx_id=0, det_size=(640, 640))
+            app_face = face_pool.get(buffalo_l, build_buffalo_l)
             app_face_ = None
     elif use_inf:
         from facexlib.recognition import init_recognition_model
         from insightface.app import FaceAnalysis
          # Load face encoder
         insightface_root_path= insight_root
-        app_face = FaceAnalysis(name='antelopev2', 
-                                root=insightface_root_path, providers=['CUDAExecutionProvider', 'CPUExecutionProvider'])
-        app_face.prepare(ctx_id=0, det_size=(640, 640))
+        app_face = face_pool.get(("FaceAnalysis", "antelopev2", insightface_root_path), lambda: prepare_face_app(
+            FaceAnalysis(name='antelopev2', root=insightface_root_path, providers=['CUDAExecutionProvider', 'CPUExecutionProvider'])))
 
         # app_320 = FaceAnalysis(name='antelopev2', 
         #                         root=insightface_root_path, providers=['CUDAExecutionProvider', 'CPUExecutionProvider'])
@@ -827,7 +953,7 @@ def insight_face_loader(photomake_mode,auraface,kolor_face,story_maker,make_dual
         # app_160 = FaceAnalysis(name='antelopev2', 
         #                         root=insightface_root_path, providers=['CUDAExecutionProvider', 'CPUExecutionProvider'])
 
-        app_face_ = init_recognition_model('arcface', device='cuda')
+        app_face_ = face_pool.get(("arcface",), lambda: init_recognition_model('arcface', device='cuda'))
         pipeline_mask = None
     else:
         app_face = None
@@ -836,13 +962,14 @@ def insight_face_loader(photomake_mode,auraface,kolor_face,story_maker,make_dual
     return app_face,pipeline_mask,app_face_
 
 def main_normal(prompt,pipe,phrases,ms_model,input_images,num_samples,steps,seed,negative_prompt,scale,image_encoder,cfg,image_processor,
-                boxes,mask_threshold,start_step,image_proj_type,image_encoder_type,drop_grounding_tokens,height,width,phrase_idxes, eot_idxes,in_img,use_repo):
+                boxes,mask_threshold,start_step,image_proj_type,image_encoder_type,drop_grounding_tokens,height,width,phrase_idxes, eot_idxes,in_img,use_repo,
+                image_embeds=None):
     if use_repo:
         in_img = None
     images = ms_model.generate(pipe=pipe, pil_images=[input_images],processed_images=in_img, num_samples=num_samples,
                                num_inference_steps=steps,
                                seed=seed,
-                               prompt=[prompt], negative_prompt=negative_prompt, scale=scale,
+                               prompt=prompt if isinstance(prompt, list) else [prompt], negative_prompt=negative_prompt, scale=scale,
                                image_encoder=image_encoder, guidance_scale=cfg,
                                image_processor=image_processor, boxes=boxes,
                                mask_threshold=mask_threshold,
@@ -852,16 +979,17 @@ def main_normal(prompt,pipe,phrases,ms_model,input_images,num_samples,steps,seed
                                phrases=phrases,
                                drop_grounding_tokens=drop_grounding_tokens,
                                phrase_idxes=phrase_idxes, eot_idxes=eot_idxes, height=height,
-                               width=width)
+                               width=width, image_embeds=image_embeds)
     return images
 def main_control(prompt,width,height,pipe,phrases,ms_model,input_images,num_samples,steps,seed,negative_prompt,scale,image_encoder,cfg,
-                 image_processor,boxes,mask_threshold,start_step,image_proj_type,image_encoder_type,drop_grounding_tokens,controlnet_scale,control_image,phrase_idxes, eot_idxes,in_img,use_repo):
+                 image_processor,boxes,mask_threshold,start_step,image_proj_type,image_encoder_type,drop_grounding_tokens,controlnet_scale,control_image,phrase_idxes, eot_idxes,in_img,use_repo,
+                 image_embeds=None):
     if use_repo:
         in_img=None
     images = ms_model.generate(pipe=pipe, pil_images=[input_images],processed_images=in_img, num_samples=num_samples,
                                num_inference_steps=steps,
                                seed=seed,
-                               prompt=[prompt], negative_prompt=negative_prompt, scale=scale,
+                               prompt=prompt if isinstance(prompt, list) else [prompt], negative_prompt=negative_prompt, scale=scale,
                                image_encoder=image_encoder, guidance_scale=cfg,
                                image_processor=image_processor, boxes=boxes,
                                mask_threshold=mask_threshold,
@@ -871,7 +999,7 @@ def main_control(prompt,width,height,pipe,phrases,ms_model,input_images,num_samp
                                phrases=phrases,
                                drop_grounding_tokens=drop_grounding_tokens,
                                phrase_idxes=phrase_idxes, eot_idxes=eot_idxes, height=height,
-                               width=width,
+                               width=width, image_embeds=image_embeds,
                                image=control_image, controlnet_conditioning_scale=controlnet_scale)
 
     return images
@@ -912,98 +1040,142 @@ def msdiffusion_main(image_1, image_2, prompts_dual, width, height, steps, seed,
     else:
         raise "no model"
     add_config = os.path.join(cur_path, "local_repo")
-    if _model_type=="img2img":
-        del pipe
-        gc.collect()
-        torch.cuda.empty_cache()
-        if single_files:
-            try:
-                pipe = StableDiffusionXLPipeline.from_single_file(
-                    ckpt_path, config=add_config, original_config=original_config_file,
-                    torch_dtype=torch.float16)
-            except:
+    # the controlnet,MSAdapter and clip vision are kept between runs with the same settings. txt2img builds on the
+    # story pipe,its stack lives on that pipe and goes with it,the story processors/scheduler/offload state are
+    # restored after sampling. img2img loads a second sdxl pipe,it is only kept with STORY_MS_CACHE=1
+    ms_key = (_model_type, get_file_stamp(ckpt_path), dif_repo, get_file_stamp(controlnet_path), lora,
+              get_file_stamp(lora_path), lora_scale, trigger_words, scheduler_choice.__name__, clip_vision)
+    story_pipe = pipe if _model_type == "txt2img" else None
+    if story_pipe is not None:
+        ms_stack = getattr(story_pipe, "ms_stacks", {}).get(ms_key)
+        story_state = (dict(story_pipe.unet.attn_processors), story_pipe.scheduler,
+                       hasattr(story_pipe.unet, "_hf_hook"))
+    else:
+        ms_stack = ms_cache.get(ms_key) if MS_CACHE else None
+    if ms_stack is None:
+        if _model_type=="img2img":
+            del pipe
+            gc.collect()
+            torch.cuda.empty_cache()
+            if single_files:
                 try:
                     pipe = StableDiffusionXLPipeline.from_single_file(
-                        ckpt_path, config=add_config, original_config_file=original_config_file,
+                        ckpt_path, config=add_config, original_config=original_config_file,
                         torch_dtype=torch.float16)
                 except:
-                    raise "load pipe error!,check you diffusers"
-        else:
-            pipe = StableDiffusionXLPipeline.from_pretrained(dif_repo, torch_dtype=torch.float16)
+                    try:
+                        pipe = StableDiffusionXLPipeline.from_single_file(
+                            ckpt_path, config=add_config, original_config_file=original_config_file,
+                            torch_dtype=torch.float16)
+                    except:
+                        raise "load pipe error!,check you diffusers"
+            else:
+                pipe = StableDiffusionXLPipeline.from_pretrained(dif_repo, torch_dtype=torch.float16)
     
     
-    if controlnet_path:
-        controlnet = ControlNetModel.from_unet(pipe.unet)
-        cn_state_dict = load_file(controlnet_path, device="cpu")
-        controlnet.load_state_dict(cn_state_dict, strict=False)
-        controlnet.to(torch.float16)
-        pipe = StableDiffusionXLControlNetPipeline.from_pipe(pipe, controlnet=controlnet)
-        del cn_state_dict
-        torch.cuda.empty_cache()
+        if controlnet_path:
+            controlnet = ControlNetModel.from_unet(pipe.unet)
+            cn_state_dict = load_file(controlnet_path, device="cpu")
+            controlnet.load_state_dict(cn_state_dict, strict=False)
+            controlnet.to(torch.float16)
+            pipe = StableDiffusionXLControlNetPipeline.from_pipe(pipe, controlnet=controlnet)
+            del cn_state_dict
+            torch.cuda.empty_cache()
     
-    if lora:
-        if lora in lora_lightning_list:
-            pipe.load_lora_weights(lora_path)
-            pipe.fuse_lora()
-        else:
-            pipe.load_lora_weights(lora_path, adapter_name=trigger_words)
-            pipe.fuse_lora(adapter_names=[trigger_words, ], lora_scale=lora_scale)
-    pipe.scheduler = scheduler_choice.from_config(pipe.scheduler.config)
-    pipe.enable_xformers_memory_efficient_attention()
-    pipe.enable_freeu(s1=0.6, s2=0.4, b1=1.1, b2=1.2)
-    pipe.enable_vae_slicing()
+        if lora and _model_type == "img2img":  # the story pipe of txt2img already has the lora fused
+            if lora in lora_lightning_list:
+                pipe.load_lora_weights(lora_path)
+                pipe.fuse_lora()
+            else:
+                pipe.load_lora_weights(lora_path, adapter_name=trigger_words)
+                pipe.fuse_lora(adapter_names=[trigger_words, ], lora_scale=lora_scale)
+        pipe.scheduler = scheduler_choice.from_config(pipe.scheduler.config)
+        pipe.enable_xformers_memory_efficient_attention()
+        pipe.enable_freeu(s1=0.6, s2=0.4, b1=1.1, b2=1.2)
+        pipe.enable_vae_slicing()
     
-    if device != "mps":
-        pipe.enable_model_cpu_offload()
+        if device != "mps":
+            pipe.enable_model_cpu_offload()
         
-    torch.cuda.empty_cache()
-    # 预加载 ms
-    photomaker_local_path = os.path.join(photomaker_dir, "ms_adapter.bin")
-    if not os.path.exists(photomaker_local_path):
-        ms_path = hf_hub_download(
-            repo_id="doge1516/MS-Diffusion",
-            filename="ms_adapter.bin",
-            repo_type="model",
-            local_dir=photomaker_dir,
-        )
-    else:
-        ms_path = photomaker_local_path
-    ms_ckpt = get_instance_path(ms_path)
-    image_processor = CLIPImageProcessor()
-    image_encoder_type = "clip"
-    image_encoder = clip_load(clip_vision)
-    from comfy.model_management import cleanup_models
-    try:
-        cleanup_models()
-    except:
+        torch.cuda.empty_cache()
+        # 预加载 ms
+        photomaker_local_path = os.path.join(photomaker_dir, "ms_adapter.bin")
+        if not os.path.exists(photomaker_local_path):
+            ms_path = hf_hub_download(
+                repo_id="doge1516/MS-Diffusion",
+                filename="ms_adapter.bin",
+                repo_type="model",
+                local_dir=photomaker_dir,
+            )
+        else:
+            ms_path = photomaker_local_path
+        ms_ckpt = get_instance_path(ms_path)
+        image_processor = CLIPImageProcessor()
+        image_encoder_type = "clip"
+        image_encoder = clip_load(clip_vision)
+        from comfy.model_management import cleanup_models
         try:
-            cleanup_models(keep_clone_weights_loaded=False)
+            cleanup_models()
         except:
-            gc.collect()
-            torch.cuda.empty_cache()
-    use_repo = False
-    config_path = os.path.join(cur_path, "config", "config.json")
-    image_encoder_config = OmegaConf.load(config_path)
-    image_encoder_projection_dim = image_encoder_config["vision_config"]["projection_dim"]
-    num_tokens = 16
-    image_proj_type = "resampler"
-    latent_init_mode = "grounding"
-    # latent_init_mode = "random"
-    image_proj_model = Resampler(
-        dim=1280,
-        depth=4,
-        dim_head=64,
-        heads=20,
-        num_queries=num_tokens,
-        embedding_dim=image_encoder_config["vision_config"]["hidden_size"],
-        output_dim=pipe.unet.config.cross_attention_dim,
-        ff_mult=4,
-        latent_init_mode=latent_init_mode,
-        phrase_embeddings_dim=pipe.text_encoder.config.projection_dim,
-    ).to(device, dtype=torch.float16)
-    ms_model = MSAdapter(pipe.unet, image_proj_model, ckpt_path=ms_ckpt, device=device, num_tokens=num_tokens)
-    ms_model.to(device, dtype=torch.float16)
-    torch.cuda.empty_cache()
+            try:
+                cleanup_models(keep_clone_weights_loaded=False)
+            except:
+                gc.collect()
+                torch.cuda.empty_cache()
+        use_repo = False
+        config_path = os.path.join(cur_path, "config", "config.json")
+        image_encoder_config = OmegaConf.load(config_path)
+        image_encoder_projection_dim = image_encoder_config["vision_config"]["projection_dim"]
+        num_tokens = 16
+        image_proj_type = "resampler"
+        latent_init_mode = "grounding"
+        # latent_init_mode = "random"
+        image_proj_model = Resampler(
+            dim=1280,
+            depth=4,
+            dim_head=64,
+            heads=20,
+            num_queries=num_tokens,
+            embedding_dim=image_encoder_config["vision_config"]["hidden_size"],
+            output_dim=pipe.unet.config.cross_attention_dim,
+            ff_mult=4,
+            latent_init_mode=latent_init_mode,
+            phrase_embeddings_dim=pipe.text_encoder.config.projection_dim,
+        ).to(device, dtype=torch.float16)
+        ms_model = MSAdapter(pipe.unet, image_proj_model, ckpt_path=ms_ckpt, device=device, num_tokens=num_tokens)
+        ms_model.to(device, dtype=torch.float16)
+        torch.cuda.empty_cache()
+        ms_stack = {"pipe": pipe, "ms_model": ms_model, "image_encoder": image_encoder,
+                    "image_processor": image_processor, "attn_procs": dict(pipe.unet.attn_processors),
+                    "image_embeds": OrderedDict()}
+        if story_pipe is not None:
+            story_pipe.ms_stacks = {ms_key: ms_stack}
+        elif MS_CACHE:
+            ms_cache.put(ms_key, ms_stack)
+    else:
+        logging.info("reuse the cached ms-diffusion adapter stack")
+        pipe, ms_model = ms_stack["pipe"], ms_stack["ms_model"]
+        image_encoder, image_processor = ms_stack["image_encoder"], ms_stack["image_processor"]
+        pipe.unet.set_attn_processor(dict(ms_stack["attn_procs"]))
+        if story_pipe is not None:
+            pipe.scheduler = scheduler_choice.from_config(pipe.scheduler.config)
+            if device != "mps":
+                pipe.enable_model_cpu_offload()
+        use_repo = False
+        num_tokens = 16
+        image_proj_type = "resampler"
+        image_encoder_type = "clip"
+    # clip vision embeds of the character pair,computed once per pair of reference images
+    embeds_key = hashlib.sha1(in_img.numpy().tobytes()).hexdigest()
+    image_embeds = ms_stack["image_embeds"].get(embeds_key)
+    if image_embeds is None:
+        image_embeds = ms_model.get_image_embeds(in_img, image_encoder, image_proj_type=image_proj_type,
+                                                 image_encoder_type=image_encoder_type, use_repo=use_repo)
+        ms_stack["image_embeds"][embeds_key] = image_embeds
+        while len(ms_stack["image_embeds"]) > 8:
+            ms_stack["image_embeds"].popitem(last=False)
+    else:
+        ms_stack["image_embeds"].move_to_end(embeds_key)
     input_images = [image_1, image_2]
     batch_size = 1
     guidance_list = guidance_list.strip().split(";")
@@ -1062,141 +1234,229 @@ def msdiffusion_main(image_1, image_2, prompts_dual, width, height, steps, seed,
     
     role_scale=guidance if guidance<=1 else guidance/10 if 1<guidance<=10 else guidance/100
     
-    if controlnet_path:
-        d1, _, _, _ = control_image.size()
-        if d1 == 1:
-            control_img_list = [control_image]
+    # used to get the attention map, return zero if the phrase is not in the prompt
+    phrase_idxes = [get_phrases_idx(pipe.tokenizer, phrases[0], prompt) for prompt in prompts_dual]
+    eot_idxes = [[get_eot_idx(pipe.tokenizer, prompt)] * len(phrases[0]) for prompt in prompts_dual]
+    # every dual prompt is sampled in one batch
+    try:
+        if controlnet_path:
+            d1, _, _, _ = control_image.size()
+            if d1 == 1:
+                control_img_list = [control_image]
+            else:
+                control_img_list = torch.chunk(control_image, chunks=d1)
+            control_images = [nomarl_upscale(control_img_list[i], width, height) for i in range(len(prompts_dual))]
+            image_ouput = main_control(prompts_dual, width, height, pipe, phrases, ms_model, input_images, batch_size,
+                                       steps,
+                                       seed, negative_prompt, role_scale, image_encoder, cfg,
+                                       image_processor, boxes, mask_threshold, start_step, image_proj_type,
+                                       image_encoder_type, drop_grounding_tokens, controlnet_scale, control_images,
+                                       phrase_idxes, eot_idxes, in_img, use_repo, image_embeds=image_embeds)
         else:
-            control_img_list = torch.chunk(control_image, chunks=d1)
-        j = 0
-        for i, prompt in enumerate(prompts_dual):
-            control_image = control_img_list[j]
-            control_image = nomarl_upscale(control_image, width, height)
-            j += 1
-            # used to get the attention map, return zero if the phrase is not in the prompt
-            phrase_idxes = [get_phrases_idx(pipe.tokenizer, phrases[0], prompt)]
-            eot_idxes = [[get_eot_idx(pipe.tokenizer, prompt)] * len(phrases[0])]
-            # print(phrase_idxes, eot_idxes)
-            image_main = main_control(prompt, width, height, pipe, phrases, ms_model, input_images, batch_size,
-                                      steps,
-                                      seed, negative_prompt, role_scale, image_encoder, cfg,
-                                      image_processor, boxes, mask_threshold, start_step, image_proj_type,
-                                      image_encoder_type, drop_grounding_tokens, controlnet_scale, control_image,
-                                      phrase_idxes, eot_idxes, in_img, use_repo)
-            
-            image_ouput.append(image_main)
-            torch.cuda.empty_cache()
-    else:
-        for i, prompt in enumerate(prompts_dual):
-            # used to get the attention map, return zero if the phrase is not in the prompt
-            phrase_idxes = [get_phrases_idx(pipe.tokenizer, phrases[0], prompt)]
-            eot_idxes = [[get_eot_idx(pipe.tokenizer, prompt)] * len(phrases[0])]
-            # print(phrase_idxes, eot_idxes)
-            image_main = main_normal(prompt, pipe, phrases, ms_model, input_images, batch_size, steps, seed,
-                                     negative_prompt, role_scale, image_encoder, cfg, image_processor,
-                                     boxes, mask_threshold, start_step, image_proj_type, image_encoder_type,
-                                     drop_grounding_tokens, height, width, phrase_idxes, eot_idxes, in_img, use_repo)
-            image_ouput.append(image_main)
-            torch.cuda.empty_cache()
+            image_ouput = main_normal(prompts_dual, pipe, phrases, ms_model, input_images, batch_size, steps, seed,
+                                      negative_prompt, role_scale, image_encoder, cfg, image_processor,
+                                      boxes, mask_threshold, start_step, image_proj_type, image_encoder_type,
+                                      drop_grounding_tokens, height, width, phrase_idxes, eot_idxes, in_img, use_repo,
+                                      image_embeds=image_embeds)
+    finally:
+        if story_pipe is not None:
+            # hand the story pipe back as the story sampler left it
+            story_procs, story_scheduler, story_offloaded = story_state
+            story_pipe.unet.set_attn_processor(story_procs)
+            story_pipe.scheduler = story_scheduler
+            if not story_offloaded and hasattr(pipe, "remove_all_hooks"):
+                pipe.remove_all_hooks()
+    torch.cuda.empty_cache()
     pipe.to("cpu")
     torch.cuda.empty_cache()
     return image_ouput
 
 
-def get_insight_dict(app_face,pipeline_mask,app_face_,image_load,photomake_mode,kolor_face,story_maker,make_dual_only,
-                     pulid,pipe,character_list_,condition_image,width, height,use_storydif,use_inf=None,image_proj_model=None):
+def get_face_mode(photomake_mode,kolor_face,story_maker,make_dual_only,pulid,use_storydif,use_inf=None,auraface=False):
+    # which face models get_insight_dict runs,also the face cache namespace
+    if photomake_mode == "v2" and use_storydif and not story_maker:
+        return "v2_aura" if auraface else "v2"
+    elif kolor_face:
+        return "kolor_face"
+    elif story_maker:
+        if make_dual_only and photomake_mode == "v2" and use_storydif:
+            return "story_maker_v2_aura" if auraface else "story_maker_v2"
+        return "story_maker"
+    elif pulid:
+        return "pulid"
+    elif use_inf:
+        return "inf"
+    return None
+
+
+def get_max_face(face_info):
+    return sorted(face_info, key=lambda x: (x['bbox'][2] - x['bbox'][0]) * (x['bbox'][3] - x['bbox'][1]))[-1]  # only use the maximum face
+
+
+def face_to_record(face, record):
+    # insightface Face is a dict of arrays/scalars,keep them as face_* arrays
+    for k, v in face.items():
+        record[f"face_{k}"] = np.asarray(v)
+    return record
+
+
+def record_to_face(record):
+    from insightface.app.common import Face
+    return Face({k[5:]: (v.item() if v.ndim == 0 else v) for k, v in record.items() if k.startswith("face_")})
+
+
+def analyze_face_record(img, face_mode, get_face_models, pipe):
+    """
+    run the face models of face_mode on one reference image,everything is returned as numpy arrays for the face cache.
+    insightface modes are batched in analyze_face_records.
+    """
+    if face_mode == "kolor_face":
+        app_face, _, _ = get_face_models()
+        face_info = app_face.get_faceinfo_one_img(img)
+        return {"embedding": np.asarray(face_info["embedding"]), "bbox": np.asarray(face_info["bbox"])}
+    elif face_mode == "pulid":
+        id_image = resize_numpy_image_long(img, 1024)
+        use_true_cfg = abs(1.0 - 1.0) > 1e-2
+        id_embeddings, uncond_id_embeddings = pipe.pulid_model.get_id_embedding(id_image, cal_uncond=use_true_cfg)
+        record = {"id_embedding": id_embeddings.float().cpu().numpy()}
+        if uncond_id_embeddings is not None:
+            record["uncond_id_embedding"] = uncond_id_embeddings.float().cpu().numpy()
+        return record
+    return {}
+
+
+def analyze_face_records(imgs, face_mode, get_face_models, pipe):
+    """
+    analyze_face_record over all reference (or control) images at once,insightface modes detect through one
+    reused BGR buffer and embed every face in one batched call,other modes run image by image.
+    """
+    if face_mode in ("v2", "v2_aura"):
+        from .utils.insightface_package import analyze_faces_batch
+        app_face, _, _ = get_face_models()
+        return [{"embedding": np.asarray(faces[0]['embedding'])} for faces in analyze_faces_batch(app_face, imgs)]
+    elif face_mode in ("story_maker_v2", "story_maker_v2_aura"):
+        from .utils.insightface_package import analyze_faces_batch, get_faces_batch
+        app_face, pipeline_mask, app_face_ = get_face_models()
+        faces_list = analyze_faces_batch(app_face, imgs)
+        faces_list_ = get_faces_batch(app_face_, imgs, convert=False)  # same as the unbatched path,which converts twice
+        records = []
+        for img, faces, face_info in zip(imgs, faces_list, faces_list_):
+            crop_image = pipeline_mask(cv2.cvtColor(np.array(img), cv2.COLOR_RGB2BGR), return_mask=True).convert('RGB')
+            record = {"embedding": np.asarray(faces[0]['embedding']), "mask": np.array(crop_image)}
+            records.append(face_to_record(get_max_face(face_info), record))
+        return records
+    elif face_mode == "story_maker":
+        from .utils.insightface_package import get_faces_batch
+        app_face, pipeline_mask, _ = get_face_models()
+        faces_list = get_faces_batch(app_face, imgs)
+        return [face_to_record(get_max_face(face_info), {"mask": np.array(pipeline_mask(img, return_mask=True).convert('RGB'))})
+                for img, face_info in zip(imgs, faces_list)]
+    elif face_mode == "inf":
+        from .utils.insightface_package import get_faces_batch
+        from insightface.utils import face_align
+        app_face, _, app_face_ = get_face_models()
+        print('Preparing ID embeddings')
+        arc_face_images = []
+        
+        def crop_max_face(id_image_cv2, face_info):
+            if len(face_info) == 0:
+                raise ValueError('No face detected in the input ID image')
+            landmark = get_max_face(face_info)['kps']
+            arc_face_images.append(face_align.norm_crop(id_image_cv2, landmark=np.array(landmark), image_size=112))
+        
+        get_faces_batch(app_face, imgs, on_image=crop_max_face)
+        # extract_arcface_bgr_embedding of every image in one forward
+        arc_face_images = torch.from_numpy(np.stack(arc_face_images)).permute(0, 3, 1, 2) / 255.
+        arc_face_images = (2 * arc_face_images - 1).cuda().contiguous()
+        with torch.no_grad():
+            id_embeds = app_face_(arc_face_images)
+        return [{"arcface": id_embed.float().cpu().numpy()} for id_embed in id_embeds]
+    elif face_mode == "inf_kps":
+        from .utils.insightface_package import get_faces_batch
+        app_face, _, _ = get_face_models()
+        records = []
+        for face_info in get_faces_batch(app_face, imgs, recognize=False):
+            if len(face_info) == 0:
+                raise ValueError('No face detected in the control image')
+            records.append({"kps": np.asarray(get_max_face(face_info)['kps'])})
+        return records
+    return [analyze_face_record(img, face_mode, get_face_models, pipe) for img in imgs]
+
+
+def get_insight_dict(face_loader,image_load,photomake_mode,kolor_face,story_maker,make_dual_only,
+                     pulid,pipe,character_list_,condition_image,width, height,use_storydif,use_inf=None,image_proj_model=None,
+                     auraface=False):
+    """
+    face_loader returns (app_face,pipeline_mask,app_face_),it is only called when an image misses the face cache.
+    """
     input_id_emb_s_dict = {}
     input_id_img_s_dict = {}
     input_id_emb_un_dict = {}
+    face_mode = get_face_mode(photomake_mode, kolor_face, story_maker, make_dual_only, pulid, use_storydif, use_inf, auraface)
+    face_models = []
+    
+    def get_face_models():
+        if not face_models:
+            face_models.extend(face_loader())
+        return face_models
+    
+    def get_face_records(imgs, mode):
+        # cached records come from disk,the misses go through the face models in one batch
+        records = [face_cache.get(img, mode) for img in imgs]
+        misses = [i for i, record in enumerate(records) if record is None]
+        if misses:
+            for i, record in zip(misses, analyze_face_records([imgs[i] for i in misses], mode, get_face_models, pipe)):
+                face_cache.put(imgs[i], mode, record)
+                records[i] = record
+        return records
+    
+    records = get_face_records(image_load, face_mode) if face_mode else [{} for _ in image_load]
+    if face_mode == "inf" and isinstance(condition_image, torch.Tensor):
+        e1, _, _, _ = condition_image.size()
+        if e1 == 1:
+            cn_image_load = [nomarl_upscale(condition_image, width, height)]
+        else:
+            img_list = list(torch.chunk(condition_image, chunks=e1))
+            cn_image_load = [nomarl_upscale(img, width, height) for img in img_list]
+        kps_records = get_face_records(cn_image_load[:len(image_load)], "inf_kps")  #need check
+    
     for ind, img in enumerate(image_load):
-        if photomake_mode == "v2" and use_storydif and not story_maker:
-            from .utils.insightface_package import analyze_faces
-            img = np.array(img)
-            img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
-            faces = analyze_faces(app_face, img, )
-            id_embed_list = torch.from_numpy((faces[0]['embedding']))
-            crop_image = img
+        record = records[ind]
+        if face_mode in ("v2", "v2_aura"):
+            id_embed_list = torch.from_numpy(record['embedding'])
+            crop_image = cv2.cvtColor(np.array(img), cv2.COLOR_RGB2BGR)
             uncond_id_embeddings = None
-        elif kolor_face:
+        elif face_mode == "kolor_face":
             device = (
                 "cuda"
                 if torch.cuda.is_available()
                 else "mps" if torch.backends.mps.is_available() else "cpu"
             )
-            face_info = app_face.get_faceinfo_one_img(img)
-            face_bbox_square = face_bbox_to_square(face_info["bbox"])
+            face_bbox_square = face_bbox_to_square(record["bbox"])
             crop_image = img.crop(face_bbox_square)
             crop_image = crop_image.resize((336, 336))
-            face_embeds = torch.from_numpy(np.array([face_info["embedding"]]))
+            face_embeds = torch.from_numpy(np.array([record["embedding"]]))
             id_embed_list = face_embeds.to(device, dtype=torch.float16)
             uncond_id_embeddings = None
-        elif story_maker:
-            if make_dual_only:  # 前段用story 双人用maker
-                if photomake_mode == "v2" and use_storydif:
-                    from .utils.insightface_package import analyze_faces
-                    img = np.array(img)
-                    img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
-                    faces = analyze_faces(app_face, img, )
-                    id_embed_list = torch.from_numpy((faces[0]['embedding']))
-                    crop_image = pipeline_mask(img, return_mask=True).convert(
-                        'RGB')  # outputs a pillow mask
-                    face_info = app_face_.get(cv2.cvtColor(np.array(img), cv2.COLOR_RGB2BGR))
-                    uncond_id_embeddings = \
-                        sorted(face_info,
-                               key=lambda x: (x['bbox'][2] - x['bbox'][0]) * (x['bbox'][3] - x['bbox'][1]))[
-                            -1]  # only use the maximum face
-                    photomake_mode = "v2"
-                    # make+v2模式下，emb存v2的向量，corp 和 unemb 存make的向量
-                else:  # V1不需要调用emb
-                    crop_image = pipeline_mask(img, return_mask=True).convert(
-                        'RGB')  # outputs a pillow mask
-                    face_info = app_face.get(cv2.cvtColor(np.array(img), cv2.COLOR_RGB2BGR))
-                    id_embed_list = \
-                        sorted(face_info,
-                               key=lambda x: (x['bbox'][2] - x['bbox'][0]) * (x['bbox'][3] - x['bbox'][1]))[
-                            -1]  # only use the maximum face
-                    uncond_id_embeddings = None
-            else:  # 全程用maker
-                crop_image = pipeline_mask(img, return_mask=True).convert('RGB')  # outputs a pillow mask
-                # timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
-                # crop_image.copy().save(os.path.join(folder_paths.get_output_directory(),f"{timestamp}_mask.png"))
-                face_info = app_face.get(cv2.cvtColor(np.array(img), cv2.COLOR_RGB2BGR))
-                id_embed_list = \
-                    sorted(face_info,
-                           key=lambda x: (x['bbox'][2] - x['bbox'][0]) * (x['bbox'][3] - x['bbox'][1]))[
-                        -1]  # only use the maximum face
-                
-                uncond_id_embeddings = None
-        elif pulid:
-            id_image = resize_numpy_image_long(img, 1024)
-            use_true_cfg = abs(1.0 - 1.0) > 1e-2
-            id_embed_list, uncond_id_embeddings = pipe.pulid_model.get_id_embedding(id_image,
-                                                                                    cal_uncond=use_true_cfg)
+        elif face_mode in ("story_maker_v2", "story_maker_v2_aura"):
+            id_embed_list = torch.from_numpy(record['embedding'])
+            crop_image = Image.fromarray(record["mask"])
+            uncond_id_embeddings = record_to_face(record)
+            photomake_mode = "v2"
+        elif face_mode == "story_maker":  # V1不需要调用emb
+            crop_image = Image.fromarray(record["mask"])
+            id_embed_list = record_to_face(record)
+            uncond_id_embeddings = None
+        elif face_mode == "pulid":
+            pulid_model = pipe.pulid_model
+            id_embed_list = torch.from_numpy(record["id_embedding"]).to(pulid_model.device, pulid_model.weight_dtype)
+            uncond_id_embeddings = None
+            if "uncond_id_embedding" in record:
+                uncond_id_embeddings = torch.from_numpy(record["uncond_id_embedding"]).to(pulid_model.device, pulid_model.weight_dtype)
             crop_image = img
-
-        elif use_inf:
-            def _detect_face(app_face, id_image_cv2):
-                    face_info = app_face.get(id_image_cv2)
-                    if len(face_info) > 0:
-                        return face_info
-                    # face_info = app_320.get(id_image_cv2)
-                    # if len(face_info) > 0:
-                    #     return face_info
-
-                    # face_info = app_160.get(id_image_cv2)
-                    # return face_info
-            from .pipelines.pipeline_infu_flux import extract_arcface_bgr_embedding,resize_and_pad_image,draw_kps
-             # Extract ID embeddings
-            print('Preparing ID embeddings')
-            id_image_cv2 = cv2.cvtColor(np.array(img), cv2.COLOR_RGB2BGR)
-            face_info = _detect_face(app_face,id_image_cv2)
-            if len(face_info) == 0:
-                raise ValueError('No face detected in the input ID image')
-            
-            face_info = sorted(face_info, key=lambda x:(x['bbox'][2]-x['bbox'][0])*(x['bbox'][3]-x['bbox'][1]))[-1] # only use the maximum face
-            landmark = face_info['kps']
-            id_embed = extract_arcface_bgr_embedding(id_image_cv2, landmark, app_face_)
-            id_embed = id_embed.clone().unsqueeze(0).float().cuda()
+        elif face_mode == "inf":
+            from .pipelines.pipeline_infu_flux import draw_kps
+            id_embed = torch.from_numpy(record["arcface"]).unsqueeze(0).float().cuda()
             id_embed = id_embed.reshape([1, -1, 512])
             id_embed = id_embed.to(device='cuda', dtype=torch.bfloat16)
             with torch.no_grad():
@@ -1209,25 +1469,13 @@ def get_insight_dict(app_face,pipeline_mask,app_face_,image_load,photomake_mode,
             # Load control image
             print('Preparing the control image')
             if isinstance(condition_image, torch.Tensor):
-                e1, _, _, _ = condition_image.size()
-                if e1 == 1:
-                    cn_image_load = [nomarl_upscale(condition_image, width, height)]
-                else:
-                    img_list = list(torch.chunk(condition_image, chunks=e1))
-                    cn_image_load = [nomarl_upscale(img, width, height) for img in img_list]
-                # control_image = control_image.convert("RGB")
-                # control_image = resize_and_pad_image(control_image, (width, height))
-                face_info = _detect_face(app_face,cv2.cvtColor(np.array(cn_image_load[ind]), cv2.COLOR_RGB2BGR)) #need check 
-                if len(face_info) == 0:
-                    raise ValueError('No face detected in the control image')
-                face_info = sorted(face_info, key=lambda x:(x['bbox'][2]-x['bbox'][0])*(x['bbox'][3]-x['bbox'][1]))[-1] # only use the maximum face
-                control_image = draw_kps(control_image, face_info['kps'])
+                control_image = draw_kps(cn_image_load[ind], kps_records[ind]["kps"])
             else:
                 out_img = np.zeros([height, width, 3])
                 control_image = Image.fromarray(out_img.astype(np.uint8))
             id_embed_list=id_embed
             crop_image = control_image  # inf use crop to control img
-            uncond_id_embeddings = None 
+            uncond_id_embeddings = None
         else:
             id_embed_list = None
             uncond_id_embeddings = None
@@ -1236,14 +1484,9 @@ def get_insight_dict(app_face,pipeline_mask,app_face_,image_load,photomake_mode,
         input_id_emb_s_dict[character_list_[ind]] = [id_embed_list]
         input_id_emb_un_dict[character_list_[ind]] = [uncond_id_embeddings]
     
-    if story_maker or kolor_face or (photomake_mode == "v2" and use_storydif):
-        del app_face
-        torch.cuda.empty_cache()
-    if story_maker:
-        del pipeline_mask
-        torch.cuda.empty_cache()
-    if use_inf:
-        del app_face,app_face_
+    if face_models:
+        face_models.clear()
+        face_pool.release()  # keep,park or drop the face models by STORY_FACE_POOL
         torch.cuda.empty_cache()
 
     if isinstance(condition_image, torch.Tensor) and story_maker:
@@ -1446,6 +1689,22 @@ class SD35Wrapper():
             torch_dtype=torch.bfloat16,
         )
         self.pipe.vae=self.ae if not self.cf_vae else None
+        self.in_session=False
+        
+    def begin_session(self, prompts, negative_prompts=()):
+        # encode every panel prompt now (kept in prompt_cache) and keep the transformer loaded until end_session,
+        # the negative embeds are zeros,so negative_prompts need no encoding
+        prompts = list(dict.fromkeys(prompts))
+        if prompts:
+            self.clip_prompt(prompts, None)
+        if self.cf_vae:
+            comfy.model_management.load_models_gpu([self.ae.patcher])
+        self.in_session=True
+        
+    def end_session(self):
+        if self.in_session:
+            self.in_session=False
+            self.pipe.maybe_free_model_hooks()
         
     def encode(self,  clip_l, clip_g, t5xxl):
         no_padding = True
@@ -1472,6 +1731,12 @@ class SD35Wrapper():
         cond, pooled = self.clip.encode_from_tokens(tokens, return_pooled=True)
         return [[cond, {"pooled_output": pooled}]]
 
+    def encode_to_device(self, clip_l, clip_g, t5xxl):
+        out = self.encode(clip_l, clip_g, t5xxl)
+        prompt_embeds = out[0][0]
+        pooled_prompt_embeds = out[0][1].get("pooled_output", None)
+        return prompt_embeds.to(device, dtype=torch.bfloat16), pooled_prompt_embeds.to(device, dtype=torch.bfloat16)
+
     def clip_prompt(self,prompt,negative_prompt):
         if isinstance(prompt,str):
             text=[prompt]
@@ -1496,11 +1761,10 @@ class SD35Wrapper():
                 clip_g = ii
                 t5xxl = ii
                 
-                out = self.encode(clip_l, clip_g, t5xxl)
-                prompt_embeds = out[0][0]
-                pooled_prompt_embeds = out[0][1].get("pooled_output", None)
-                emb_e.append(prompt_embeds.to(device, dtype=torch.bfloat16))
-                emb_e_pool.append(pooled_prompt_embeds.to(device, dtype=torch.bfloat16))
+                prompt_embeds, pooled_prompt_embeds = prompt_cache.get_or_encode(
+                    self.clip, ("sd35", clip_l, clip_g, t5xxl), lambda: self.encode_to_device(clip_l, clip_g, t5xxl))
+                emb_e.append(prompt_embeds)
+                emb_e_pool.append(pooled_prompt_embeds)
             emb_e=torch.cat(emb_e,dim=0)
             emb_e_pool = torch.cat(emb_e_pool, dim=0)
             emb_n_pool=torch.zeros_like(emb_e_pool)
@@ -1552,7 +1816,8 @@ class SD35Wrapper():
         else:
             img_pil = latents_out
      
-        self.pipe.maybe_free_model_hooks()
+        if not self.in_session:
+            self.pipe.maybe_free_model_hooks()
         return img_pil
 
 
@@ -136,18 +136,30 @@ class MSAdapter(torch.nn.Module):
                 attn_processor.need_text_attention_map = True
                 attn_processor.attention_maps = []  # clear attention maps
     
+    def disable_psuedo_attention_mask(self):
+        # a cached adapter may still have the mask of an earlier run enabled
+        for attn_processor in self.pipe.unet.attn_processors.values():
+            if isinstance(attn_processor, IPAttnProcessor):
+                attn_processor.use_psuedo_attention_mask = False
+                attn_processor.need_text_attention_map = False
+                attn_processor.attention_maps = []
+    
     def generate(self, pipe, pil_images=None, processed_images=None, prompt=None, negative_prompt=None, scale=1.0,
                  num_samples=4, seed=None, guidance_scale=7.5, num_inference_steps=50, image_processor=None,
                  image_encoder=None, image_proj_type="linear", image_encoder_type="clip", weight_dtype=torch.float16,
                  boxes=None, phrases=None, drop_grounding_tokens=None, phrase_idxes=None,
                  eot_idxes=None, height=1024, width=1024, subject_scales=None, mask_threshold=None, start_step=5,
-                 use_repo=None,
+                 use_repo=None, image_embeds=None,
                  **kwargs):
         # generate images (validation&inference)
+        # a list of prompts shares the reference images and is sampled as one batch,
+        # image_embeds are the precomputed encoder outputs of processed_images
         self.pipe = pipe
         self.set_scale(scale, subject_scales)
         if mask_threshold is not None:
             self.enable_psuedo_attention_mask(mask_threshold, start_step)
+        else:
+            self.disable_psuedo_attention_mask()
         
         # pil_images: [[xxx, xxx, xxx], [xxx, xxx, xxx], ...]
         bsz = len(pil_images)  # only support bsz=1 now
@@ -160,7 +172,7 @@ class MSAdapter(torch.nn.Module):
                     processed_images.append(processed_image)
                 processed_images = torch.stack(processed_images, dim=0)
        
-        num_prompts = bsz
+        num_prompts = len(prompt) if isinstance(prompt, List) else bsz
         if prompt is None:
             prompt = "best quality, high quality"
         if negative_prompt is None:
@@ -192,7 +204,7 @@ class MSAdapter(torch.nn.Module):
                                     "drop_grounding_tokens": drop_grounding_tokens}
             else:
                 grounding_kwargs = None
-            boxes = torch.repeat_interleave(boxes, repeats=num_samples, dim=0)
+            boxes = torch.repeat_interleave(boxes, repeats=num_samples * num_prompts // bsz, dim=0)
             uncond_boxes = torch.zeros_like(boxes)
             boxes = torch.cat([uncond_boxes, boxes], dim=0)
             cross_attention_kwargs = {"boxes": boxes}
@@ -214,9 +226,10 @@ class MSAdapter(torch.nn.Module):
         
         with (torch.inference_mode()):
             #print(processed_images.shape)
-            image_embeds = self.get_image_embeds(processed_images, image_encoder, image_proj_type=image_proj_type,
-                                                 image_encoder_type=image_encoder_type, weight_dtype=weight_dtype,
-                                                 use_repo=use_repo)
+            if image_embeds is None:
+                image_embeds = self.get_image_embeds(processed_images, image_encoder, image_proj_type=image_proj_type,
+                                                     image_encoder_type=image_encoder_type, weight_dtype=weight_dtype,
+                                                     use_repo=use_repo)
             del image_encoder
             torch.cuda.empty_cache()
             # print(image_embeds.shape) #torch.Size([1, 257, 1664])
@@ -235,7 +248,9 @@ class MSAdapter(torch.nn.Module):
                                                                -2],
                                                            image_prompt_embeds.shape[
                                                                -1])  # (bsz, total_num_tokens*rn, cross_attention_dim)
-            image_prompt_embeds = torch.cat([self.dummy_image_tokens, image_prompt_embeds], dim=1)
+            image_prompt_embeds = torch.cat([self.dummy_image_tokens.expand(bsz, -1, -1), image_prompt_embeds], dim=1)
+            # every prompt of the batch uses the same reference images
+            image_prompt_embeds = torch.repeat_interleave(image_prompt_embeds, repeats=num_prompts // bsz, dim=0)
             uncond_image_prompt_embeds = torch.zeros_like(image_prompt_embeds)
             bs_embed, seq_len, _ = image_prompt_embeds.shape
             image_prompt_embeds = image_prompt_embeds.repeat(1, num_samples, 1)
@@ -253,7 +268,9 @@ class MSAdapter(torch.nn.Module):
             prompt_embeds = torch.cat([prompt_embeds_, image_prompt_embeds], dim=1)
             negative_prompt_embeds = torch.cat([negative_prompt_embeds_, uncond_image_prompt_embeds], dim=1)
         
-        generator = torch.Generator(self.device).manual_seed(seed) if seed is not None else None
+        # one generator per image,so each prompt starts from the same noise as when sampled alone
+        generator = [torch.Generator(self.device).manual_seed(seed) for _ in range(num_prompts * num_samples)] \
+            if seed is not None else None
         
         images = pipe(
             prompt_embeds=prompt_embeds,
@@ -0,0 +1,50 @@
+import importlib
+import importlib.util
+import os
+import sys
+import types
+
+import pytest
+
+torch = pytest.importorskip("torch")
+# the node module imports comfy and folder_paths,so it only runs inside a ComfyUI environment
+pytest.importorskip("folder_paths")
+pytest.importorskip("comfy")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE = "comfyui_storydiffusion"
+
+
+def load_node_module():
+    # import the custom node as a package without running its __init__ (which registers every node)
+    if PACKAGE not in sys.modules:
+        spec = importlib.util.spec_from_file_location(PACKAGE, os.path.join(ROOT, "__init__.py"),
+                                                      submodule_search_locations=[ROOT])
+        sys.modules[PACKAGE] = importlib.util.module_from_spec(spec)
+    return importlib.import_module(f"{PACKAGE}.Storydiffusion_node")
+
+
+def test_write_pass_after_library_reuse(tmp_path):
+    node = load_node_module()
+    processor = node.SpatialAttnProcessor2_0(id_length=1)
+    unet = types.SimpleNamespace(
+        attn_processors={"up_blocks.0.attentions.0.transformer_blocks.0.attn1.processor": processor},
+        device=torch.device("cpu"), dtype=torch.float32)
+
+    first = torch.randn(2, 4, 8)
+    for step in range(3):
+        processor.get_write_bank("[A]", 3, 4, 8, unet.device, unet.dtype).set(step, first + step)
+    path = str(tmp_path / "A.safetensors")
+    node.save_single_character_weights(unet, "[A]", "a woman", path)
+
+    # reuse: the bank is read from the library file
+    node.load_single_character_weights(unet, path)
+    assert isinstance(processor.id_bank["[A]"], node.LazyIdBank)
+    assert torch.equal(processor.id_bank["[A]"].get(1), first + 1)
+    assert torch.equal(processor.id_bank["[A]"].get(5), first + 2)  # longer runs reuse the last saved step
+
+    # miss: a later run with another seed writes the character again on the same unet
+    second = torch.randn(2, 4, 8)
+    processor.get_write_bank("[A]", 3, 4, 8, unet.device, unet.dtype).set(0, second)
+    assert isinstance(processor.id_bank["[A]"], node.IdBank)
+    assert torch.equal(processor.id_bank["[A]"].get(0), second)
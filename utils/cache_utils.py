@@ -0,0 +1,697 @@
+# !/usr/bin/env python
+# -*- coding: UTF-8 -*-
+import functools
+import gc
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+# pipeline cache budget in GB (RAM+VRAM of every cached pipe),0 means only keep the latest pipe
+PIPE_CACHE_GB = float(os.getenv("STORY_PIPE_CACHE_GB", "0"))
+# set 1 to also keep the separate sdxl pipe of ms-diffusion img2img between runs (RAM of a second sdxl pipe)
+MS_CACHE = os.getenv("STORY_MS_CACHE", "0") != "0"
+# seconds a cached pipe may stay unused before it is dropped,0 keeps it until evicted or unloaded
+PIPE_CACHE_IDLE = float(os.getenv("STORY_PIPE_CACHE_IDLE", "900"))
+# how many encoded prompts are kept,0 disables the prompt cache
+PROMPT_CACHE_SIZE = int(os.getenv("STORY_PROMPT_CACHE_SIZE", "128"))
+# MB of cpu RAM the encoded prompts may take (a t5 prompt is several MB,a clip one a few hundred KB)
+PROMPT_CACHE_MB = float(os.getenv("STORY_PROMPT_CACHE_MB", "512"))
+# set 0 to always rerun the face models on the reference images
+FACE_CACHE = os.getenv("STORY_FACE_CACHE", "1") != "0"
+# face models after a run: "gpu" keep as loaded,"cpu" park torch modules on cpu,"evict" drop them
+FACE_POOL_POLICY = os.getenv("STORY_FACE_POOL", "cpu").lower()
+# seconds a pooled face model may stay unused before it is dropped
+FACE_POOL_IDLE = float(os.getenv("STORY_FACE_POOL_IDLE", "600"))
+# threads that download/read checkpoints ahead of the loader,0 disables the prefetch
+PREFETCH_WORKERS = int(os.getenv("STORY_PREFETCH_WORKERS", "4"))
+# files bigger than this (GB) are not read ahead,they would only push the others out of the page cache
+PREFETCH_MAX_GB = float(os.getenv("STORY_PREFETCH_MAX_GB", "24"))
+# set 0 to quantize flux/sd3.5 weights (nf4/qfloat8) on every load instead of reusing the saved quantized copy
+QUANT_CACHE = os.getenv("STORY_QUANT_CACHE", "1") != "0"
+# set 1 to save the consistory anchors of a character (several GB per file) and reuse them in later runs
+ANCHOR_CACHE = os.getenv("STORY_ANCHOR_CACHE", "0") != "0"
+
+
+def get_file_stamp(path):
+    # path + mtime,so a rewritten ckpt/lora with same name is not hit
+    if path and os.path.isfile(path):
+        return (path, os.path.getmtime(path))
+    return (path, None)
+
+
+def get_obj_key(obj):
+    # comfyUI model/clip/vae objects are kept alive by the cache entry,so id() is stable while cached
+    if obj is None:
+        return None
+    if isinstance(obj, dict):
+        return tuple(sorted((k, str(v)) for k, v in obj.items()))
+    return id(obj)
+
+
+prefetch_pool = ThreadPoolExecutor(max_workers=max(PREFETCH_WORKERS, 1), thread_name_prefix="story_prefetch")
+_prefetching = {}  # path:future
+
+
+def warm_file(path, chunk_mb=64):
+    # read the file once,so the torch.load/safetensors load of the loader hits the page cache
+    with open(path, "rb", buffering=0) as f:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        buffer = memoryview(bytearray(chunk_mb * 1024 ** 2))
+        total = 0
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            total += n
+    return total
+
+
+def get_weight_files(path):
+    # a checkpoint file or every weight file of a diffusers/hf repo dir
+    if not path or not isinstance(path, str):
+        return []
+    if os.path.isfile(path):
+        return [path]
+    files = []
+    if os.path.isdir(path):
+        for root, _, names in os.walk(path):
+            files += [os.path.join(root, name) for name in names
+                      if name.endswith((".safetensors", ".bin", ".pt", ".pth", ".ckpt", ".gguf"))]
+    return files
+
+
+def prefetch_files(paths):
+    """
+    read every weight file of paths concurrently in prefetch_pool and return at once,
+    so the page cache is warm by the time the pipeline being built loads them.
+    """
+    if PREFETCH_WORKERS <= 0:
+        return []
+    futures = []
+    for path in dict.fromkeys(f for p in paths for f in get_weight_files(p)):
+        future = _prefetching.get(path)
+        if future is not None and not future.done():
+            continue
+        if os.path.getsize(path) > PREFETCH_MAX_GB * 1024 ** 3:
+            continue
+        future = prefetch_pool.submit(warm_file, path)
+        future.add_done_callback(lambda f, path=path: _prefetching.pop(path, None))
+        _prefetching[path] = future
+        futures.append(future)
+    if futures:
+        logging.info(f"prefetch {len(futures)} checkpoint files in background")
+    return futures
+
+
+def get_hash_key(*items):
+    # stable across sessions,so only pass paths/strings/numbers,never id() of live objects
+    return hashlib.sha1(json.dumps(items, default=str).encode("utf-8")).hexdigest()
+
+
+def get_module_bytes(obj, depth=2, _seen=None):
+    """
+    sum the bytes of parameters and buffers of every torch module reachable from a pipe,
+    diffusers pipelines are walked by components,wrappers (FluxGenerator,SD35Wrapper...) by attributes.
+    """
+    if _seen is None:
+        _seen = set()
+    if obj is None or id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+    if isinstance(obj, torch.nn.Module):
+        total = 0
+        for tensor in list(obj.parameters()) + list(obj.buffers()):
+            if id(tensor) in _seen or tensor.device.type == "meta":
+                continue
+            _seen.add(id(tensor))
+            total += tensor.numel() * tensor.element_size()
+        return total
+    if isinstance(obj, torch.Tensor):
+        return obj.numel() * obj.element_size()
+    if depth <= 0:
+        return 0
+    children = getattr(obj, "components", None)
+    if not isinstance(children, dict):
+        children = getattr(obj, "__dict__", {})
+    return sum(get_module_bytes(v, depth - 1, _seen) for v in children.values())
+
+
+class PipelineCache:
+    """
+    process-wide LRU cache of loaded pipelines,the newest entry is kept while the budget allows,older ones are
+    evicted once the sum of their weights is over budget_gb. entries unused for idle_timeout seconds are dropped
+    by the idle sweeper,everything is dropped when comfyUI unloads its models.
+    """
+
+    def __init__(self, budget_gb=PIPE_CACHE_GB, idle_timeout=PIPE_CACHE_IDLE):
+        self.budget = int(budget_gb * 1024 ** 3)
+        self.idle_timeout = idle_timeout
+        self.entries = OrderedDict()  # key:(entry,size,last used)
+        self.lock = threading.RLock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            entry, size, _ = self.entries[key]
+            self.entries[key] = (entry, size, time.monotonic())
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry, size=None):
+        if size is None:
+            size = get_module_bytes(entry.get("pipe"))
+        with self.lock:
+            self.entries[key] = (entry, size, time.monotonic())
+            self.entries.move_to_end(key)
+            logging.info(f"pipeline cached ({size / 1024 ** 3:.2f} GB),total {self.total_bytes() / 1024 ** 3:.2f} GB in {len(self.entries)} pipes")
+            self.evict()
+
+    def total_bytes(self):
+        return sum(size for _, size, _ in self.entries.values())
+
+    def evict(self, keep_latest=True):
+        with self.lock:
+            evicted = False
+            while len(self.entries) > int(keep_latest) and self.total_bytes() > self.budget:
+                key, _ = self.entries.popitem(last=False)
+                logging.info(f"evict cached pipeline {key[:3]}...")
+                evicted = True
+        if evicted:
+            gc.collect()
+            torch.cuda.empty_cache()
+
+    def reserve(self):
+        # call on a miss before building,so the old pipe is released first instead of doubling the peak memory
+        self.evict(keep_latest=False)
+
+    def discard(self, pipe):
+        # drop the entries holding pipe,for pipes another stage changed in a way that can not be undone
+        with self.lock:
+            for key in [key for key, (entry, _, _) in self.entries.items() if entry.get("pipe") is pipe]:
+                logging.info(f"drop modified cached pipeline {key[:3]}...")
+                del self.entries[key]
+
+    def sweep(self):
+        if self.idle_timeout <= 0:
+            return
+        now = time.monotonic()
+        with self.lock:
+            idle = [key for key, (_, _, used) in self.entries.items() if now - used > self.idle_timeout]
+            for key in idle:
+                logging.info(f"drop idle cached pipeline {key[:3]}...")
+                del self.entries[key]
+        if idle:
+            gc.collect()
+            torch.cuda.empty_cache()
+
+    def clear(self):
+        with self.lock:
+            if not self.entries:
+                return
+            self.entries.clear()
+        gc.collect()
+        torch.cuda.empty_cache()
+
+
+pipe_cache = PipelineCache()
+# ms-diffusion img2img stack (sdxl pipe,controlnet,MSAdapter,clip vision) with STORY_MS_CACHE=1,txt2img keeps it on the story pipe
+ms_cache = PipelineCache()
+
+
+class CharacterLibrary:
+    """
+    index of saved character banks,root/index.json maps a hash of (character prompt,model,settings)
+    to the bank file and the id images sampled with it (relative to root) and keeps the character name and settings.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.index_path = os.path.join(root, "index.json")
+        self._index = {}
+        self._mtime = None
+
+    @property
+    def index(self):
+        # reread when another run (or a user) changed the manifest
+        mtime = os.path.getmtime(self.index_path) if os.path.isfile(self.index_path) else None
+        if mtime != self._mtime:
+            self._mtime = mtime
+            self._index = {}
+            if mtime is not None:
+                try:
+                    with open(self.index_path, "r", encoding="utf-8") as f:
+                        self._index = json.load(f)
+                except (OSError, ValueError) as e:
+                    logging.warning(f"character library index {self.index_path} is unreadable: {e}")
+        return self._index
+
+    def get(self, key):
+        entry = self.index.get(key)
+        if entry is None:
+            return None
+        path = os.path.join(self.root, entry["file"])
+        return path if os.path.isfile(path) else None
+
+    def get_images(self, key):
+        # the id images of the bank,None for entries saved without them or with missing files
+        entry = self.index.get(key)
+        if entry is None or not entry.get("images"):
+            return None
+        paths = [os.path.join(self.root, image) for image in entry["images"]]
+        return paths if all(os.path.isfile(path) for path in paths) else None
+
+    def find(self, character):
+        return [entry for entry in self.index.values() if entry["character"] == character]
+
+    def add(self, key, character, filepath, images=(), **settings):
+        index = dict(self.index)
+        index[key] = {"character": character, "file": os.path.relpath(filepath, self.root),
+                      "images": [os.path.relpath(image, self.root) for image in images], **settings}
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(index, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.index_path)
+        self._index = index
+        self._mtime = os.path.getmtime(self.index_path)
+
+
+def _map_tensors(value, fn):
+    # apply fn to every tensor of an encoder output (tuples,lists and dicts of comfy conditionings)
+    if isinstance(value, torch.Tensor):
+        return fn(value)
+    if isinstance(value, (list, tuple)):
+        return type(value)(_map_tensors(v, fn) for v in value)
+    if isinstance(value, dict):
+        return {k: _map_tensors(v, fn) for k, v in value.items()}
+    return value
+
+
+class PromptEmbedCache:
+    """
+    process-wide LRU cache of text encoder outputs,keyed by (encoder id,text,max_sequence_length,clip_skip...).
+    entries are kept on cpu and bounded by max_items and max_bytes,a hit is moved back to the encoder's device.
+    the entries of an encoder are dropped when it is garbage collected,so a reused id() never hits stale embeds.
+    """
+
+    def __init__(self, max_items=PROMPT_CACHE_SIZE, max_bytes=PROMPT_CACHE_MB * 1024 ** 2):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key:(cpu value,device,bytes)
+        self.nbytes = 0
+        self.owners = set()
+        self.hits = 0
+        self.misses = 0
+        # reentrant,the finalizer of an encoder may call drop() from a gc run inside a locked section
+        self.lock = threading.RLock()
+
+    def get_or_encode(self, owner, key, encode):
+        if self.max_items <= 0 or self.max_bytes <= 0:
+            return encode()
+        key = (id(owner),) + tuple(key)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            else:
+                self.misses += 1
+        if entry is not None:
+            value, device, _ = entry
+            return _map_tensors(value, lambda t: t.to(device)) if device is not None else value
+        value = encode()  # outside the lock,another run may encode meanwhile
+        tensors = []
+
+        def to_cpu(tensor):
+            tensors.append(tensor)
+            return tensor.detach().to("cpu")
+
+        cpu_value = _map_tensors(value, to_cpu)
+        nbytes = sum(t.numel() * t.element_size() for t in tensors)
+        if nbytes > self.max_bytes:
+            return value
+        with self.lock:
+            if id(owner) not in self.owners:
+                self.owners.add(id(owner))
+                weakref.finalize(owner, self.drop, id(owner))
+            old = self.entries.pop(key, None)
+            if old is not None:  # encoded by two runs at once
+                self.nbytes -= old[2]
+            self.entries[key] = (cpu_value, tensors[0].device if tensors else None, nbytes)
+            self.nbytes += nbytes
+            while len(self.entries) > self.max_items or self.nbytes > self.max_bytes:
+                self.nbytes -= self.entries.popitem(last=False)[1][2]
+        return value
+
+    def drop(self, owner_id):
+        with self.lock:
+            self.owners.discard(owner_id)
+            for key in [key for key in self.entries if key[0] == owner_id]:
+                self.nbytes -= self.entries.pop(key)[2]
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "items": len(self.entries), "MB": round(self.nbytes / 1024 ** 2, 1)}
+
+
+prompt_cache = PromptEmbedCache()
+
+
+def _prompt_key_arg(value):
+    # prompts,numbers and devices make the key,tensors (precomputed embeds,images) are not cacheable
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, torch.device):
+        return str(value)
+    if isinstance(value, (list, tuple)) and all(isinstance(v, str) for v in value):
+        return tuple(value)
+    raise TypeError(type(value))
+
+
+def enable_prompt_cache(pipe):
+    """
+    route pipe.encode_prompt (sdxl,kolors chatglm,flux t5/clip,sd3...) through prompt_cache,
+    calls with tensors in the arguments still encode every time.
+    """
+    encode_prompt = getattr(pipe, "encode_prompt", None)
+    if encode_prompt is None or getattr(encode_prompt, "prompt_cached", False):
+        return pipe
+    owner = next((getattr(pipe, name) for name in ("text_encoder", "text_encoder_2", "text_encoder_3")
+                  if getattr(pipe, name, None) is not None), None)
+    if owner is None:
+        return pipe
+    encoder_ids = tuple(id(getattr(pipe, name, None)) for name in ("text_encoder", "text_encoder_2", "text_encoder_3"))
+
+    @functools.wraps(encode_prompt)
+    def cached_encode_prompt(*args, **kwargs):
+        try:
+            key = (encoder_ids, tuple(_prompt_key_arg(v) for v in args),
+                   tuple((k, _prompt_key_arg(v)) for k, v in sorted(kwargs.items())))
+        except TypeError:
+            return encode_prompt(*args, **kwargs)
+        return prompt_cache.get_or_encode(owner, key, lambda: encode_prompt(*args, **kwargs))
+
+    cached_encode_prompt.prompt_cached = True
+    pipe.encode_prompt = cached_encode_prompt
+    return pipe
+
+
+class FaceAnalysisCache:
+    """
+    disk cache of face analysis results (embeddings,bboxes,keypoints,masks) stored as one .npz per image,
+    keyed by the image content hash + mode,so repeated reference images never load the face models.
+    """
+
+    def __init__(self, root, enabled=FACE_CACHE):
+        self.root = root
+        self.enabled = enabled
+
+    def get_path(self, img, mode):
+        array = np.asarray(img)
+        digest = hashlib.sha1(array.tobytes())
+        digest.update(f"{array.shape}{mode}".encode("utf-8"))
+        return os.path.join(self.root, f"{digest.hexdigest()}.npz")
+
+    def get(self, img, mode):
+        if not self.enabled:
+            return None
+        path = self.get_path(img, mode)
+        if not os.path.isfile(path):
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                return {k: data[k] for k in data.files}
+        except (OSError, ValueError) as e:
+            logging.warning(f"face cache {path} is unreadable: {e}")
+            return None
+
+    def put(self, img, mode, record):
+        if not self.enabled:
+            return
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        path = self.get_path(img, mode)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **record)
+        os.replace(tmp_path, path)
+
+
+class ModelPool:
+    """
+    process-wide pool of face models (detector/recognizer apps,antelopev2,AuraFace,mask pipeline,arcface...),
+    shared by every loader run. release() applies the policy after a run,models unused for idle_timeout
+    seconds are dropped by the idle sweeper. onnx sessions can not change device,so "cpu" only parks torch modules.
+    """
+
+    def __init__(self, policy=FACE_POOL_POLICY, idle_timeout=FACE_POOL_IDLE):
+        self.policy = policy
+        self.idle_timeout = idle_timeout
+        self.entries = {}  # key:[model,home device,last used,prepared det size]
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def get_torch_module(model):
+        # the module itself or the .model of a transformers pipeline
+        module = model if isinstance(model, torch.nn.Module) else getattr(model, "model", None)
+        return module if isinstance(module, torch.nn.Module) else None
+
+    @staticmethod
+    def get_det_model(model):
+        # the detector of insightface apps,FaceAnalysis2/analyze_faces change its input size per call
+        det_model = getattr(model, "det_model", None)
+        return det_model if hasattr(det_model, "input_size") else None
+
+    def get(self, key, build):
+        self.sweep()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                model = build()
+                module = self.get_torch_module(model)
+                param = next(module.parameters(), None) if module is not None else None
+                home = param.device if param is not None else None
+                det_model = self.get_det_model(model)
+                entry = [model, home, 0.0, det_model.input_size if det_model is not None else None]
+                self.entries[key] = entry
+            else:
+                if entry[1] is not None:
+                    self.get_torch_module(entry[0]).to(entry[1])  # wake a parked module
+                if entry[3] is not None:
+                    self.get_det_model(entry[0]).input_size = entry[3]  # the size it was prepared with,e.g. 640
+            entry[2] = time.monotonic()
+            return entry[0]
+
+    def release(self):
+        if self.policy == "evict":
+            self.clear()
+            return
+        if self.policy == "cpu":
+            with self.lock:
+                for model, home, _, _ in self.entries.values():
+                    if home is not None and home.type != "cpu":
+                        self.get_torch_module(model).to("cpu")
+        self.sweep()
+
+    def sweep(self):
+        now = time.monotonic()
+        with self.lock:
+            idle = [key for key, entry in self.entries.items() if now - entry[2] > self.idle_timeout]
+            for key in idle:
+                logging.info(f"drop idle face model {key[0]}")
+                del self.entries[key]
+        if idle:
+            gc.collect()
+            torch.cuda.empty_cache()
+
+    def clear(self):
+        with self.lock:
+            if not self.entries:
+                return
+            self.entries.clear()
+        gc.collect()
+        torch.cuda.empty_cache()
+
+
+face_pool = ModelPool()
+
+
+def get_hub_revision(repo_id, revision=None):
+    # commit sha a hub revision (branch,tag,"refs/pr/1"...) resolves to,from the hub when online,else from the hf cache
+    revision = revision or "main"
+    if re.fullmatch(r"[0-9a-f]{40}", revision):
+        return revision
+    try:
+        from huggingface_hub import constants, model_info
+    except ImportError:
+        return None
+    if not constants.HF_HUB_OFFLINE:
+        try:
+            return model_info(repo_id, revision=revision, timeout=10).sha
+        except Exception:
+            pass
+    ref_path = os.path.join(constants.HF_HUB_CACHE, "models--" + repo_id.replace("/", "--"), "refs", revision)
+    try:
+        with open(ref_path, "r", encoding="utf-8") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+class QuantizedWeightCache:
+    """
+    disk cache of already quantized weights (bnb nf4,quanto qfloat8) as safetensors,keyed by the source
+    checkpoint (path+mtime of its weight files,or the hub repo id,subfolder and the commit its revision resolves to)
+    and the quant mode,a hit is read from the mmap'd file and skips both the full precision weights and the quantize
+    pass. saving a new file for a source removes the older files of the same source and mode.
+    """
+
+    def __init__(self, root, enabled=QUANT_CACHE):
+        self.root = root
+        self.enabled = enabled
+        self.hub_revisions = {}  # (repo id,revision):(commit sha,resolved at),so get and put agree without a second call
+
+    def get_revision(self, repo_id, revision):
+        key = (repo_id, revision)
+        sha, resolved = self.hub_revisions.get(key, (None, 0.0))
+        if sha is None or time.monotonic() - resolved > 300:
+            sha = get_hub_revision(repo_id, revision)
+            self.hub_revisions[key] = (sha, time.monotonic())
+        return sha
+
+    def get_path(self, source, mode, subfolder=None, revision=None):
+        local = os.path.join(source, subfolder) if subfolder else source
+        stamps = [get_file_stamp(f) for f in sorted(get_weight_files(local))]
+        if not stamps:  # a hub repo id
+            stamps = [source, subfolder, self.get_revision(source, revision)]
+        return os.path.join(self.root, f"{mode}_{get_hash_key(stamps, mode)}.safetensors")
+
+    def evict_stale(self, source, subfolder, mode, keep_path):
+        # files of an older mtime/revision of the same source are never hit again
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if not name.endswith(".safetensors") or os.path.normpath(path) == os.path.normpath(keep_path):
+                continue
+            try:
+                with safe_open(path, framework="pt", device="cpu") as f:
+                    metadata = f.metadata() or {}
+            except Exception:
+                continue
+            if (metadata.get("source") == str(source) and metadata.get("subfolder", "") == (subfolder or "")
+                    and metadata.get("mode") == mode):
+                try:
+                    os.remove(path)
+                    logging.info(f"removed stale {mode} quantized weights of {source} {path}")
+                except OSError as e:  # still mapped by a loaded model on windows
+                    logging.warning(f"can not remove stale quantized weights {path}: {e}")
+
+    def get(self, source, mode, subfolder=None, revision=None):
+        if not self.enabled:
+            return None
+        path = self.get_path(source, mode, subfolder, revision)
+        return path if os.path.isfile(path) else None
+
+    @staticmethod
+    def load(path):
+        with safe_open(path, framework="pt", device="cpu") as f:
+            metadata = f.metadata() or {}
+            state_dict = {k: f.get_tensor(k) for k in f.keys()}
+        for alias, name in json.loads(metadata.get("aliases", "{}")).items():
+            state_dict[alias] = state_dict[name]
+        return state_dict, metadata
+
+    def put(self, source, mode, state_dict, subfolder=None, revision=None, **metadata):
+        if not self.enabled:
+            return None
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        # safetensors refuses shared tensors (tied embeddings...),keep one copy and record the aliases
+        tensors, aliases, seen = {}, {}, {}
+        for k, v in state_dict.items():
+            v = v.detach()
+            ptr = (v.device, v.data_ptr(), tuple(v.shape), v.dtype)
+            if ptr in seen:
+                aliases[k] = seen[ptr]
+                continue
+            seen[ptr] = k
+            tensors[k] = v.to("cpu").contiguous()
+        metadata = {k: v if isinstance(v, str) else json.dumps(v) for k, v in metadata.items()}
+        metadata.update(source=str(source), subfolder=subfolder or "", mode=mode, aliases=json.dumps(aliases))
+        path = self.get_path(source, mode, subfolder, revision)
+        tmp_path = path + ".tmp"
+        save_file(tensors, tmp_path, metadata=metadata)
+        os.replace(tmp_path, path)
+        logging.info(f"saved {mode} quantized weights of {source} to {path}")
+        self.evict_stale(source, subfolder, mode, path)
+        return path
+
+
+_unload_callbacks = []
+
+
+def on_comfy_unload(callback):
+    """
+    run callback when comfyUI unloads all models (the "free model memory" action of the ui/api),
+    so the caches of this package release their pipes and models with comfyUI's own.
+    """
+    _unload_callbacks.append(callback)
+    try:
+        import comfy.model_management as model_management
+    except ImportError:
+        return
+    unload_all_models = model_management.unload_all_models
+    if getattr(unload_all_models, "story_hooked", False):
+        return
+
+    @functools.wraps(unload_all_models)
+    def hooked_unload_all_models(*args, **kwargs):
+        for unload in list(_unload_callbacks):
+            try:
+                unload()
+            except Exception as e:
+                logging.warning(f"story cache release failed: {e}")
+        return unload_all_models(*args, **kwargs)
+
+    hooked_unload_all_models.story_hooked = True
+    model_management.unload_all_models = hooked_unload_all_models
+
+
+_idle_sweeps = []
+_idle_sweeper = None
+
+
+def on_idle_sweep(sweep, interval=60.0):
+    # a daemon thread runs every registered sweep,so idle entries are dropped even when no further run comes
+    global _idle_sweeper
+    _idle_sweeps.append(sweep)
+    if _idle_sweeper is not None:
+        return
+
+    def run():
+        while True:
+            time.sleep(interval)
+            for idle_sweep in list(_idle_sweeps):
+                try:
+                    idle_sweep()
+                except Exception as e:
+                    logging.warning(f"story cache idle sweep failed: {e}")
+
+    _idle_sweeper = threading.Thread(target=run, name="story_idle_sweeper", daemon=True)
+    _idle_sweeper.start()
+
+
+for _cache in (pipe_cache, ms_cache, face_pool):
+    on_comfy_unload(_cache.clear)
+    on_idle_sweep(_cache.sweep)
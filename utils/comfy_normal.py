@@ -3,6 +3,7 @@ import torch
 import numpy as np
 from PIL import Image
 import node_helpers
+import comfy.model_management
 from nodes import common_ksampler
 
 def phi2tensor(img):
@@ -20,6 +21,31 @@ class CFGenerator:
         self.ae=ae
         self.clip=clip
         self.model_type=model_type
+        self.session=None  # text:conditioning while a story session is open
+
+    def encode(self, text):
+        tokens = self.clip.tokenize(text)
+        output = self.clip.encode_from_tokens(tokens, return_pooled=True, return_dict=True)
+        cond = output.pop("cond")
+        return [[cond, output]]
+
+    def get_conditioning(self, text):
+        if self.session is None:
+            return self.encode(text)
+        if text not in self.session:
+            self.session[text] = self.encode(text)
+        return self.session[text]
+
+    def begin_session(self, prompts, negative_prompts=()):
+        # encode every panel prompt of a sampler run before sampling,then load the model and vae together,
+        # so comfy does not page them out for the text encoder between panels
+        self.session = {}
+        for text in dict.fromkeys(list(prompts) + list(negative_prompts)):
+            self.session[text] = self.encode(text)
+        comfy.model_management.load_models_gpu([self.model, self.ae.patcher])
+
+    def end_session(self):
+        self.session = None
 
     @torch.inference_mode()
     def generate_image(
@@ -53,10 +79,7 @@ class CFGenerator:
         
        
         #cf clip postive
-        tokens = self.clip.tokenize(text)
-        output = self.clip.encode_from_tokens(tokens, return_pooled=True, return_dict=True)
-        cond = output.pop("cond")
-        conditioning=[[cond, output]]
+        conditioning=self.get_conditioning(text)
         
         #flux GUIDANCE
         if self.model_type == "FLUX":
@@ -65,10 +88,7 @@ class CFGenerator:
             postive_c=conditioning
             
         #cf neg
-        tokens_ = self.clip.tokenize(negative_text)
-        output_ = self.clip.encode_from_tokens(tokens_, return_pooled=True, return_dict=True)
-        cond_ = output_.pop("cond")
-        negative_c = [[cond_, output_]]
+        negative_c = self.get_conditioning(negative_text)
         
         if image:
             if isinstance(image,list):
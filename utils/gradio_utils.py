@@ -271,6 +271,63 @@ def cal_attn_indice_xl_effcient_memory(total_length,id_length,sa32,sa64,height_s
     return indices1024,indices4096
 
 
+class AttnIndicePlan:
+    r"""
+    Consistent attention indices of every denoising step, sampled once with a seeded cpu generator.
+    The indices of each (step, image) are packed in one int32 buffer per resolution on device,
+    so the unet loop only slices it and never calls `nonzero`.
+    """
+    def __init__(self,total_length,id_length,sa32,sa64,height_s,width_s,steps,seed,device="cuda"):
+        self.total_length = total_length
+        self.id_length = id_length
+        self.steps = max(int(steps),1)
+        generator = torch.Generator(device="cpu").manual_seed(int(seed))
+        nums_1024 = (height_s // 32) * (width_s // 32)
+        nums_4096 = (height_s // 16) * (width_s // 16)
+        self.nums_1024 = nums_1024
+        self.buffer1024,self.offsets1024 = self.pack(nums_1024,sa32,generator,device)
+        self.buffer4096,self.offsets4096 = self.pack(nums_4096,sa64,generator,device)
+
+    def pack(self,nums,sa,generator,device):
+        bool_matrix = torch.rand((self.steps * self.total_length,nums),generator=generator) < sa
+        counts = bool_matrix.sum(dim=1).tolist()
+        offsets = [0]
+        for count in counts:
+            offsets.append(offsets[-1] + count)
+        # nonzero is row-major,so indices of row k are buffer[offsets[k]:offsets[k+1]]
+        buffer = torch.nonzero(bool_matrix,as_tuple=True)[1].to(device=device,dtype=torch.int32)
+        return buffer,offsets
+
+    def get(self,step):
+        start = (step % self.steps) * self.total_length
+        indices1024 = [self.buffer1024[self.offsets1024[k]:self.offsets1024[k + 1]] for k in range(start,start + self.total_length)]
+        indices4096 = [self.buffer4096[self.offsets4096[k]:self.offsets4096[k + 1]] for k in range(start,start + self.total_length)]
+        return indices1024,indices4096
+
+    def max_length(self,nums,img_nums):
+        # most tokens the first img_nums images of one step write,used to preallocate the id bank
+        offsets = self.offsets1024 if nums == self.nums_1024 else self.offsets4096
+        img_nums = min(img_nums,self.total_length)
+        return max(offsets[s * self.total_length + img_nums] - offsets[s * self.total_length] for s in range(self.steps))
+
+    def nbytes(self):
+        return (self.buffer1024.numel() + self.buffer4096.numel()) * 4
+
+
+_indice_plans = {}
+
+
+def get_attn_indice_plan(total_length,id_length,sa32,sa64,height_s,width_s,steps,seed,device="cuda",max_plans=8):
+    key = (total_length,id_length,sa32,sa64,height_s,width_s,steps,seed,str(device))
+    plan = _indice_plans.pop(key,None)
+    if plan is None:
+        plan = AttnIndicePlan(total_length,id_length,sa32,sa64,height_s,width_s,steps,seed,device=device)
+    _indice_plans[key] = plan  # newest at the end
+    while len(_indice_plans) > max_plans:
+        _indice_plans.pop(next(iter(_indice_plans)))
+    return plan
+
+
 class AttnProcessor(nn.Module):
     r"""
     Default processor for performing attention-related computations.
@@ -1,6 +1,9 @@
+import cv2
 import numpy as np
 # pip install insightface==0.7.3
 from insightface.app import FaceAnalysis
+from insightface.app.common import Face
+from insightface.utils import face_align
 from insightface.data import get_image as ins_get_image
 
 ### 
@@ -27,3 +30,59 @@ def analyze_faces(face_analysis: FaceAnalysis, img_data: np.ndarray, det_size=(6
             return faces
 
     return []
+
+
+def to_bgr(img, buffer=None):
+    # RGB PIL/array to BGR,written into buffer when the shape matches so a batch of references reuses one array
+    array = np.asarray(img)
+    if buffer is None or buffer.shape != array.shape:
+        buffer = np.empty_like(array)
+    cv2.cvtColor(array, cv2.COLOR_RGB2BGR, dst=buffer)
+    return buffer
+
+def get_faces_batch(face_analysis: FaceAnalysis, images, det_sizes=(None,), convert=True, recognize=True, on_image=None):
+    # NOTE: FaceAnalysis.get over many images. detection and the landmark/attribute models run per image
+    # through one reused BGR buffer,the recognition of every face runs in one batched get_feat call.
+    # det_sizes are tried in order until a face is found (like analyze_faces),on_image(data, faces) is
+    # called while the buffer still holds the image.
+    rec_model = face_analysis.models.get('recognition') if recognize else None
+    buffer = None
+    faces_list = []
+    crops = []
+    for img in images:
+        if convert:
+            buffer = to_bgr(img, buffer)
+            data = buffer
+        else:
+            data = np.asarray(img)
+        for size in det_sizes:
+            if size is not None:
+                face_analysis.det_model.input_size = size
+            bboxes, kpss = face_analysis.det_model.detect(data, max_num=0, metric='default')
+            if bboxes.shape[0] > 0:
+                break
+        faces = []
+        for i in range(bboxes.shape[0]):
+            face = Face(bbox=bboxes[i, 0:4], kps=kpss[i] if kpss is not None else None, det_score=bboxes[i, 4])
+            for taskname, model in face_analysis.models.items():
+                if taskname not in ('detection', 'recognition'):
+                    model.get(data, face)
+            if rec_model is not None:
+                crops.append(face_align.norm_crop(data, landmark=face.kps, image_size=rec_model.input_size[0]))
+            faces.append(face)
+        if on_image is not None:
+            on_image(data, faces)
+        faces_list.append(faces)
+    if crops:
+        try:
+            feats = rec_model.get_feat(crops)
+        except Exception:  # recognition models exported with a fixed batch of 1
+            feats = np.concatenate([rec_model.get_feat(crop) for crop in crops])
+        for face, feat in zip((face for faces in faces_list for face in faces), feats):
+            face['embedding'] = feat.flatten()
+    return faces_list
+
+def analyze_faces_batch(face_analysis: FaceAnalysis, images, convert=True):
+    # analyze_faces over many images,see get_faces_batch
+    detection_sizes = [None] + [(size, size) for size in range(640, 256, -64)] + [(256, 256)]
+    return get_faces_batch(face_analysis, images, det_sizes=detection_sizes, convert=convert)